@@ -1,9 +1,39 @@
 from django.contrib import admin
 
-from .models import Customer, Sale, Campaign, Coupon, StoreSettings
+from .models import (Customer, CustomerProfile, Sale, Campaign, Coupon, 
+        StoreSettings, ArchivedSale, ArchivedCoupon, ArchiveRollup, 
+        Notification, ScheduledTask, StoreShard, SaleIdempotencyKey, 
+        SuppressedCellphone, CouponEvent)
+from .views import release_held_sale
 
 admin.site.register(Customer)
-admin.site.register(Sale)
+admin.site.register(CustomerProfile)
 admin.site.register(Campaign)
 admin.site.register(Coupon)
 admin.site.register(StoreSettings)
+admin.site.register(ArchivedSale)
+admin.site.register(ArchivedCoupon)
+admin.site.register(ArchiveRollup)
+admin.site.register(Notification)
+admin.site.register(ScheduledTask)
+admin.site.register(StoreShard)
+admin.site.register(SaleIdempotencyKey)
+admin.site.register(SuppressedCellphone)
+admin.site.register(CouponEvent)
+
+
+@admin.register(Sale)
+class SaleAdmin(admin.ModelAdmin):
+    list_display = ('id', 'store', 'customer', 'final_value', 'date', 
+            'is_evaluated', 'is_flagged')
+    list_filter = ('is_flagged', 'is_evaluated')
+    actions = ['release_held_sales']
+
+    @admin.action(description="Release the held coupon issuance")
+    def release_held_sales(self, request, queryset):
+        """Issue the held coupons of the selected flagged sales."""
+        issued = [release_held_sale(sale_id) for sale_id in queryset.filter(
+                is_flagged=True, is_evaluated=False).values_list('id', 
+                flat=True)]
+        issued = [coupon for coupon in issued if coupon]
+        self.message_user(request, f"{len(issued)} coupons issued.")
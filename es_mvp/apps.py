@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class EsMvpConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'es_mvp'
+
+    def ready(self):
+        # Connects the receivers that forget the memoized store rows.
+        from . import auth
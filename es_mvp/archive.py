@@ -0,0 +1,155 @@
+"""
+Implement the hot/cold archival of coupons and sales.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.http import Http404
+from .models import (Sale, Coupon, ArchivedSale, ArchivedCoupon,
+        ArchiveRollup, CouponState, TERMINAL_STATES, VALIDATED_STATES)
+from .fragments import bump_data_version
+from .sharding import store_db
+from datetime import date, timedelta
+
+
+# Field names copied from the live rows to the archive rows.
+SALE_FIELDS = ('id', 'store_id', 'customer_id', 'initial_value',
+        'effective_discount', 'final_value', 'redeemed_coupon_id',
+        'identifier', 'is_evaluated', 'is_flagged', 'flag_reason', 'date', 
+        'date_added')
+COUPON_FIELDS = ('id', 'store_id', 'sale_id', 'campaign_id', 'customer_id',
+        'identifier', 'discount_value', 'discount_limit_rate',
+        'expiration_date', 'state', 'date_added')
+
+
+def archivable_rows(store_id, horizon_date):
+    """
+    Select the sales and coupons of a store that can be moved to the archive.
+    A sale is archivable if it is older than the horizon date, its issued
+    coupon (if any) is archivable and its redeemed coupon (if any) is
+    archivable. A coupon is archivable if it is in a terminal state (redeemed
+    or expired), its origination sale is archivable and its redemption sale (if
+    any) is archivable. The candidate sets are pruned until they are stable,
+    so the archive never references a live row (and vice versa).
+    Returns a tuple (sale ids, coupon ids).
+    """
+    # Maps each old sale to its redeemed coupon.
+    sales = dict(Sale.objects.filter(store=store_id,
+            date__lt=horizon_date).values_list('id', 'redeemed_coupon'))
+    # Maps each coupon issued from an old sale to its origination sale and its
+    # redemption sale.
+    issued = {}
+    terminal = set()
+    for coupon_id, sale_id, redemption_sale_id, state in (
+            Coupon.objects.filter(store=store_id, sale__in=sales.keys()
+            ).values_list('id', 'sale', 'redeemed_coupon', 'state')):
+        issued[sale_id] = (coupon_id, redemption_sale_id)
+        if state in TERMINAL_STATES:
+            terminal.add(coupon_id)
+    sale_ids = set(sales)
+    coupon_ids = {coupon_id for coupon_id, redemption_sale_id
+            in issued.values() if coupon_id in terminal}
+    # Prunes both sets until a fixed point.
+    changed = True
+    while changed:
+        changed = False
+        for coupon_id, redemption_sale_id in issued.values():
+            if ((coupon_id in coupon_ids) and redemption_sale_id and
+                    (redemption_sale_id not in sale_ids)):
+                coupon_ids.discard(coupon_id)
+                changed = True
+        for sale_id in list(sale_ids):
+            issued_coupon = issued.get(sale_id)
+            redeemed_coupon_id = sales[sale_id]
+            if ((issued_coupon and issued_coupon[0] not in coupon_ids) or
+                    (redeemed_coupon_id and
+                    redeemed_coupon_id not in coupon_ids)):
+                sale_ids.discard(sale_id)
+                changed = True
+        # A coupon can only be archived together with its origination sale.
+        for sale_id, (coupon_id, redemption_sale_id) in issued.items():
+            if (coupon_id in coupon_ids) and (sale_id not in sale_ids):
+                coupon_ids.discard(coupon_id)
+                changed = True
+    return sale_ids, coupon_ids
+
+
+def update_rollups(store_id, sale_ids, coupon_ids):
+    """
+    Add the totals of the rows about to be archived to the campaign rollups.
+    """
+    coupons = Coupon.objects.filter(id__in=coupon_ids)
+    totals = {}
+    for row in coupons.values('campaign').annotate(
+            cumulative_cashback=Sum('discount_value',
+                    filter=Q(state=CouponState.REDEEMED), default=0.00),
+            redeemed_coupons=Count('id', filter=Q(state=CouponState.REDEEMED)),
+            issued_coupons=Count('id', 
+                    filter=Q(state__in=VALIDATED_STATES)),
+            expired_coupons=Count('id', filter=Q(state=CouponState.EXPIRED))):
+        totals[row.pop('campaign')] = row
+    for row in Sale.objects.filter(id__in=sale_ids).exclude(
+            redeemed_coupon=None).values('redeemed_coupon__campaign').annotate(
+            cumulative_sales=Sum('final_value')):
+        totals.setdefault(row['redeemed_coupon__campaign'], {})[
+                'cumulative_sales'] = row['cumulative_sales']
+    for campaign_id, campaign_totals in totals.items():
+        ArchiveRollup.objects.get_or_create(store_id=store_id,
+                campaign_id=campaign_id)
+        ArchiveRollup.objects.filter(campaign_id=campaign_id).update(
+                **{field : F(field) + value
+                        for field, value in campaign_totals.items()})
+
+
+def archive_store(store_id, horizon_days=None):
+    """
+    Move the archivable sales and coupons of a store to the archive tables.
+    Everything happens in a single transaction. Returns a tuple (archived
+    sales, archived coupons).
+    """
+    if horizon_days is None:
+        horizon_days = settings.ARCHIVE_HORIZON_DAYS
+    horizon_date = date.today() - timedelta(days=horizon_days)
+    sale_ids, coupon_ids = archivable_rows(store_id, horizon_date)
+    if not sale_ids:
+        return 0, 0
+    with transaction.atomic(using=store_db()):
+        update_rollups(store_id, sale_ids, coupon_ids)
+        # Note: the foreign keys between archive tables are checked at the
+        # end of the transaction, so the insertion order does not matter.
+        ArchivedSale.objects.bulk_create(
+                ArchivedSale(**row) for row in Sale.objects.filter(
+                        id__in=sale_ids).values(*SALE_FIELDS))
+        ArchivedCoupon.objects.bulk_create(
+                ArchivedCoupon(**row) for row in Coupon.objects.filter(
+                        id__in=coupon_ids).values(*COUPON_FIELDS))
+        # Breaks the 'Sale.redeemed_coupon' <-> 'Coupon.sale' protected
+        # references before deleting the live rows.
+        Sale.objects.filter(id__in=sale_ids).update(redeemed_coupon=None)
+        Coupon.objects.filter(id__in=coupon_ids).delete()
+        # The archived rows leave the cached store lists.
+        bump_data_version(store_id)
+        Sale.objects.filter(id__in=sale_ids).delete()
+    return len(sale_ids), len(coupon_ids)
+
+
+def get_sale(sale_id):
+    """Get a live or archived sale. Raises 'Http404' if it does not exist."""
+    try:
+        return Sale.objects.get(id=sale_id)
+    except Sale.DoesNotExist:
+        try:
+            return ArchivedSale.objects.get(id=sale_id)
+        except ArchivedSale.DoesNotExist:
+            raise Http404
+
+
+def get_coupon(coupon_id):
+    """Get a live or archived coupon. Raises 'Http404' if it does not exist."""
+    try:
+        return Coupon.objects.get(id=coupon_id)
+    except Coupon.DoesNotExist:
+        try:
+            return ArchivedCoupon.objects.get(id=coupon_id)
+        except ArchivedCoupon.DoesNotExist:
+            raise Http404
@@ -0,0 +1,103 @@
+"""
+Implement the memoization of the store user and settings.
+"""
+from django.conf import settings
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from .models import StoreSettings
+
+### Store memoization
+#
+# Every store request loads its user (see 'AuthenticationMiddleware') and, in
+# most views, its settings. Both are memoized in the session cache
+# ('SESSION_CACHE_ALIAS'), so a store request usually runs its views without 
+# these fixed queries.
+# A memoized row is forgotten when it is saved (ex. a password change or a 
+# login) or deleted, and a memoized user on logout (see the receivers below).
+# It expires after 'STORE_MEMO_TIMEOUT' seconds (a bound for the rows changed
+# otherwise, ex. by a queryset update). The cache must be shared by the app 
+# processes, so a forgotten row is forgotten by all of them: without a shared
+# cache, the memoization is disabled (see the Platform.sh settings in the 
+# project settings.py).
+#
+###
+
+
+def memo_cache():
+    """
+    Return the cache of the memoized store rows, or None if the memoization is
+    disabled ('STORE_MEMO_TIMEOUT' is 0).
+    """
+    if not settings.STORE_MEMO_TIMEOUT:
+        return None
+    return caches[settings.SESSION_CACHE_ALIAS]
+
+
+def store_user_key(store_id):
+    """Return the cache key of a memoized store user."""
+    return f"store_user:{store_id}"
+
+
+def store_settings_key(store_id):
+    """Return the cache key of memoized store settings."""
+    return f"store_settings:{store_id}"
+
+
+class MemoizedModelBackend(ModelBackend):
+    """The model authentication backend, with the store users memoized."""
+
+    def get_user(self, user_id):
+        cache = memo_cache()
+        if cache is None:
+            return super().get_user(user_id)
+        user = cache.get(store_user_key(user_id))
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(store_user_key(user_id), user,
+                        settings.STORE_MEMO_TIMEOUT)
+        return user
+
+
+def get_store_settings(store):
+    """
+    Return the settings of a store, memoized. Raises 'StoreSettings.
+    DoesNotExist' (as 'StoreSettings.objects.get()') for a store without
+    settings.
+    Note: the memoized settings are read-only (use 'StoreSettings.objects' to
+    edit them).
+    """
+    cache = memo_cache()
+    if cache is None:
+        return StoreSettings.objects.get(store=store)
+    store_settings = cache.get(store_settings_key(store.id))
+    if store_settings is None:
+        store_settings = StoreSettings.objects.get(store=store)
+        cache.set(store_settings_key(store.id), store_settings,
+                settings.STORE_MEMO_TIMEOUT)
+    return store_settings
+
+
+@receiver([post_save, post_delete], sender=User)
+def forget_store_user(sender, instance, **kwargs):
+    """Forget a memoized store user (ex. on login or password change)."""
+    if memo_cache() is not None:
+        memo_cache().delete(store_user_key(instance.id))
+
+
+@receiver(user_logged_out)
+def forget_logged_out_user(sender, request, user, **kwargs):
+    """Forget the memoized user of a logout."""
+    if (user is not None) and (memo_cache() is not None):
+        memo_cache().delete(store_user_key(user.id))
+
+
+@receiver([post_save, post_delete], sender=StoreSettings)
+def forget_store_settings(sender, instance, **kwargs):
+    """Forget memoized store settings."""
+    if memo_cache() is not None:
+        memo_cache().delete(store_settings_key(instance.store_id))
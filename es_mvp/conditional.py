@@ -0,0 +1,96 @@
+"""
+Implement the conditional GET validators of the sale, coupon and campaign
+detail pages.
+"""
+from django.contrib import messages
+from django.utils.cache import patch_cache_control
+from .models import (Sale, Coupon, ArchivedSale, ArchivedCoupon, CouponState,
+        APPLICABLE_STATES)
+from .fragments import data_version
+from datetime import date
+import hashlib
+
+### Conditional GET
+#
+# Each detail view is decorated with 'condition()' (see 'django.views.
+# decorators.http'), with an ETag function below. The ETag is derived from the
+# displayed state of the row (read in a single lightweight query), so an
+# unchanged page is answered with a '304 Not Modified' before the view runs.
+# The campaign ETag is the store data version (see 'es_mvp/fragments.py'), as
+# its page summarizes the store coupons.
+# The pages also carry the store session (ex. the CSRF token of the logout
+# form), so the ETag includes the CSRF secret, and a page with pending flash
+# messages is never validated.
+# The pages are always revalidated: they are private to the logged in store
+# (and must not be shown from the browser cache after a logout), and their 
+# CSRF token rotates with each login.
+#
+###
+
+
+def page_etag(request, *state):
+    """
+    Return the ETag of a detail page from its displayed state, or None (no
+    conditional response).
+    """
+    if len(messages.get_messages(request)):
+        return None
+    state = (request.user.id, request.META.get('CSRF_COOKIE')) + state
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+
+def effective_state(state, expiration_date, today=None):
+    """Return the coupon state, with the expiration evaluated at read time."""
+    if (state in APPLICABLE_STATES) and (expiration_date <
+            (today or date.today())):
+        return CouponState.EXPIRED
+    return state
+
+
+def sale_etag(request, sale_id):
+    """Return the ETag of a sale page (see 'views.sale()')."""
+    row = Sale.objects.filter(id=sale_id, store=request.user).values_list(
+            'is_evaluated', 'is_flagged', 'flag_reason', 'coupon',
+            'store__storesettings__currency').first()
+    if row is None:
+        # Note: the archived rows do not change.
+        row = ArchivedSale.objects.filter(id=sale_id,
+                store=request.user).values_list('id',
+                'store__storesettings__currency').first()
+        if row is None:
+            # Lets the view handle a missing or unowned sale.
+            return None
+        row = ('archived',) + row
+    return page_etag(request, 'sale', sale_id, *row)
+
+
+def coupon_etag(request, coupon_id):
+    """Return the ETag of a coupon page (see 'views.coupon()')."""
+    row = Coupon.objects.filter(id=coupon_id, store=request.user).values_list(
+            'state', 'expiration_date', 'redeemed_coupon',
+            'store__storesettings__currency').first()
+    if row is None:
+        row = ArchivedCoupon.objects.filter(id=coupon_id,
+                store=request.user).values_list('id',
+                'store__storesettings__currency').first()
+        if row is None:
+            return None
+        return page_etag(request, 'archived_coupon', coupon_id, *row)
+    state, expiration_date, bonified_sale, currency = row
+    return page_etag(request, 'coupon', coupon_id, effective_state(state,
+            expiration_date), bonified_sale, currency)
+
+
+def campaign_etag(request, campaign_id):
+    """Return the ETag of a campaign page (see 'views.campaign()')."""
+    return page_etag(request, 'campaign', campaign_id,
+            data_version(request.user.id), date.today())
+
+
+def patch_detail_cache(response):
+    """
+    Set the browser cache policy of a detail page: it is kept private and
+    revalidated (with the ETag) on each view.
+    """
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
@@ -1,124 +1,176 @@
-from .models import Customer, Coupon, StoreSettings
-from .sms import sending_sms_aws
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .models import (Coupon, StoreSettings, CouponState, Notification, 
+        CustomerProfile, SaleIdempotencyKey)
+from .sms import sms_cost_report
+from .notifications import (activation_step, plan_notifications, 
+        schedule_notifications, deliver_notifications)
+from .archive import archive_store
+from .wallet import refresh_wallets
+from .fragments import bump_data_version
+from .scheduler import register
+from .routers import read_replica
+from .sharding import per_shard, store_db, moving_stores
+from .suppression import sync_opt_outs
 from datetime import date, datetime, timedelta
-from math import floor
-import kronos
+import logging
 
 ### Important:
 #
-# This module uses django-kronos package. See the documentation in: 
-# https://github.com/jgorset/django-kronos
+# The tasks of this module are run by the app scheduler (see 
+# 'es_mvp/scheduler.py'). The cron expressions are evaluated in the project 
+# timezone. 
 #
-# It is necessary to update the cron registry to include a new function.
-# Command: python manage.py installtasks
+# To run the scheduler service (on one or many app nodes):
+# Command: python manage.py runscheduler
 #
-# To check registred tasks.
-# Command: python manage.py showtasks
+# To check the registered tasks and their run state.
+# Command: python manage.py runscheduler --status
 #
 # To test a routine manually 
-# Command: python manage.py runtask <function>
+# Command: python manage.py runscheduler --run <function>
 #
-# Note: due to the use of a virtual environment, was necessary to include in 
-# the app settings.py:
-# KRONOS_PREFIX = 'source ...es_mvp_env/bin/activate &&'
+# Each task runs once per store shard (see 'es_mvp/sharding.py'), and returns
+# a dict of its results by shard. The tasks over global tables run once.
+# The stores moving between shards are skipped (see 'moving_stores()'): their
+# rows are caught up by the next run.
 #
 ###
 
+logger = logging.getLogger(__name__)
+
 # Runs everiday, 3:00AM.
-@kronos.register('0 3 * * *')
+@register('0 3 * * *')
+@per_shard
 def coupon_expiration_task():
-    """Process expired coupons."""
-    today = date.today()
-    # Gets all valid, unredeemed and non-expired coupons.
-    valid_coupons = Coupon.objects.filter(is_valid=True, is_redeemed=False, 
-            is_expired=False)
-    for coupon in valid_coupons:
-        # If the coupon is expired, update its status.
-        if coupon.expiration_date < today:
-            coupon.is_expired = True
-            coupon.save()
+    """
+    Process expired coupons.
+    The expiration is evaluated at read time (see 'CouponQuerySet'), thus this 
+    task only settles the stored state of the overdue coupons in bulk. It is 
+    not in the critical path and can run infrequently.
+    """
+    moving = moving_stores()
+    coupons = Coupon.objects.exclude(store__in=moving)
+    with transaction.atomic(using=store_db()):
+        # Invalidates the cached fragments of the stores with overdue coupons.
+        bump_data_version(*coupons.overdue().values_list('store', 
+                flat=True).distinct())
+        coupons.settle_expired()
+        # Refreshes the customer wallets with an expired coupon.
+        refresh_wallets(CustomerProfile.objects.exclude(
+                store__in=moving).filter(
+                next_expiration__lt=date.today()).values_list('customer', 
+                flat=True))
     ## TO-DO: to implement a logging registry to this task.
     return None
 
-# Runs everiday, 8:00AM.
-@kronos.register('0 8 * * *')
+# Runs everyday, 0:30AM (before the activation cycle).
+@register('30 0 * * *')
+def opt_out_sync_task():
+    """
+    Suppress the cellphones that opted out at the SMS provider (see 
+    'es_mvp/suppression.py'). A global task.
+    """
+    suppressed = sync_opt_outs()
+    logger.info("Opt-out sync: %s cellphones suppressed.", suppressed)
+    return suppressed
+
+# Runs everiday, 1:00AM.
+@register('0 1 * * *')
+@per_shard
 def coupon_activation_task():
     """
     Handle the coupon activation cycle.
     Currently this app only supports the sending activation messages by SMS with
     the AWS SNS API. The activation cycle comprehends 4 steps, sending a 
-    specific message in each step. The first three steps are function of the 
-    coupon added date. And the last step are related with the coupon expiration
-    date.
+    specific message in each step (see 'activation_step()' in 
+    'es_mvp/notifications.py').
+    The messages due today are planned: a customer gets at most one message per
+    day, merging their due coupons in a digest. Then the messages are queued in
+    slots spread across the delivery window of each store (see 
+    'notification_delivery_task'). The activation state transitions of the 
+    coupons are applied when their message is sent, so a coupon becomes valid
+    only from its first message delivered to a non-suppressed cellphone. 
+    Returns the projected cost report.
     """
 
     today = date.today()
-    # Gets all valid coupons, unredeemed, non-expired and not fully activated.
-    non_activated_coupons = Coupon.objects.filter(is_redeemed=False, 
-            is_expired=False, is_activated=False)
-    for coupon in non_activated_coupons:
-        # Gets the store settings and customer data to support message building.
-        settings = StoreSettings.objects.get(store=coupon.store.id)
-        customer = Customer.objects.get(id=coupon.sale.customer.id)
-        # Converts a datetime object in a date object:
-        trigger_date = date(coupon.date_added.year,
-                    coupon.date_added.month, coupon.date_added.day)
-        # The SMS recipient.
-        cellphone = f"+{customer.cellphone}"
-        ### First activation: if the coupon was issued 2 days ago.
-        if today == (trigger_date + timedelta(days=2)):
-            # Important: a SMS can have 140 ASCII characters. The variable part 
-            # of this message takes until 61 chars. Thus, the static part of the 
-            # string, including spaces and punctuation, must have 79 characters
-            # or less.
-            message = (f"You receive {settings.currency}" + 
-                    f"{floor(coupon.discount_value)} of cashback " + 
-                    f"on {settings.title}. Expires on " + 
-                    f"{format(coupon.expiration_date.day,'02d')}" +
-                    f".{format(coupon.expiration_date.month,'02d')}. Max " + 
-                    f"discount {coupon.discount_limit_rate}%, not cumulative. " +
-                    f"{coupon.campaign.url}")
-            sending_sms_aws(cellphone, message)
-            # Makes the coupon applicable.
-            coupon.is_valid = True
-            coupon.save()
-        ### Second activation: if the coupon was issued 7 days ago.
-        elif today == (trigger_date + timedelta(days=7)):
-            # The static part of the string must be 79 characters or less.
-            message = (f"You have {settings.currency}" + 
-                    f"{floor(coupon.discount_value)} cashback to purchases on" +
-                    f"{settings.title}. Expires on " + 
-                    f"{format(coupon.expiration_date.day,'02d')}" +
-                    f".{format(coupon.expiration_date.month,'02d')}. Max " + 
-                    f"discount {coupon.discount_limit_rate}%, not cumulative. " +
-                    f"{coupon.campaign.url}")
-            sending_sms_aws(cellphone, message)
-        ### Third activation: if the coupon was issued 27 days ago.
-        elif today == (trigger_date + timedelta(days=27)):
-            # The static part of the  string must be 79 characters or less.
-            message = (f"Don't let cashback expire {settings.currency}" + 
-                    f"{floor(coupon.discount_value)} for purchases on" +
-                    f"{settings.title}. Expires on " + 
-                    f"{format(coupon.expiration_date.day,'02d')}" +
-                    f".{format(coupon.expiration_date.month,'02d')}. Max " + 
-                    f"discount {coupon.discount_limit_rate}%, not cumulative. " +
-                    f"{coupon.campaign.url}")
-            sending_sms_aws(cellphone, message)
-        ### Last activation: if the coupon has an expiration lifetime greater 
-        ### than 35 days and there are only 3 days left before its expiration.
-        elif (coupon.campaign.coupon_lifetime > 35) and (
-                today == (coupon.expiration_date - timedelta(days=3))):
-            # The static part of the  string must be 79 characters or less.
-            message = (f"Expires in 3 days! Your cashback of {settings.currency}" + 
-                    f"{floor(coupon.discount_value)} to use " + 
-                    f"on {settings.title} expires in " + 
-                    f"{format(coupon.expiration_date.day,'02d')}" +
-                    f".{format(coupon.expiration_date.month,'02d')}. Max " + 
-                    f"discount {coupon.discount_limit_rate}%, not cumulative. " +
-                    f"{coupon.campaign.url}")
-            sending_sms_aws(cellphone, message)
-            # At the end, update the coupon status.
-            coupon.is_activated = True
-            coupon.save()
-    ## TO-DO: to implement a logging registry to this task.
-    return None
+    # Gets all unredeemed, non-expired and not fully activated coupons.
+    # Note: the expiration is evaluated at read time. The scan reads from the
+    # replica (see 'es_mvp/routers.py').
+    with read_replica():
+        non_activated_coupons = Coupon.objects.exclude(
+                store__in=moving_stores()).filter(
+                state__in=(CouponState.PENDING, CouponState.VALID), 
+                expiration_date__gte=today).select_related(
+                'store__storesettings', 'customer', 'campaign')
+        due = []
+        for coupon in non_activated_coupons:
+            step = activation_step(coupon, today)
+            if step is not None:
+                due.append((coupon, step))
+    # Merges the messages of each customer and applies the daily caps.
+    # Note: the task can run again in the same day (the customers with a 
+    # queued message are skipped).
+    notifications = plan_notifications(due, today)
+    report = sms_cost_report(notification.message 
+            for notification in notifications)
+    logger.info("Coupon activation: %(messages)s messages, %(segments)s "
+            "segments (%(GSM-7)s GSM-7, %(UCS-2)s UCS-2), projected cost "
+            "%(cost).4f.", report)
+    with transaction.atomic(using=store_db()):
+        Notification.objects.bulk_create(schedule_notifications(
+                notifications))
+    return report
+
+# Runs every minute.
+@register('* * * * *')
+@per_shard
+def notification_delivery_task():
+    """
+    Drain the notification queue: sends the messages whose delivery slot is 
+    due, at a flat rate (see 'NOTIFICATION_DELIVERY_RATE' in the app 
+    settings.py).
+    """
+    sent = deliver_notifications()
+    if sent:
+        logger.info("Notification delivery: %s messages sent.", sent)
+    return sent
+
+# Runs every sunday, 4:00AM.
+@register('0 4 * * 0')
+@per_shard
+def archival_task():
+    """
+    Move redeemed/expired coupons and the sales older than the archive horizon
+    (see 'ARCHIVE_HORIZON_DAYS' in the app settings.py) to the archive tables.
+    Each store is archived in its own transaction. Returns the number of 
+    archived sales and coupons (a tuple).
+    """
+    moving = moving_stores()
+    # Only the settled expired coupons are archived.
+    Coupon.objects.exclude(store__in=moving).settle_expired()
+    archived_sales = archived_coupons = 0
+    for store_settings in StoreSettings.objects.exclude(store__in=moving):
+        sales, coupons = archive_store(store_settings.store_id)
+        archived_sales += sales
+        archived_coupons += coupons
+    if archived_sales or archived_coupons:
+        logger.info("Archival: %s sales and %s coupons archived.", 
+                archived_sales, archived_coupons)
+    return archived_sales, archived_coupons
+
+# Runs every hour, at minute 30.
+@register('30 * * * *')
+@per_shard
+def idempotency_key_expiration_task():
+    """
+    Delete the sale idempotency keys older than their TTL (see 
+    'SALE_IDEMPOTENCY_KEY_TTL' in the app settings.py).
+    """
+    deleted, _ = SaleIdempotencyKey.objects.exclude(
+            store__in=moving_stores()).filter(date_added__lt=(
+            timezone.now() - timedelta(
+            hours=settings.SALE_IDEMPOTENCY_KEY_TTL))).delete()
+    return deleted
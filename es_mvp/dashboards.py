@@ -0,0 +1,157 @@
+"""
+Implement the summaries of the dashboards (the home and campaign pages).
+"""
+from django.db import connections, router
+from django.db.models import Sum
+from asgiref.sync import sync_to_async
+from .models import (Sale, Coupon, ArchiveRollup, CouponState, 
+        VALIDATED_STATES)
+import asyncio
+import logging
+
+### Summaries
+#
+# A summary is made of independent queries, given as a dict of callables (see
+# 'store_summary_queries()' and 'campaign_summary_queries()'). The sync views
+# run them one after another. The async views (for the ASGI deployment) run
+# them concurrently, each in its own thread and database connection, so the
+# page latency tracks the slowest query rather than the sum (see
+# 'gather_queries()').
+# Note: the async ORM of Django runs every query in the same thread, one after
+# another, thus it is not used here.
+# A query that misses the 'DASHBOARD_QUERY_TIMEOUT' leaves its totals out: the
+# summary is partial (and it is not cached). On PostgreSQL, the query is also
+# cancelled by the database (its 'statement_timeout'), so its thread is 
+# released.
+#
+###
+
+logger = logging.getLogger(__name__)
+
+
+def store_summary_queries(store):
+    """Return the queries of a store summary."""
+    coupons = Coupon.objects.filter(store=store)
+    return {
+        # Summarizes only incentived sales.
+        'cumulative_sales' : lambda: Sale.objects.filter(store=store).exclude(
+                redeemed_coupon=None).aggregate(total=Sum('final_value',
+                default=0.00))['total'],
+        # Summarizes the cashback given.
+        'cumulative_cashback' : lambda: coupons.filter(
+                state=CouponState.REDEEMED).aggregate(total=Sum(
+                'discount_value', default=0.00))['total'],
+        'redeemed_coupons' : lambda: coupons.filter(
+                state=CouponState.REDEEMED).count(),
+        'issued_coupons' : lambda: coupons.filter(
+                state__in=VALIDATED_STATES).count(),
+        'expired_coupons' : lambda: coupons.expired().count(),
+        # Summarizes the archived rows.
+        'archived' : lambda: ArchiveRollup.objects.filter(
+                store=store).aggregate(
+                cumulative_sales=Sum('cumulative_sales', default=0.00),
+                cumulative_cashback=Sum('cumulative_cashback', default=0.00),
+                redeemed_coupons=Sum('redeemed_coupons', default=0),
+                issued_coupons=Sum('issued_coupons', default=0),
+                expired_coupons=Sum('expired_coupons', default=0)),
+        }
+
+
+def campaign_summary_queries(campaign):
+    """Return the queries of a campaign summary."""
+    redeemed_coupons = Coupon.objects.filter(campaign=campaign.id,
+            state=CouponState.REDEEMED)
+    return {
+        # Summarizes only incentived sales (the sales that redeemed a campaign
+        # coupon).
+        'cumulative_sales' : lambda: Sale.objects.filter(
+                store=campaign.store_id,
+                redeemed_coupon__in=redeemed_coupons).aggregate(total=Sum(
+                'final_value', default=0.00))['total'],
+        # Summarizes the cashback given.
+        'cumulative_cashback' : lambda: redeemed_coupons.aggregate(total=Sum(
+                'discount_value', default=0.00))['total'],
+        'redeemed_coupons' : lambda: redeemed_coupons.count(),
+        'issued_coupons' : lambda: Coupon.objects.filter(campaign=campaign.id,
+                state__in=VALIDATED_STATES).count(),
+        'expired_coupons' : lambda: Coupon.objects.filter(
+                campaign=campaign.id).expired().count(),
+        # Gets the totals of the archived rows (if any).
+        'archived' : lambda: ArchiveRollup.objects.filter(
+                campaign=campaign.id).values('cumulative_sales',
+                'cumulative_cashback', 'redeemed_coupons', 'issued_coupons',
+                'expired_coupons').first() or {},
+        }
+
+
+def build_summary(results):
+    """
+    Build a summary from the query results (see 'run_queries()'). The totals
+    of a missing result are None, and the summary is flagged as partial.
+    """
+    archived = results.get('archived')
+    totals = {'is_partial' : None in results.values()}
+    for name in ('cumulative_sales', 'cumulative_cashback', 'redeemed_coupons',
+            'issued_coupons', 'expired_coupons'):
+        if (results.get(name) is None) or (archived is None):
+            totals[name] = None
+        else:
+            totals[name] = results[name] + archived.get(name, 0)
+    try:
+        # Handles zero division (and the missing totals).
+        totals['conversion_rate'] = (totals['redeemed_coupons'] /
+                totals['issued_coupons'])
+    except:
+        totals['conversion_rate'] = None
+    return totals
+
+
+def run_queries(queries):
+    """Run the summary queries, one after another. Returns a dict."""
+    return {name : query() for name, query in queries.items()}
+
+
+def run_in_thread(query, timeout=None):
+    """
+    Run a query in a worker thread. On PostgreSQL, the database cancels the 
+    query at the timeout (in seconds). The database connections of the thread
+    are closed at the end.
+    """
+    try:
+        if timeout is not None:
+            # Note: the summary queries read store rows, routed as a coupon.
+            connection = connections[router.db_for_read(Coupon)]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SET statement_timeout = %s", 
+                            [max(1, round(timeout * 1000))])
+        return query()
+    finally:
+        connections.close_all()
+
+
+async def gather_queries(queries, timeout=None):
+    """
+    Run the summary queries concurrently. A query that misses the timeout (in
+    seconds) gets a None result. Returns a dict.
+    """
+    tasks = {name : asyncio.ensure_future(sync_to_async(run_in_thread,
+            thread_sensitive=False)(query, timeout)) 
+            for name, query in queries.items()}
+    done, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+    results = {}
+    for name, task in tasks.items():
+        if task in pending:
+            # Note: the thread is not interrupted, its result is just 
+            # discarded (the database cancels the query, see 
+            # 'run_in_thread()').
+            task.cancel()
+            logger.warning("Dashboard query %s timed out.", name)
+            results[name] = None
+        elif task.exception() is not None:
+            logger.error("Dashboard query %s failed.", name,
+                    exc_info=task.exception())
+            results[name] = None
+        else:
+            results[name] = task.result()
+    return results
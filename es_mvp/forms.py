@@ -22,8 +22,11 @@ class SaleForm(forms.ModelForm):
             required=False,
             label=("First time registered customer." + 
                     " It is necessary to validate the customer's cell phone!"))
-    # A hidden field to supports the 'new sale' function flow.
-    ns_control_flag = forms.BooleanField(widget=forms.HiddenInput())
+    # The idempotency key of the registration, generated on the blank form. A
+    # resubmitted registration gets the original outcome (see 'new_sale()' in
+    # 'es_mvp/views.py').
+    idempotency_key = forms.CharField(max_length=64, required=False,
+            widget=forms.HiddenInput())
 
     class Meta:
         model = Sale
@@ -88,6 +91,9 @@ class StoreSettingsForm(forms.ModelForm):
                 'bonus_rate',
                 'discount_limit_rate',
                 'coupon_lifetime',
+                'timezone',
+                'delivery_window_start',
+                'delivery_window_end',
                 ]
         labels = {
                 'title' : 'Store name',
@@ -99,5 +105,8 @@ class StoreSettingsForm(forms.ModelForm):
                 'discount_limit_rate' : 'Standard maximum discount (on %)',
                 'coupon_lifetime' : 
                     'Standard coupon expiration (in days from issuance)',
+                'timezone' : 'Timezone (ex. America/Sao_Paulo)',
+                'delivery_window_start' : 'Send SMS messages from (hh:mm)',
+                'delivery_window_end' : 'Send SMS messages until (hh:mm)',
                 }
                 
@@ -0,0 +1,74 @@
+"""
+Implement the versioned template fragment caching of the store pages.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
+from django.db.models import F
+from .models import StoreDataVersion
+from .sharding import store_db
+from datetime import date
+
+### Fragment caching
+#
+# The costly fragments of the store pages (the summaries and the paginated
+# lists) are cached with the '{% cache %}' template tag, keyed on the store,
+# the store data version and the current day (the coupon expiration is
+# evaluated at read time, so the totals can change at midnight).
+# Any change of the store data (a new sale, a redemption, a campaign edit or a
+# cron task) bumps the store data version, after its transaction commits. Thus
+# a store never sees a stale fragment after it acts, and the unused fragments
+# just expire from the cache. The data versions are kept in the database (see
+# 'StoreDataVersion'), so a bump reaches every app process, even with a 
+# per-process fragment cache (each process just keeps its own fragments).
+# Note: the views pass the fragment data as lazy objects (see
+# 'SimpleLazyObject'), so a cached fragment skips its queries too.
+#
+###
+
+
+def data_version(store_id):
+    """
+    Return the current data version of a store, read from the primary 
+    database of its shard (a single-row read).
+    """
+    return StoreDataVersion.objects.using(store_db()).filter(
+            store=store_id).values_list('version', flat=True).first() or 0
+
+
+def bump_data_version(*store_ids):
+    """
+    Bump the data version of some stores, when the current transaction commits
+    (or immediately, out of a transaction).
+    """
+    using = store_db()
+    def bump():
+        with transaction.atomic(using=using):
+            versions = StoreDataVersion.objects.using(using)
+            bumped = set(versions.filter(store__in=store_ids).values_list(
+                    'store', flat=True))
+            for store_id in set(store_ids) - bumped:
+                # A new counter. Note: a concurrent bump may create it first.
+                versions.get_or_create(store_id=store_id)
+            versions.filter(store__in=store_ids).update(
+                    version=F('version') + 1)
+    transaction.on_commit(bump, using=using)
+
+
+def fragment_context(store_id):
+    """Return the template context to key the cached fragments of a store."""
+    return {
+        'data_version' : f"{data_version(store_id)}.{date.today().toordinal()}",
+        'fragment_cache' : settings.FRAGMENT_CACHE,
+        'fragment_timeout' : settings.FRAGMENT_CACHE_TIMEOUT,
+        }
+
+
+def is_fragment_cached(context, fragment_name, *vary_on):
+    """
+    Check if a fragment is cached, given its '{% cache %}' name and vary-on
+    values (ex. for an async view to skip its queries).
+    """
+    return caches[context['fragment_cache']].has_key(
+            make_template_fragment_key(fragment_name, vary_on))
@@ -0,0 +1,75 @@
+"""
+Implement the cursor based tail of the coupon event ledger.
+"""
+from django.conf import settings
+from .models import CouponEvent, CouponEventType
+from .sharding import use_shard
+
+### Coupon event ledger tail
+#
+# The downstream consumers (analytics, exports) read the new coupon events 
+# incrementally, instead of rescanning the coupons. A cursor is an opaque 
+# string with the position of the last event read from each shard, its 
+# transaction id and its event id (ex. 'default:0:120,shard1:7731:45'). A 
+# consumer keeps the cursor returned by 'tail_events()' and passes it to the 
+# next read. The events of each shard are read in the order of their 
+# transactions, once no older transaction is in flight (see 
+# 'CouponEventQuerySet.tail()' in 'es_mvp/models.py'), so a cursor never 
+# passes an event yet to be committed. A cursor of the event ids only (ex. 
+# 'default:120') reads on from the events recorded before the transaction 
+# ids.
+# Note: a store move copies its events to the target shard keeping their ids
+# and the transaction ids of the source shard, thus a consumer may read them
+# again, or skip them (the event ids are unique across the shards). The moves
+# should wait for the consumers to catch up.
+#
+###
+
+
+def parse_cursor(cursor):
+    """
+    Parse a ledger cursor, as a dict of the last (transaction id, event id) 
+    by shard alias. Raises 'ValueError' on an invalid cursor.
+    """
+    positions = {}
+    for position in filter(None, (cursor or '').split(',')):
+        alias, *position = position.split(':')
+        if alias not in settings.SHARD_DATABASES:
+            raise ValueError(f"Unknown shard: {alias}")
+        if len(position) == 1:
+            # An event id only: the events recorded before the transaction 
+            # ids have none (0).
+            position = [0, *position]
+        xid, event_id = map(int, position)
+        positions[alias] = (xid, event_id)
+    return positions
+
+
+def format_cursor(positions):
+    """Format a ledger cursor (see 'parse_cursor()')."""
+    return ','.join(f"{alias}:{xid}:{event_id}" 
+            for alias, (xid, event_id) in positions.items())
+
+
+def tail_events(cursor=None, limit=None):
+    """
+    Read the coupon events after a cursor (None reads from the start), up to 
+    'limit' events (see 'COUPON_EVENT_TAIL_LIMIT' in the app settings.py). 
+    Returns a tuple (events, next cursor). The events are dicts, in 
+    transaction order within each shard.
+    """
+    if limit is None:
+        limit = settings.COUPON_EVENT_TAIL_LIMIT
+    positions = parse_cursor(cursor)
+    events = []
+    for alias in settings.SHARD_DATABASES:
+        if len(events) >= limit:
+            break
+        with use_shard(alias):
+            for event in CouponEvent.objects.tail(positions.get(alias, 
+                    (0, 0)), limit - len(events)).values('id', 'coupon', 
+                    'store', 'event', 'date_added', 'xid'):
+                positions[alias] = (event.pop('xid'), event['id'])
+                event['event'] = CouponEventType(event['event']).name.lower()
+                events.append(event)
+    return events, format_cursor(positions)
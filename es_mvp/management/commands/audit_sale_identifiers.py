@@ -0,0 +1,77 @@
+"""
+Audit the store sales for duplicated POS identifiers (see
+'SALE_IDENTIFIER_POLICY' in the app settings.py).
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Exists, Min, Max, OuterRef, Q
+from es_mvp.models import Sale, ArchivedSale
+from es_mvp.routers import read_replica
+from es_mvp.sharding import use_shard
+
+
+def identifier_groups(model, coupon, other, store=None):
+    """
+    Return the sales of a model grouped by store and POS identifier: the
+    groups of many sales, or with sales of the 'other' model (live or
+    archived). A single grouped scan (see the identifier index of the models).
+    """
+    sales = model.objects.exclude(identifier='')
+    if store:
+        sales = sales.filter(store=store)
+    return sales.values('store', 'identifier').annotate(
+            sales=Count('id', distinct=True),
+            coupons=Count(coupon, distinct=True),
+            first_sale=Min('id'), last_sale=Max('id'),
+            first_date=Min('date'), last_date=Max('date'),
+            other=Exists(other.objects.filter(store=OuterRef('store'), 
+            identifier=OuterRef('identifier')))).filter(
+            Q(sales__gt=1) | Q(other=True))
+
+
+def merge_group(duplicates, group):
+    """Add a group to the duplicates, by store and POS identifier."""
+    key = (group['store'], group['identifier'])
+    if key not in duplicates:
+        duplicates[key] = group
+        return
+    duplicate = duplicates[key]
+    for field in ('sales', 'coupons'):
+        duplicate[field] += group[field]
+    for field in ('first_sale', 'first_date'):
+        duplicate[field] = min(duplicate[field], group[field])
+    for field in ('last_sale', 'last_date'):
+        duplicate[field] = max(duplicate[field], group[field])
+
+
+class Command(BaseCommand):
+    help = ("Find the POS sale identifiers registered more than once by a "
+            "store, live or archived sales.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store', type=int,
+                help="Audit a single store (user id).")
+
+    def handle(self, *args, **options):
+        groups = 0
+        for alias in settings.SHARD_DATABASES:
+            with use_shard(alias), read_replica():
+                duplicates = {}
+                for group in identifier_groups(Sale, 'coupon', ArchivedSale,
+                        options['store']):
+                    merge_group(duplicates, group)
+                for group in identifier_groups(ArchivedSale, 
+                        'archivedcoupon', Sale, options['store']):
+                    merge_group(duplicates, group)
+                for (store, identifier), duplicate in sorted(
+                        duplicates.items()):
+                    groups += 1
+                    self.stdout.write(f"Store {store} -- "
+                            f"ID {identifier}: "
+                            f"{duplicate['sales']} sales "
+                            f"({duplicate['first_sale']} to "
+                            f"{duplicate['last_sale']}, "
+                            f"{duplicate['first_date']} to "
+                            f"{duplicate['last_date']}), "
+                            f"{duplicate['coupons']} coupons issued")
+        self.stdout.write(f"{groups} duplicated sale IDs.")
@@ -0,0 +1,59 @@
+"""
+Import the SMS delivery receipts exported by the provider (see 
+'es_mvp/receipts.py').
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from es_mvp.receipts import import_receipts, delivery_rates
+from es_mvp.routers import read_replica
+from es_mvp.sharding import use_shard
+from datetime import timedelta
+import gzip
+import sys
+
+
+class Command(BaseCommand):
+    help = "Import the SMS delivery receipts (JSON lines files)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='*', metavar='FILE',
+                help="The receipt files, plain or gzipped ('-' reads the "
+                "standard input).")
+        parser.add_argument('--batch-size', type=int,
+                help="Receipts updated per bulk query (default: "
+                "DELIVERY_RECEIPT_BATCH_SIZE).")
+        parser.add_argument('--rates', type=int, metavar='DAYS',
+                help="Show the delivery rates of the last DAYS days, by "
+                "store and campaign.")
+
+    def handle(self, *args, **options):
+        for path in options['files']:
+            try:
+                if path == '-':
+                    counts = import_receipts(sys.stdin, 
+                            options['batch_size'])
+                else:
+                    opener = gzip.open if path.endswith('.gz') else open
+                    with opener(path, 'rt', encoding='utf-8') as lines:
+                        counts = import_receipts(lines, options['batch_size'])
+            except OSError as error:
+                raise CommandError(f"Can not read {path}: {error}")
+            self.stdout.write(f"{path}: {counts['receipts']} receipts, "
+                    f"{counts['updated']} notifications updated, "
+                    f"{counts['invalid']} invalid, "
+                    f"{counts['suppressed']} cellphones suppressed")
+        if options['rates'] is not None:
+            since = timezone.now() - timedelta(days=options['rates'])
+            for alias in settings.SHARD_DATABASES:
+                with use_shard(alias), read_replica():
+                    for rate in delivery_rates(since=since):
+                        delivery_rate = ('-' if rate['delivery_rate'] is None
+                                else f"{rate['delivery_rate']:.1%}")
+                        self.stdout.write(f"Store {rate['store']} -- "
+                                f"Campaign {rate['campaign'] or 'digest'}: "
+                                f"{rate['sent']} sent, "
+                                f"{rate['delivered']} delivered, "
+                                f"{rate['failed']} failed, "
+                                f"{rate['pending']} pending "
+                                f"({delivery_rate})")
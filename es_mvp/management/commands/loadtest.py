@@ -0,0 +1,257 @@
+"""
+Load test the 'new sale' pipeline with simulated POS counter traffic.
+"""
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from es_mvp.models import (Customer, CustomerProfile, Sale, Campaign, Coupon,
+        CouponState, StoreSettings, Notification, CouponEvent, 
+        CouponEventType)
+from es_mvp.views import initial_store_settings
+from es_mvp.sharding import store_db, use_store
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from unittest import mock
+import logging
+import random
+import secrets
+import threading
+import time
+
+### Load test
+#
+# Replays checkout flows against the 'new sale' pipeline (see 'new_sale()' in
+# 'es_mvp/views.py') with the Django test client, through the full middleware
+# stack (sessions, CSRF and authentication), at rising concurrency levels. The
+# SMS sending is stubbed out. The flows are:
+#
+#   new: a new customer (lookup, cellphone validation and registration).
+#   returning: a returning customer without applicable coupons (a single POST).
+#   redeem: a returning customer that redeems a coupon (lookup and redemption).
+#
+# The test runs over a throwaway store, removed at the end (unless '--keep').
+# Important: it writes to the configured database. Do not run it against the
+# production database.
+#
+###
+
+FLOWS = ('new', 'returning', 'redeem')
+
+
+def percentile(values, rate):
+    """Return the percentile of a list of values (nearest rank)."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(rate * len(values)))]
+
+
+def is_lock_error(error):
+    """Check if a database error is due to lock contention."""
+    message = str(error).lower()
+    return any(sign in message for sign in ('locked', 'deadlock',
+            'could not obtain lock', 'could not serialize'))
+
+
+class Command(BaseCommand):
+    help = "Load test the 'new sale' pipeline with simulated checkouts."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', default='1,2,4,8',
+                help="Comma separated concurrency levels (default: 1,2,4,8).")
+        parser.add_argument('--checkouts', type=int, default=200,
+                help="Checkouts per concurrency level (default: 200).")
+        parser.add_argument('--mix', default='new=0.2,returning=0.5,redeem=0.3',
+                help="Flow weights (default: new=0.2,returning=0.5,redeem=0.3).")
+        parser.add_argument('--seed', type=int, default=None,
+                help="Random seed, to replay the same traffic.")
+        parser.add_argument('--keep', action='store_true',
+                help="Keep the load test store and its data.")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',')]
+            mix = {flow : float(weight) for flow, weight in (item.split('=')
+                    for item in options['mix'].split(','))}
+        except ValueError:
+            raise CommandError("Invalid '--concurrency' or '--mix' value.")
+        if set(mix) - set(FLOWS):
+            raise CommandError(f"Unknown flows: {set(mix) - set(FLOWS)}")
+        self.random = random.Random(options['seed'])
+        self.lock = threading.Lock()
+        checkouts = options['checkouts']
+        store = self.create_store()
+        # Each seeded customer checks out once (the redeem customers hold a 
+        # valid coupon).
+        self.returning = self.seed_customers(store, checkouts * len(levels), 
+                coupons=False)
+        self.redeeming = self.seed_customers(store, checkouts * len(levels), 
+                coupons=True)
+        self.stdout.write(f"Store: {store.username} -- "
+                f"database: {connection.vendor} -- checkouts per level: "
+                f"{checkouts} -- mix: {mix}")
+        self.stdout.write("level  checkouts/s  requests/s  p50 ms  p90 ms  "
+                "p99 ms  max ms  errors  lock errors  flagged")
+        # The failed requests are counted, not logged.
+        request_logger = logging.getLogger('django.request')
+        request_logger_level = request_logger.level
+        request_logger.setLevel(logging.CRITICAL)
+        try:
+            with mock.patch('es_mvp.views.sending_sms_aws'), override_settings(
+                    ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']):
+                for level in levels:
+                    flows = self.random.choices(list(mix),
+                            weights=list(mix.values()), k=checkouts)
+                    self.report(level, self.run_level(store, level, flows))
+        finally:
+            request_logger.setLevel(request_logger_level)
+            if not options['keep']:
+                self.remove_store(store)
+
+    def create_store(self):
+        """Create a throwaway store, with its settings and a campaign."""
+        store = User.objects.create_user(
+                username=f"loadtest-{secrets.token_hex(4)}",
+                password=secrets.token_urlsafe(16))
+        initial_store_settings(store.id)
+        with use_store(store.id):
+            Campaign.objects.create(store=store, title='Load test',
+                    min_sale_value=0.0, max_sale_value=100000.0, 
+                    bonus_rate=20, discount_limit_rate=30, coupon_lifetime=45)
+        return store
+
+    def seed_customers(self, store, count, coupons):
+        """
+        Create returning customers in bulk, optionally with a valid coupon each.
+        Returns a list of cellphone numbers.
+        """
+        # Note: the store rows live in the store shard.
+        with use_store(store.id):
+            cellphones = [f"5511{self.random.randrange(10**9):09d}"
+                    for index in range(count)]
+            customers = Customer.objects.bulk_create(Customer(store=store,
+                    cellphone=cellphone, is_verified=True)
+                    for cellphone in cellphones)
+            if coupons:
+                sales = Sale.objects.bulk_create(Sale(store=store,
+                        customer=customer, initial_value=100.0,
+                        effective_discount=0.0, final_value=100.0,
+                        is_evaluated=True, date=date.today())
+                        for customer in customers)
+                campaign = Campaign.objects.filter(store=store).first()
+                issued = Coupon.objects.bulk_create(Coupon(store=store,
+                        sale=sale, campaign=campaign,
+                        customer_id=sale.customer_id,
+                        identifier=secrets.token_hex(3).upper(),
+                        discount_value=20.0, discount_limit_rate=30,
+                        expiration_date=date.today() + timedelta(days=30),
+                        state=CouponState.VALID) for sale in sales)
+                for event in (CouponEventType.ISSUED, 
+                        CouponEventType.VALIDATED):
+                    CouponEvent.objects.record(event, [(coupon.id, store.id)
+                            for coupon in issued])
+        return cellphones
+
+    def next_customer(self, flow):
+        """Take a customer cellphone for a checkout flow."""
+        with self.lock:
+            if flow == 'new':
+                return f"5599{self.random.randrange(10**9):09d}"
+            elif flow == 'returning':
+                return self.returning.pop()
+            return self.redeeming.pop()
+
+    def run_level(self, store, level, flows):
+        """Run the checkouts of a concurrency level. Returns the results."""
+        results = {'latencies' : [], 'requests' : 0, 'errors' : 0,
+                'lock_errors' : 0, 'flagged' : 0}
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as executor:
+            for outcome in executor.map(lambda flow: self.checkout(store,
+                    flow), flows):
+                latency, requests, error, flagged = outcome
+                results['requests'] += requests
+                results['flagged'] += flagged
+                if error is None:
+                    results['latencies'].append(latency)
+                else:
+                    results['errors'] += 1
+                    results['lock_errors'] += is_lock_error(error)
+        results['duration'] = time.perf_counter() - started
+        return results
+
+    def checkout(self, store, flow):
+        """
+        Run a checkout flow, as a POS client. Returns a tuple (latency in ms,
+        requests, error or None, flagged).
+        """
+        client = Client(enforce_csrf_checks=True,
+                HTTP_ACCEPT='application/json')
+        client.force_login(store)
+        cellphone = self.next_customer(flow)
+        data = {
+            'customer_country_code' : cellphone[:2],
+            'customer_long_distance_code' : cellphone[2:4],
+            'customer_cellphone' : cellphone[4:],
+            'initial_value' : f"{self.random.uniform(20, 500):.2f}",
+            'date' : date.today().isoformat(),
+            'identifier' : '',
+            }
+        url = reverse('es_mvp:new_sale')
+        requests = 0
+        started = time.perf_counter()
+        try:
+            # The 'new sale' page starts the pipeline and sets the CSRF cookie.
+            client.get(url, HTTP_ACCEPT='text/html')
+            data['csrfmiddlewaretoken'] = client.cookies['csrftoken'].value
+            requests += 1
+            response = client.post(url, data).json()
+            requests += 1
+            if response['step'] == 'verify':
+                data['customer_verified'] = 'on'
+                response = client.post(url, data).json()
+                requests += 1
+            elif response['step'] == 'redeem':
+                data['redeemed_coupon'] = response['coupon_choices'][0][0]
+                response = client.post(url, data).json()
+                requests += 1
+            if response['step'] != 'done':
+                raise ValueError(f"Unexpected step: {response}")
+        except Exception as error:
+            # Note: the test client raises the view exceptions.
+            return None, requests, error, False
+        finally:
+            connections.close_all()
+        latency = (time.perf_counter() - started) * 1000
+        return latency, requests, None, response.get('is_flagged', False)
+
+    def report(self, level, results):
+        """Write the results of a concurrency level."""
+        latencies = results['latencies']
+        self.stdout.write(f"{level:5d}  "
+                f"{len(latencies) / results['duration']:11.1f}  "
+                f"{results['requests'] / results['duration']:10.1f}  "
+                f"{percentile(latencies, 0.50):6.1f}  "
+                f"{percentile(latencies, 0.90):6.1f}  "
+                f"{percentile(latencies, 0.99):6.1f}  "
+                f"{max(latencies, default=0.0):6.1f}  "
+                f"{results['errors']:6d}  {results['lock_errors']:11d}  "
+                f"{results['flagged']:7d}")
+
+    def remove_store(self, store):
+        """Remove the load test store and all its data."""
+        with use_store(store.id), transaction.atomic(using=store_db()):
+            Notification.objects.filter(store=store).delete()
+            CouponEvent.objects.filter(store=store).delete()
+            CustomerProfile.objects.filter(store=store).delete()
+            Sale.objects.filter(store=store).update(redeemed_coupon=None)
+            Coupon.objects.filter(store=store).delete()
+            Sale.objects.filter(store=store).delete()
+            Customer.objects.filter(store=store).delete()
+            Campaign.objects.filter(store=store).delete()
+            StoreSettings.objects.filter(store=store).delete()
+            store.delete()
@@ -0,0 +1,54 @@
+"""
+Manage the store shards (see 'es_mvp/sharding.py').
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from es_mvp.models import StoreShard
+from es_mvp import sharding
+
+
+class Command(BaseCommand):
+    help = "Show the store shards, prepare a new shard or move a store."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', action='store_true',
+                help="Show the number of stores of each shard.")
+        parser.add_argument('--init-sequences', metavar='SHARD',
+                help="Start the id sequences of a new (migrated) shard.")
+        parser.add_argument('--move', type=int, metavar='STORE',
+                help="Move a store (user id) to the '--to' shard.")
+        parser.add_argument('--to', metavar='SHARD',
+                help="The target shard of '--move'.")
+        parser.add_argument('--grace', type=float,
+                help="Seconds to wait for the requests in flight of a moving "
+                "store.")
+
+    def handle(self, *args, **options):
+        if options['status']:
+            stores = dict(StoreShard.objects.values_list('shard').annotate(
+                    Count('store')))
+            for alias in settings.SHARD_DATABASES:
+                self.stdout.write(f"{alias}: {stores.pop(alias, 0)} stores")
+            for alias, count in stores.items():
+                self.stdout.write(f"{alias} (unknown): {count} stores")
+        elif options['init_sequences']:
+            if options['init_sequences'] not in settings.SHARD_DATABASES:
+                raise CommandError(f"Unknown shard: {options['init_sequences']}")
+            sharding.init_sequences(options['init_sequences'])
+            self.stdout.write(f"{options['init_sequences']}: sequences set.")
+        elif options['move']:
+            if options['to'] not in settings.SHARD_DATABASES:
+                raise CommandError(f"Unknown shard: {options['to']}")
+            copied = sharding.move_store(options['move'], options['to'],
+                    options['grace'])
+            if not copied:
+                self.stdout.write(f"Store {options['move']} is already in "
+                        f"{options['to']}.")
+                return
+            self.stdout.write(f"Store {options['move']} moved to "
+                    f"{options['to']}: " + ", ".join(f"{count} {name}"
+                    for name, count in copied.items() if count))
+        else:
+            raise CommandError("Use '--status', '--init-sequences' or "
+                    "'--move' (see '--help').")
@@ -0,0 +1,47 @@
+"""
+Rebuild the denormalized customer profiles (see 'es_mvp/wallet.py').
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from es_mvp.models import Customer
+from es_mvp.wallet import rebuild_profiles
+from es_mvp.sharding import per_shard, store_db, use_store, moving_stores
+
+
+class Command(BaseCommand):
+    help = "Rebuild the customer profiles from the sales and coupons."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--store', type=int,
+                help="Only rebuild the customers of a store (user id).")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                help="Number of customers rebuilt per transaction.")
+
+    def handle(self, *args, **options):
+        if options['store'] in moving_stores():
+            raise CommandError(f"Store {options['store']} is moving between "
+                    "shards.")
+        if options['store']:
+            with use_store(options['store']):
+                rebuilt = self.rebuild(options['store'], 
+                        options['batch_size'])
+        else:
+            # Note: the shards are rebuilt one at a time.
+            rebuilt = sum(per_shard(self.rebuild)(None,
+                    options['batch_size']).values())
+        self.stdout.write(f"{rebuilt} customer profiles rebuilt.")
+
+    def rebuild(self, store, batch_size):
+        """Rebuild the profiles, in batches. Returns the number rebuilt."""
+        # Note: the stores moving between shards are skipped.
+        customers = Customer.objects.exclude(
+                store__in=moving_stores()).order_by('id')
+        if store:
+            customers = customers.filter(store=store)
+        customer_ids = list(customers.values_list('id', flat=True))
+        rebuilt = 0
+        for start in range(0, len(customer_ids), batch_size):
+            with transaction.atomic(using=store_db()):
+                rebuilt += rebuild_profiles(
+                        customer_ids[start:start + batch_size])
+        return rebuilt
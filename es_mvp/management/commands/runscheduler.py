@@ -0,0 +1,41 @@
+"""
+Run the app scheduler service (see 'es_mvp/scheduler.py').
+"""
+from django.core.management.base import BaseCommand, CommandError
+from es_mvp.models import ScheduledTask
+from es_mvp import scheduler
+
+
+class Command(BaseCommand):
+    help = "Run the scheduler service, or show the run state of the tasks."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', action='store_true',
+                help="Show the registered tasks and their run state.")
+        parser.add_argument('--run', metavar='TASK',
+                help="Run a single task now.")
+        parser.add_argument('--interval', type=int,
+                help="The scheduler tick, in seconds.")
+
+    def handle(self, *args, **options):
+        tasks = scheduler.discover_tasks()
+        if options['status']:
+            states = {task.name : task 
+                    for task in ScheduledTask.objects.all()}
+            for name, (schedule, function) in tasks.items():
+                state = states.get(name)
+                if state is None:
+                    self.stdout.write(f"{name} ({schedule}): never run")
+                    continue
+                self.stdout.write(f"{name} ({schedule}): "
+                        f"{state.last_status or 'pending'} -- "
+                        f"last slot {state.last_slot} -- "
+                        f"last run {state.last_started} to "
+                        f"{state.last_finished} on {state.node} -- "
+                        f"{state.runs} runs")
+        elif options['run']:
+            if options['run'] not in tasks:
+                raise CommandError(f"Unknown task: {options['run']}")
+            scheduler.run_task(options['run'])
+        else:
+            scheduler.run_forever(options['interval'])
@@ -0,0 +1,104 @@
+"""
+Measure the start time of the app processes (the web workers and the
+scheduled task runs).
+"""
+from django.core.management.base import BaseCommand, CommandError
+import os
+import subprocess
+import sys
+import time
+
+### Startup benchmark
+#
+# Each target starts a fresh Python process with 'python -X importtime', which
+# boots the app as a real process would, and exits. The report shows the wall
+# time of the process, the import time, the slowest top-level imports and the
+# heavy modules loaded at start (these should load on their first use only).
+# The best of '--repeat' runs is reported, to skip the cold disk cache.
+#
+###
+
+# The code of each target process.
+TARGETS = {
+    # A web worker boot: the WSGI application and the URL patterns.
+    'worker' : ("from django.core.wsgi import get_wsgi_application; "
+            "get_wsgi_application(); "
+            "from django.urls import get_resolver; "
+            "get_resolver().url_patterns"),
+    # A scheduled task run ('python manage.py runscheduler --run TASK'), up to
+    # the task itself.
+    'task' : ("import django; django.setup(); "
+            "from django.core.management import load_command_class; "
+            "load_command_class('es_mvp', 'runscheduler'); "
+            "from es_mvp import scheduler; scheduler.discover_tasks()"),
+    }
+# The heavy modules that should not be loaded at start.
+HEAVY_MODULES = ('boto3', 'botocore', 'numpy', 'platformshconfig')
+
+
+def measure(code):
+    """
+    Run a target process once. Returns a dict with the wall time (ms) and the
+    imports, as a list of tuples (module, self time (us), cumulative time (us),
+    depth).
+    """
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+            capture_output=True, text=True, env=os.environ.copy())
+    wall_time = (time.perf_counter() - started) * 1000
+    if process.returncode:
+        raise CommandError(f"The target process failed:\n{process.stderr}")
+    imports = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(self_time), int(cumulative), depth))
+    return {'wall_time' : wall_time, 'imports' : imports}
+
+
+class Command(BaseCommand):
+    help = "Measure the start time of the app processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('targets', nargs='*', metavar='TARGET',
+                help=f"The processes to measure: {', '.join(TARGETS)} "
+                "(default: all).")
+        parser.add_argument('--repeat', type=int, default=3,
+                help="Runs per target (the best one is reported).")
+        parser.add_argument('--top', type=int, default=10,
+                help="Number of slowest top-level imports to show.")
+        parser.add_argument('--max-ms', type=float,
+                help="Fail if a target takes longer (wall time, in ms).")
+
+    def handle(self, *args, **options):
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                'es_mvp_project.settings')
+        for target in options['targets']:
+            if target not in TARGETS:
+                raise CommandError(f"Unknown target: {target}")
+        slow = []
+        for target in options['targets'] or list(TARGETS):
+            run = min((measure(TARGETS[target]) for i in
+                    range(max(1, options['repeat']))),
+                    key=lambda run: run['wall_time'])
+            top_level = [entry for entry in run['imports'] if entry[3] == 0]
+            import_time = sum(entry[2] for entry in top_level) / 1000
+            self.stdout.write(f"{target}: {run['wall_time']:.0f} ms "
+                    f"(imports {import_time:.0f} ms, "
+                    f"{len(run['imports'])} modules)")
+            for name, self_time, cumulative, depth in sorted(top_level,
+                    key=lambda entry: -entry[2])[:options['top']]:
+                self.stdout.write(f"  {cumulative / 1000:8.1f} ms  {name}")
+            heavy = [entry[0] for entry in run['imports']
+                    if entry[0] in HEAVY_MODULES]
+            if heavy:
+                self.stdout.write(self.style.WARNING(f"  heavy modules "
+                        f"loaded at start: {', '.join(heavy)}"))
+            if (options['max_ms'] is not None) and (run['wall_time'] >
+                    options['max_ms']):
+                slow.append(target)
+        if slow:
+            raise CommandError(f"Over {options['max_ms']:.0f} ms: "
+                    f"{', '.join(slow)}")
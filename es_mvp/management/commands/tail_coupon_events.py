@@ -0,0 +1,42 @@
+"""
+Export the new coupon events as JSON lines (see 'es_mvp/ledger.py').
+"""
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from es_mvp.ledger import tail_events
+import json
+import os
+
+
+class Command(BaseCommand):
+    help = ("Write the coupon events after a cursor as JSON lines, and the "
+            "next cursor.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cursor',
+                help="Read the events after this cursor (default: from the "
+                "start).")
+        parser.add_argument('--cursor-file', metavar='PATH',
+                help="Read the cursor from a file, and save the next cursor "
+                "there (an incremental export).")
+        parser.add_argument('--limit', type=int,
+                help="Maximum number of events (default: "
+                "COUPON_EVENT_TAIL_LIMIT).")
+
+    def handle(self, *args, **options):
+        cursor = options['cursor']
+        path = options['cursor_file']
+        if (cursor is None) and path and os.path.exists(path):
+            with open(path) as cursor_file:
+                cursor = cursor_file.read().strip()
+        try:
+            events, cursor = tail_events(cursor, options['limit'])
+        except ValueError as error:
+            raise CommandError(f"Invalid cursor: {error}")
+        for event in events:
+            self.stdout.write(json.dumps(event, cls=DjangoJSONEncoder))
+        # Note: the cursor is saved once the events were written.
+        if path:
+            with open(path, 'w') as cursor_file:
+                cursor_file.write(cursor)
+        self.stderr.write(f"{len(events)} events. Cursor: {cursor}")
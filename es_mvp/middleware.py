@@ -0,0 +1,72 @@
+"""
+Implement the middlewares of the app.
+"""
+from django.conf import settings
+from django.http import HttpResponse
+from django.urls import reverse
+from .routers import routing
+from .sharding import is_sharded, store_shard, use_shard
+
+# The cookie that pins the store session to the primary database.
+PRIMARY_PIN_COOKIE = 'primary_pin'
+# The query parameter (and session key) that selects the shard browsed in the
+# admin site.
+ADMIN_SHARD_KEY = '_shard'
+
+
+class ReplicaPinningMiddleware:
+    """
+    Pin the reads of a store session to the primary database for a while
+    after it writes (read-your-writes), so a replica never shows a stale page
+    to the store that has just acted (see 'es_mvp/routers.py').
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with routing(pinned=PRIMARY_PIN_COOKIE in request.COOKIES) as state:
+            response = self.get_response(request)
+        if state['wrote']:
+            response.set_cookie(PRIMARY_PIN_COOKIE, '1',
+                    max_age=settings.REPLICA_PIN_SECONDS, httponly=True,
+                    samesite='Lax')
+        return response
+
+
+class ShardMiddleware:
+    """
+    Route the store rows of a request to the shard of the current store (see
+    'es_mvp/sharding.py'). The writes of a store that is moving between shards
+    are refused. In the admin site, the browsed shard is selected with the
+    '_shard' query parameter (ex. '/admin/es_mvp/sale/?_shard=shard1').
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not (is_sharded() and request.user.is_authenticated):
+            return self.get_response(request)
+        if request.user.is_staff and request.path.startswith(
+                reverse('admin:index')):
+            if ADMIN_SHARD_KEY in request.GET:
+                request.session[ADMIN_SHARD_KEY] = request.GET[ADMIN_SHARD_KEY]
+                # Note: the admin refuses unknown query parameters.
+                request.GET = request.GET.copy()
+                del request.GET[ADMIN_SHARD_KEY]
+            shard = request.session.get(ADMIN_SHARD_KEY,
+                    settings.SHARD_DATABASES[0])
+            if shard not in settings.SHARD_DATABASES:
+                shard = settings.SHARD_DATABASES[0]
+        else:
+            shard, is_moving = store_shard(request.user.id)
+            if is_moving and (request.method not in ('GET', 'HEAD', 
+                    'OPTIONS')):
+                response = HttpResponse("A loja está em manutenção. Tente "
+                        "novamente em alguns instantes.", status=503)
+                response['Retry-After'] = settings.SHARD_MOVE_GRACE
+                return response
+        with use_shard(shard):
+            return self.get_response(request)
+
@@ -0,0 +1,240 @@
+# Generated by Django 4.2.4 on 2026-10-19 13:31
+
+import datetime
+from django.conf import settings
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+import django.db.models.expressions
+import es_mvp.validators
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedCoupon',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('identifier', models.CharField(max_length=6)),
+                ('discount_value', models.FloatField()),
+                ('discount_limit_rate', models.IntegerField()),
+                ('expiration_date', models.DateField()),
+                ('is_redeemed', models.BooleanField(default=False)),
+                ('is_expired', models.BooleanField(default=False)),
+                ('is_activated', models.BooleanField(default=False)),
+                ('is_valid', models.BooleanField(default=False)),
+                ('date_added', models.DateTimeField()),
+                ('date_archived', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(max_length=60)),
+                ('min_sale_value', models.FloatField(validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('max_sale_value', models.FloatField(validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('url', models.CharField(blank=True, max_length=20, validators=[django.core.validators.URLValidator()])),
+                ('bonus_rate', models.IntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+                ('discount_limit_rate', models.IntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+                ('coupon_lifetime', models.IntegerField(validators=[django.core.validators.MinValueValidator(5)])),
+                ('is_active', models.BooleanField(default=True)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Coupon',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('identifier', models.CharField(max_length=6)),
+                ('discount_value', models.FloatField()),
+                ('discount_limit_rate', models.IntegerField()),
+                ('expiration_date', models.DateField()),
+                ('is_redeemed', models.BooleanField(default=False)),
+                ('is_expired', models.BooleanField(default=False)),
+                ('is_activated', models.BooleanField(default=False)),
+                ('is_valid', models.BooleanField(default=False)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.campaign')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Customer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cellphone', models.CharField(max_length=16)),
+                ('is_verified', models.BooleanField(default=False)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StoreSettings',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('title', models.CharField(blank=True, max_length=25)),
+                ('currency', models.CharField(max_length=3)),
+                ('country_code', models.CharField(max_length=3)),
+                ('long_distance_code', models.CharField(max_length=3)),
+                ('url', models.CharField(blank=True, max_length=20, validators=[django.core.validators.URLValidator()])),
+                ('bonus_rate', models.IntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+                ('discount_limit_rate', models.IntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+                ('coupon_lifetime', models.IntegerField(validators=[django.core.validators.MinValueValidator(5)])),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('store', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'store settings',
+            },
+        ),
+        migrations.CreateModel(
+            name='Sale',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('initial_value', models.FloatField(validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('effective_discount', models.FloatField(validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('final_value', models.FloatField(validators=[django.core.validators.MinValueValidator(0.0)])),
+                ('identifier', models.CharField(blank=True, max_length=12)),
+                ('is_evaluated', models.BooleanField(default=False)),
+                ('date', models.DateField(validators=[es_mvp.validators.validate_sale_date])),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.customer')),
+                ('redeemed_coupon', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='redeemed_coupon', to='es_mvp.coupon')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='customer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.customer'),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='sale',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.sale'),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='store',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='ArchiveRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cumulative_sales', models.FloatField(default=0.0)),
+                ('cumulative_cashback', models.FloatField(default=0.0)),
+                ('redeemed_coupons', models.IntegerField(default=0)),
+                ('issued_coupons', models.IntegerField(default=0)),
+                ('expired_coupons', models.IntegerField(default=0)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('campaign', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.campaign')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedSale',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('initial_value', models.FloatField()),
+                ('effective_discount', models.FloatField()),
+                ('final_value', models.FloatField()),
+                ('identifier', models.CharField(blank=True, max_length=12)),
+                ('is_evaluated', models.BooleanField(default=False)),
+                ('date', models.DateField()),
+                ('date_added', models.DateTimeField()),
+                ('date_archived', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.customer')),
+                ('redeemed_coupon', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='redeemed_coupon', to='es_mvp.archivedcoupon')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='archivedcoupon',
+            name='campaign',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.campaign'),
+        ),
+        migrations.AddField(
+            model_name='archivedcoupon',
+            name='customer',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.customer'),
+        ),
+        migrations.AddField(
+            model_name='archivedcoupon',
+            name='sale',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.archivedsale'),
+        ),
+        migrations.AddField(
+            model_name='archivedcoupon',
+            name='store',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddConstraint(
+            model_name='storesettings',
+            constraint=models.CheckConstraint(check=models.Q(('bonus_rate__gte', 0)), name='store_settings_bonus_rate_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='storesettings',
+            constraint=models.CheckConstraint(check=models.Q(('discount_limit_rate__gte', 0)), name='store_settings_discount_limit_rate_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='storesettings',
+            constraint=models.CheckConstraint(check=models.Q(('coupon_lifetime__gte', 5)), name='store_settings_coupon_lifetime_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='sale',
+            constraint=models.CheckConstraint(check=models.Q(('initial_value__gte', 0.0)), name='sale_initial_value_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='sale',
+            constraint=models.CheckConstraint(check=models.Q(('effective_discount__gte', 0.0)), name='sale_effective_discount_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='sale',
+            constraint=models.CheckConstraint(check=models.Q(('final_value__gte', 0.0)), name='sale_final_value_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='sale',
+            constraint=models.CheckConstraint(check=models.Q(('final_value__exact', django.db.models.expressions.CombinedExpression(models.F('initial_value'), '-', models.F('effective_discount')))), name='sale_final_value_conciliation', violation_error_message='Final value must be equal to the sales value minus the discount applied.'),
+        ),
+        migrations.AddConstraint(
+            model_name='sale',
+            constraint=models.CheckConstraint(check=models.Q(('date__gte', django.db.models.expressions.CombinedExpression(models.F('date_added'), '-', models.Value(datetime.timedelta(days=15))))), name='sale_date_limit_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='sale',
+            constraint=models.CheckConstraint(check=models.Q(('date__lte', django.db.models.expressions.CombinedExpression(models.F('date_added'), '+', models.Value(datetime.timedelta(days=1))))), name='sale_date_limit_max'),
+        ),
+        migrations.AddConstraint(
+            model_name='campaign',
+            constraint=models.CheckConstraint(check=models.Q(('min_sale_value__gte', 0.0)), name='campaign_min_sale_value_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='campaign',
+            constraint=models.CheckConstraint(check=models.Q(('max_sale_value__gte', 0.0)), name='campaign_max_sale_value_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='campaign',
+            constraint=models.CheckConstraint(check=models.Q(('max_sale_value__gte', models.F('min_sale_value'))), name='campaign_max_min_sale_value_test', violation_error_message='Maximum purchase amount must be greater than minimum purchase amount.'),
+        ),
+        migrations.AddConstraint(
+            model_name='campaign',
+            constraint=models.CheckConstraint(check=models.Q(('bonus_rate__gte', 0)), name='campaign_bonus_rate_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='campaign',
+            constraint=models.CheckConstraint(check=models.Q(('discount_limit_rate__gte', 0)), name='campaign_discount_limit_rate_min'),
+        ),
+        migrations.AddConstraint(
+            model_name='campaign',
+            constraint=models.CheckConstraint(check=models.Q(('coupon_lifetime__gte', 5)), name='campaign_coupon_lifetime_min'),
+        ),
+    ]
@@ -0,0 +1,96 @@
+# Generated by Django 4.2.4 on 2026-10-19 13:32
+
+from django.db import migrations, models
+
+
+# Numeric values of 'es_mvp.models.CouponState'.
+PENDING, VALID, ACTIVATED, REDEEMED, EXPIRED = 1, 2, 3, 4, 5
+
+
+def flags_to_state(apps, schema_editor):
+    """
+    Convert the former lifecycle flags to the coupon state. The precedence
+    follows the old coupon status display: redeemed, expired, valid (activated
+    or not) and, at last, pending.
+    """
+    for model_name in ('Coupon', 'ArchivedCoupon'):
+        # Note: writes through the migrated database ('migrate --database').
+        objects = apps.get_model('es_mvp', model_name).objects.using(
+                schema_editor.connection.alias)
+        objects.filter(is_valid=True).update(state=VALID)
+        objects.filter(is_valid=True, is_activated=True).update(
+                state=ACTIVATED)
+        objects.filter(is_expired=True).update(state=EXPIRED)
+        objects.filter(is_redeemed=True).update(state=REDEEMED)
+
+
+def state_to_flags(apps, schema_editor):
+    """Restore the former lifecycle flags from the coupon state."""
+    for model_name in ('Coupon', 'ArchivedCoupon'):
+        objects = apps.get_model('es_mvp', model_name).objects.using(
+                schema_editor.connection.alias)
+        objects.exclude(state=PENDING).update(is_valid=True)
+        objects.filter(state=ACTIVATED).update(is_activated=True)
+        objects.filter(state=EXPIRED).update(is_expired=True)
+        objects.filter(state=REDEEMED).update(is_redeemed=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedcoupon',
+            name='state',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (2, 'Valid'), (3, 'Activated'), (4, 'Redeemed'), (5, 'Expired')], default=1),
+        ),
+        migrations.AddField(
+            model_name='coupon',
+            name='state',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'Pending'), (2, 'Valid'), (3, 'Activated'), (4, 'Redeemed'), (5, 'Expired')], default=1),
+        ),
+        migrations.RunPython(flags_to_state, state_to_flags),
+        migrations.RemoveField(
+            model_name='archivedcoupon',
+            name='is_activated',
+        ),
+        migrations.RemoveField(
+            model_name='archivedcoupon',
+            name='is_expired',
+        ),
+        migrations.RemoveField(
+            model_name='archivedcoupon',
+            name='is_redeemed',
+        ),
+        migrations.RemoveField(
+            model_name='archivedcoupon',
+            name='is_valid',
+        ),
+        migrations.RemoveField(
+            model_name='coupon',
+            name='is_activated',
+        ),
+        migrations.RemoveField(
+            model_name='coupon',
+            name='is_expired',
+        ),
+        migrations.RemoveField(
+            model_name='coupon',
+            name='is_redeemed',
+        ),
+        migrations.RemoveField(
+            model_name='coupon',
+            name='is_valid',
+        ),
+        migrations.AddIndex(
+            model_name='coupon',
+            index=models.Index(fields=['store', 'state', 'expiration_date'], name='coupon_store_state_exp_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='coupon',
+            constraint=models.CheckConstraint(check=models.Q(('state__gte', 1), ('state__lte', 5)), name='coupon_state_range'),
+        ),
+    ]
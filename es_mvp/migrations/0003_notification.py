@@ -0,0 +1,31 @@
+# Generated by Django 4.2.4 on 2026-10-19 13:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('es_mvp', '0002_coupon_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Notification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message', models.TextField()),
+                ('coupons', models.PositiveSmallIntegerField(default=1)),
+                ('segments', models.PositiveSmallIntegerField(default=1)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='es_mvp.customer')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['customer', 'date_added'], name='notification_customer_date_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.4 on 2026-10-19 13:45
+
+import datetime
+from django.db import migrations, models
+import django.utils.timezone
+import es_mvp.validators
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0003_notification'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='date_sent',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='send_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='storesettings',
+            name='delivery_window_end',
+            field=models.TimeField(default=datetime.time(18, 0)),
+        ),
+        migrations.AddField(
+            model_name='storesettings',
+            name='delivery_window_start',
+            field=models.TimeField(default=datetime.time(9, 0)),
+        ),
+        migrations.AddField(
+            model_name='storesettings',
+            name='timezone',
+            field=models.CharField(default='America/Sao_Paulo', max_length=64, validators=[es_mvp.validators.validate_timezone]),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('date_sent', None)), fields=['send_at'], name='notification_queue_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='storesettings',
+            constraint=models.CheckConstraint(check=models.Q(('delivery_window_end__gt', models.F('delivery_window_start'))), name='store_settings_delivery_window', violation_error_message='The delivery window must end after its start.'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.4 on 2026-10-19 13:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0004_delivery_window'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScheduledTask',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('schedule', models.CharField(max_length=100)),
+                ('last_slot', models.DateTimeField()),
+                ('last_started', models.DateTimeField(blank=True, null=True)),
+                ('last_finished', models.DateTimeField(blank=True, null=True)),
+                ('last_status', models.CharField(blank=True, max_length=10)),
+                ('last_error', models.TextField(blank=True)),
+                ('node', models.CharField(blank=True, max_length=100)),
+                ('runs', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.4 on 2026-10-19 13:48
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('es_mvp', '0005_scheduled_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerProfile',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='profile', serialize=False, to='es_mvp.customer')),
+                ('cashback_balance', models.FloatField(default=0.0)),
+                ('usable_coupons', models.IntegerField(default=0)),
+                ('next_expiration', models.DateField(blank=True, null=True)),
+                ('sales_count', models.IntegerField(default=0)),
+                ('lifetime_spend', models.FloatField(default=0.0)),
+                ('last_purchase_date', models.DateField(blank=True, null=True)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
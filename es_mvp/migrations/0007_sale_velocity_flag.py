@@ -0,0 +1,33 @@
+# Generated by Django 4.2.4 on 2026-10-19 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0006_customer_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedsale',
+            name='flag_reason',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='archivedsale',
+            name='is_flagged',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='flag_reason',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='sale',
+            name='is_flagged',
+            field=models.BooleanField(default=False),
+        ),
+    ]
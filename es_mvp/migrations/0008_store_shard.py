@@ -0,0 +1,25 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('es_mvp', '0007_sale_velocity_flag'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreShard',
+            fields=[
+                ('store', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('shard', models.CharField(max_length=100)),
+                ('is_moving', models.BooleanField(default=False)),
+                ('date_updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:13
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('es_mvp', '0008_store_shard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SaleIdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('is_flagged', models.BooleanField(default=False)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('issued_coupon', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='es_mvp.coupon')),
+                ('sale', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='es_mvp.sale')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date_added'], name='sale_idempotency_date_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='saleidempotencykey',
+            constraint=models.UniqueConstraint(fields=('store', 'key'), name='sale_idempotency_key_unique'),
+        ),
+    ]
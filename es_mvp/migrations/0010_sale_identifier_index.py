@@ -0,0 +1,17 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0009_sale_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sale',
+            index=models.Index(condition=models.Q(('identifier', ''), _negated=True), fields=['store', 'identifier'], name='sale_store_identifier_idx'),
+        ),
+    ]
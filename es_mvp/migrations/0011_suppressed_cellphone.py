@@ -0,0 +1,27 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0010_sale_identifier_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SuppressedCellphone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cellphone', models.CharField(max_length=16, unique=True)),
+                ('reason', models.CharField(choices=[('opt_out', 'Opt-out'), ('permanent_failure', 'Permanent failure')], max_length=20)),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='is_suppressed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0011_suppressed_cellphone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='campaign',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='es_mvp.campaign'),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='date_delivered',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='delivery_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('delivered', 'Delivered'), ('failed', 'Failed')], default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='notification',
+            name='message_id',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('message_id', ''), _negated=True), fields=['message_id'], name='notification_message_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(condition=models.Q(('message_id', ''), _negated=True), fields=['store', 'campaign', 'delivery_status'], name='notification_delivery_idx'),
+        ),
+    ]
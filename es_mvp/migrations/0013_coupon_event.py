@@ -0,0 +1,29 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:22
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('es_mvp', '0012_notification_delivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CouponEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event', models.PositiveSmallIntegerField(choices=[(1, 'Issued'), (2, 'Validated'), (3, 'Activated'), (4, 'Redeemed'), (5, 'Expired')])),
+                ('date_added', models.DateTimeField(auto_now_add=True)),
+                ('coupon', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='events', to='es_mvp.coupon')),
+                ('store', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.PROTECT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['store', 'date_added'], name='coupon_event_store_date_idx')],
+            },
+        ),
+    ]
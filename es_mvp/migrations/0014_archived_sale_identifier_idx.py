@@ -0,0 +1,17 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0013_coupon_event'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='archivedsale',
+            index=models.Index(condition=models.Q(('identifier', ''), _negated=True), fields=['store', 'identifier'], name='archived_sale_identifier_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0014_archived_sale_identifier_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='activations',
+            field=models.JSONField(blank=True, default=list),
+        ),
+    ]
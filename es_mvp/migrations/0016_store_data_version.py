@@ -0,0 +1,23 @@
+# Generated by Django 4.2.4 on 2026-10-19 14:59
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('es_mvp', '0015_notification_activations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoreDataVersion',
+            fields=[
+                ('store', models.OneToOneField(on_delete=django.db.models.deletion.PROTECT, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
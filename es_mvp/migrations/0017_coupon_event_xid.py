@@ -0,0 +1,22 @@
+# Generated by Django 4.2.4 on 2026-10-19 15:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('es_mvp', '0016_store_data_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='couponevent',
+            name='xid',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='couponevent',
+            index=models.Index(fields=['xid', 'id'], name='coupon_event_xid_idx'),
+        ),
+    ]
@@ -1,9 +1,14 @@
-from django.db import models
+from django.db import models, connections, router, transaction
 from django.contrib.auth.models import User
-from django.db.models import CheckConstraint, Q, F
+from django.db.models import CheckConstraint, Q, F, Value, FloatField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast, Ceil, Least
+from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator, URLValidator
-from .validators import validate_sale_date
-from datetime import date, timedelta
+from django.utils.translation import gettext_lazy as _
+from django.conf import settings as django_settings
+from .validators import validate_sale_date, validate_timezone
+from datetime import date, time, timedelta
 
 
 ### ES Minimum Viable Product App
@@ -55,6 +60,40 @@ class Customer(models.Model):
         return customer
 
 
+class CustomerProfile(models.Model):
+    """
+    Model the denormalized profile (and cashback wallet) of a customer, so a 
+    customer lookup at the counter is a single-row read. It is maintained in 
+    the same transaction of the sale registration, the coupon redemption, the 
+    coupon activation and the coupon expiration (see 'es_mvp/wallet.py'). 
+    Command to rebuild it: python manage.py rebuild_profiles
+    """
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE,
+            primary_key=True, related_name='profile')
+    store = models.ForeignKey(User, on_delete=models.PROTECT)
+    ### The wallet: the applicable coupons (valid or activated, not expired).
+    cashback_balance = models.FloatField(default=0.0)
+    usable_coupons = models.IntegerField(default=0)
+    # The nearest expiration date of the usable coupons. The wallet is stale 
+    # after this date, and it is refreshed at read time.
+    next_expiration = models.DateField(null=True, blank=True)
+    ### The purchase history, including the archived sales.
+    sales_count = models.IntegerField(default=0)
+    lifetime_spend = models.FloatField(default=0.0)
+    last_purchase_date = models.DateField(null=True, blank=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """
+        To display customer profile objects in the admin panel or Django shell.
+        """
+        profile = (f"Customer: {self.customer_id} -- " + 
+                f"Balance: {self.cashback_balance} -- " + 
+                f"Coupons: {self.usable_coupons} -- " + 
+                f"Lifetime spend: {self.lifetime_spend}")
+        return profile
+
+
 class Sale(models.Model):
     """
     Model a sale event.
@@ -88,6 +127,11 @@ class Sale(models.Model):
     # active campaign is tested and, if applicable, a new coupon is issued. 
     # Thus, the status changes to "evaluated".
     is_evaluated = models.BooleanField(default=False)
+    # A sale that violates a velocity rule is flagged as suspect and its coupon
+    # issuance is held (it stays "not evaluated") until released. See 
+    # 'es_mvp/velocity.py'.
+    is_flagged = models.BooleanField(default=False)
+    flag_reason = models.CharField(max_length=200, blank=True)
     # Date of sale transaction. It determines the lifetime of an issued coupon.
     date = models.DateField(validators=[validate_sale_date])
     date_added = models.DateTimeField(auto_now_add=True)
@@ -120,6 +164,13 @@ class Sale(models.Model):
                 check=Q(date__lte=(F("date_added") + timedelta(days=1))),
                         name='sale_date_limit_max'),
         )
+        indexes = (
+            # Supports the duplicate checks of the POS sale identifiers (see
+            # 'SALE_IDENTIFIER_POLICY' in the app settings.py).
+            models.Index(fields=['store', 'identifier'], 
+                    condition=~Q(identifier=''),
+                    name='sale_store_identifier_idx'),
+        )
 
     def __str__(self):
         """
@@ -135,6 +186,47 @@ class Sale(models.Model):
         return sale
 
 
+class SaleIdempotencyKey(models.Model):
+    """
+    Model the idempotency key of a sale registration, with its outcome. A 
+    retried registration (ex. a POS resubmitting on a flaky connection) gets 
+    the original outcome instead of a duplicate sale. The keys expire (see 
+    'SALE_IDEMPOTENCY_KEY_TTL' in the app settings.py).
+    """
+    store = models.ForeignKey(User, on_delete=models.CASCADE)
+    # The key sent by the client (see 'new_sale()' in 'es_mvp/views.py').
+    key = models.CharField(max_length=64)
+    # The outcome. Note: the sale is null only while it is registered.
+    sale = models.ForeignKey(Sale, on_delete=models.CASCADE, null=True, 
+            blank=True)
+    issued_coupon = models.ForeignKey("Coupon", on_delete=models.SET_NULL, 
+            null=True, blank=True, related_name='+')
+    is_flagged = models.BooleanField(default=False)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = (
+            # Supports the replay lookup (and serializes concurrent retries).
+            models.UniqueConstraint(fields=['store', 'key'],
+                    name='sale_idempotency_key_unique'),
+        )
+        indexes = (
+            # Supports the expiration.
+            models.Index(fields=['date_added'], 
+                    name='sale_idempotency_date_idx'),
+        )
+
+    def __str__(self):
+        """
+        To display idempotency key objects in the admin panel or Django shell.
+        """
+        idempotency_key = (f"Store: {self.store} -- " +
+                f"Key: {self.key} -- " +
+                f"Sale: {self.sale_id}"
+                )
+        return idempotency_key
+
+
 class Campaign(models.Model):
     """
     Model an incentive campaign.
@@ -201,7 +293,142 @@ class Campaign(models.Model):
         return campaign
 
 
-class Coupon(models.Model):
+class CouponState(models.IntegerChoices):
+    """
+    Enumerate the coupon lifecycle states.
+    """
+    # Issued, but the customer was not notified yet.
+    PENDING = 1, 'Pending'
+    # Valid (the same as applicable). A coupon becomes valid from the first 
+    # activation message delivery (~2 days from the added date).
+    VALID = 2, 'Valid'
+    # Valid and the activation cycle was completed (that is, all activation 
+    # messages were sent).
+    ACTIVATED = 3, 'Activated'
+    REDEEMED = 4, 'Redeemed'
+    EXPIRED = 5, 'Expired'
+
+
+# The states from which a coupon can be redeemed on a new sale.
+APPLICABLE_STATES = (CouponState.VALID, CouponState.ACTIVATED)
+# The states of a coupon that was made valid (the same as issued). Note: the 
+# state does not keep if an expired coupon was valid before, thus the expired
+# coupons are counted apart.
+VALIDATED_STATES = (CouponState.VALID, CouponState.ACTIVATED, 
+        CouponState.REDEEMED)
+# The final states of the coupon lifecycle.
+TERMINAL_STATES = (CouponState.REDEEMED, CouponState.EXPIRED)
+# The allowed lifecycle transitions (current state: next states).
+COUPON_TRANSITIONS = {
+    CouponState.PENDING : (CouponState.VALID, CouponState.EXPIRED),
+    CouponState.VALID : (CouponState.ACTIVATED, CouponState.REDEEMED,
+            CouponState.EXPIRED),
+    CouponState.ACTIVATED : (CouponState.REDEEMED, CouponState.EXPIRED),
+    CouponState.REDEEMED : (),
+    CouponState.EXPIRED : (),
+}
+
+
+class CouponLifecycle(models.Model):
+    """
+    Model the coupon lifecycle as a single state column. Shared by the live and
+    the archived coupons.
+    """
+    state = models.PositiveSmallIntegerField(choices=CouponState.choices,
+            default=CouponState.PENDING)
+
+    class Meta:
+        abstract = True
+
+    def transition_to(self, state):
+        """
+        Change the coupon state, enforcing the allowed lifecycle transitions.
+        Note: the caller must save the coupon.
+        """
+        if state not in COUPON_TRANSITIONS[self.state]:
+            raise ValidationError(
+                _("Invalid coupon transition from %(current)s to %(next)s."),
+                params={"current": CouponState(self.state).label,
+                        "next": CouponState(state).label},
+                code="coupon_invalid_transition")
+        self.state = state
+
+    ### Read-only flags, kept for the templates and the Django shell.
+
+    @property
+    def is_redeemed(self):
+        return self.state == CouponState.REDEEMED
+
+    @property
+    def is_expired(self):
+        # Note: the expiration is evaluated at read time. See 'CouponQuerySet'.
+        return (self.state == CouponState.EXPIRED) or (
+                (self.state in APPLICABLE_STATES) and 
+                (self.expiration_date < date.today()))
+
+    @property
+    def is_activated(self):
+        return self.state == CouponState.ACTIVATED
+
+    @property
+    def is_valid(self):
+        # Note: a redeemed coupon was valid before (see 'VALIDATED_STATES').
+        return self.state in VALIDATED_STATES
+
+
+class CouponQuerySet(models.QuerySet):
+    """
+    Coupon queries that evaluate the expiration at read time, driven by the 
+    'expiration_date'. A coupon is expired from the day after its expiration 
+    date. Thus, the stored 'expired' state is only a cache, settled in bulk by 
+    the 'coupon_expiration_task' (see 'es_mvp/cron.py').
+    """
+
+    def applicable(self, today=None):
+        """Coupons that can be redeemed on a new sale today."""
+        return self.filter(state__in=APPLICABLE_STATES, 
+                expiration_date__gte=(today or date.today()))
+
+    def expired(self, today=None):
+        """Coupons expired, settled or not."""
+        return self.filter(Q(state=CouponState.EXPIRED) | Q(
+                state__in=APPLICABLE_STATES, 
+                expiration_date__lt=(today or date.today())))
+
+    def overdue(self, today=None):
+        """Coupons expired, but whose stored state was not settled yet."""
+        return self.filter(state__in=APPLICABLE_STATES, 
+                expiration_date__lt=(today or date.today()))
+
+    def settle_expired(self, today=None):
+        """
+        Store the 'expired' state of the overdue coupons in a single query, and
+        record their expiration events (see 'CouponEvent'). Returns the number
+        of settled coupons.
+        """
+        overdue = self.select_for_update().overdue(today)
+        with transaction.atomic(using=overdue.db):
+            coupons = list(overdue.values_list('id', 'store'))
+            settled = self.filter(id__in=[coupon_id for coupon_id, store_id 
+                    in coupons]).update(state=CouponState.EXPIRED)
+            CouponEvent.objects.record(CouponEventType.EXPIRED, coupons)
+        return settled
+
+    def with_effective_discount(self, sale_initial_value):
+        """
+        Annotate the effective discount of each coupon on a new sale, in SQL. 
+        It is the lesser of the coupon face value and the maximum discount 
+        allowed, calculated by: ceil('sale_initial_value' * 
+        'coupon.discount_limit_rate'). Mirrors 'sale_effective_discount()' (see 
+        'es_mvp/views.py').
+        """
+        max_discount = Ceil(Value(float(sale_initial_value)) * (
+                Cast('discount_limit_rate', FloatField()) / Value(100.0)))
+        return self.annotate(effective_discount=Least('discount_value', 
+                max_discount, output_field=FloatField()))
+
+
+class Coupon(CouponLifecycle):
     """
     Model a bonus coupon.
     """
@@ -227,42 +454,139 @@ class Coupon(models.Model):
     # Expiration is calculated by:
     # 'Sale.added_date' + timedelta(Campaign.coupon_lifetime)
     expiration_date = models.DateField()
-    # To control if coupon was redeemed.
-    is_redeemed = models.BooleanField(default=False)
-    # To control if coupon was expired.
-    is_expired = models.BooleanField(default=False)
-    # To control if coupon activated cycle was completed (that is, if all 
-    # activation message was sent).
-    is_activated = models.BooleanField(default=False)
-    # To control if coupon is valid (the same as applicable). A coupon becomes 
-    # valid from the first activation message delivery (~2 days from the 
-    # added_date).
-    is_valid = models.BooleanField(default=False)
     date_added = models.DateTimeField(auto_now_add=True)
 
+    objects = CouponQuerySet.as_manager()
+
+    class Meta:
+        indexes = (
+            # Supports the store scoped lifecycle queries (summaries, applicable
+            # coupons and the cron jobs).
+            models.Index(fields=['store', 'state', 'expiration_date'],
+                    name='coupon_store_state_exp_idx'),
+        )
+        constraints = (
+            # For checking and maintain the DB integrity.
+            CheckConstraint(
+                check=Q(state__gte=CouponState.PENDING, 
+                        state__lte=CouponState.EXPIRED),
+                name='coupon_state_range'),
+        )
+
     def __str__(self):
         """
         To display coupon objects in the admin panel or the Django shell.
         """
-        if self.is_redeemed:
-            coupon_status = "redeemed"
-        elif self.is_expired:
-            coupon_status = "expired"
-        elif self.is_valid:
-            coupon_status = "valid"
-        else:
-            coupon_status = "invalid"
         coupon = (f"Store: {self.store.storesettings.title} -- " +
                 f"Sale: {self.sale.identifier} -- " +
                 f"Customer: {self.customer.cellphone} -- " +
                 f"ID: {self.identifier} -- " +
                 f"Value: {self.discount_value} -- " + 
                 f"Expiration: {self.expiration_date} -- " + 
-                f"Status: {coupon_status}"
+                f"Status: {self.get_state_display()}"
                 )
         return coupon
 
 
+### Coupon event ledger
+#
+# An append-only history of the coupon lifecycle: an event per issuance, 
+# activation transition, redemption and expiration, written in the same 
+# transaction as the coupon change (the bulk paths included). The ledger keeps
+# the events of the archived coupons (they keep their ids), and it is consumed
+# incrementally by a cursor (see 'es_mvp/ledger.py').
+#
+###
+
+class CouponEventType(models.IntegerChoices):
+    """
+    Enumerate the coupon events. Each event enters the coupon state of the same
+    value (see 'CouponState').
+    """
+    ISSUED = 1, 'Issued'
+    VALIDATED = 2, 'Validated'
+    ACTIVATED = 3, 'Activated'
+    REDEEMED = 4, 'Redeemed'
+    EXPIRED = 5, 'Expired'
+
+
+class CouponEventQuerySet(models.QuerySet):
+
+    def record(self, event, coupons):
+        """
+        Record an event of many coupons in a single query. The coupons are a 
+        list of (coupon id, store id) tuples. The events take the id of their
+        transaction (see 'tail()').
+        """
+        using = router.db_for_write(CouponEvent)
+        with transaction.atomic(using=using):
+            # Note: SQLite holds a single writer until the commit, and other
+            # databases than PostgreSQL are not supported.
+            xid = 0
+            connection = connections[using]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT pg_current_xact_id()::text::bigint")
+                    xid = cursor.fetchone()[0]
+            return self.using(using).bulk_create(CouponEvent(
+                    coupon_id=coupon_id, store_id=store_id, event=event, 
+                    xid=xid) for coupon_id, store_id in coupons)
+
+    def tail(self, after=(0, 0), limit=None):
+        """
+        The events after a (transaction id, event id) position, in that order.
+        On PostgreSQL, only the events of the transactions older than every 
+        transaction in flight are read, so an event yet to be committed never 
+        takes a lower position than the events read (but a long transaction
+        delays the tail).
+        """
+        if limit is None:
+            limit = django_settings.COUPON_EVENT_TAIL_LIMIT
+        xid, event_id = after
+        events = self.filter(Q(xid__gt=xid) | Q(xid=xid, id__gt=event_id))
+        if connections[events.db].vendor == 'postgresql':
+            events = events.filter(xid__lt=RawSQL(
+                    "pg_snapshot_xmin(pg_current_snapshot())::text::bigint",
+                    []))
+        return events.order_by('xid', 'id')[:limit]
+
+
+class CouponEvent(models.Model):
+    """
+    Model an event of the coupon lifecycle. The rows are never changed.
+    """
+    store = models.ForeignKey(User, on_delete=models.PROTECT, db_index=False)
+    # Note: not a constraint, since the archived coupons leave the table.
+    coupon = models.ForeignKey(Coupon, on_delete=models.DO_NOTHING, 
+            db_constraint=False, related_name='events')
+    event = models.PositiveSmallIntegerField(choices=CouponEventType.choices)
+    date_added = models.DateTimeField(auto_now_add=True)
+    # The id of the transaction that recorded the event, on PostgreSQL (else 
+    # 0). It orders the ledger tail (see 'tail()').
+    xid = models.BigIntegerField(default=0, editable=False)
+
+    objects = CouponEventQuerySet.as_manager()
+
+    class Meta:
+        indexes = (
+            # Supports the store scoped history (ex. the funnel timings).
+            models.Index(fields=['store', 'date_added'], 
+                    name='coupon_event_store_date_idx'),
+            # Supports the ledger tail.
+            models.Index(fields=['xid', 'id'], name='coupon_event_xid_idx'),
+        )
+
+    def __str__(self):
+        """
+        To display coupon event objects in the admin panel or Django shell.
+        """
+        coupon_event = (f"Coupon: {self.coupon_id} -- " +
+                f"Event: {self.get_event_display()} -- " +
+                f"Date: {self.date_added}"
+                )
+        return coupon_event
+
+
 class StoreSettings(models.Model):
     """
     Model the store settings. This is an extension of the User (store) model.
@@ -286,11 +610,21 @@ class StoreSettings(models.Model):
             validators=[MinValueValidator(0)])
     # Default coupon lifetime in days.
     coupon_lifetime = models.IntegerField(validators=[MinValueValidator(5)])
+    ### The delivery window of the activation messages, in the store timezone.
+    timezone = models.CharField(max_length=64, 
+            default=django_settings.TIME_ZONE, validators=[validate_timezone])
+    delivery_window_start = models.TimeField(default=time(9, 0))
+    delivery_window_end = models.TimeField(default=time(18, 0))
     date_added = models.DateTimeField(auto_now_add=True)
 
     class Meta: 
         verbose_name_plural = 'store settings'
         constraints = (
+            CheckConstraint(
+                check=Q(delivery_window_end__gt=F("delivery_window_start")),
+                name='store_settings_delivery_window',
+                violation_error_message=_(
+                        "The delivery window must end after its start.")),
             # For checking and maintain the DB integrity.
             CheckConstraint(
                 check=Q(bonus_rate__gte=0),
@@ -311,4 +645,317 @@ class StoreSettings(models.Model):
         store_settings = (f"Owner: {self.owner} --  Added: {self.date_added}")       
         return store_settings
 
- 
\ No newline at end of file
+ 
+
+class StoreDataVersion(models.Model):
+    """
+    Model the data version of a store, bumped by any change of the store data.
+    It keys the cached fragments of the store pages (see 
+    'es_mvp/fragments.py').
+    Note: it lives in the database, so every app process sees a bump at once.
+    """
+    store = models.OneToOneField(User, on_delete=models.PROTECT, 
+            primary_key=True)
+    version = models.PositiveBigIntegerField(default=0)
+
+
+### Archive (cold storage)
+#
+# Redeemed/expired coupons and sales older than the archive horizon are moved 
+# out of the live tables by the 'archival_task' (see 'es_mvp/cron.py' and 
+# 'es_mvp/archive.py'). Archived rows keep their original primary keys, so the 
+# detail pages and any shared links still resolve them. The archive is closed 
+# under its references: an archived sale only points to archived coupons and 
+# vice versa, thus the live tables never reference an archived row.
+#
+###
+
+class ArchivedSale(models.Model):
+    """
+    Model an archived sale event. Mirrors the 'Sale' model.
+    """
+    # The original 'Sale.id'.
+    id = models.BigIntegerField(primary_key=True)
+    store = models.ForeignKey(User, on_delete=models.PROTECT)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
+    initial_value = models.FloatField()
+    effective_discount = models.FloatField()
+    final_value = models.FloatField()
+    redeemed_coupon = models.OneToOneField("ArchivedCoupon", 
+            on_delete=models.PROTECT, blank=True, null=True, 
+            related_name='redeemed_coupon')
+    identifier = models.CharField(max_length=12, blank=True)
+    is_evaluated = models.BooleanField(default=False)
+    is_flagged = models.BooleanField(default=False)
+    flag_reason = models.CharField(max_length=200, blank=True)
+    date = models.DateField()
+    # Note: not an 'auto_now_add' field, the original value is preserved.
+    date_added = models.DateTimeField()
+    date_archived = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = (
+            # Supports the duplicate checks of the POS sale identifiers (see
+            # 'SALE_IDENTIFIER_POLICY' in the app settings.py).
+            models.Index(fields=['store', 'identifier'], 
+                    condition=~Q(identifier=''),
+                    name='archived_sale_identifier_idx'),
+        )
+
+    def __str__(self):
+        """
+        To display archived sale objects in the admin panel or Django shell.
+        """
+        sale = (f"Store: {self.store} -- " +
+                f"Sale ID: {self.identifier} -- " + 
+                f"Date: {self.date} -- " + 
+                f"Value: {self.final_value} -- " + 
+                f"Archived: {self.date_archived}" 
+                )        
+        return sale
+
+
+class ArchivedCoupon(CouponLifecycle):
+    """
+    Model an archived (redeemed or expired) coupon. Mirrors the 'Coupon' model.
+    """
+    # The original 'Coupon.id'.
+    id = models.BigIntegerField(primary_key=True)
+    store = models.ForeignKey(User, on_delete=models.PROTECT)
+    sale = models.OneToOneField(ArchivedSale, on_delete=models.PROTECT)
+    campaign = models.ForeignKey(Campaign, on_delete=models.PROTECT)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
+    identifier = models.CharField(max_length=6)
+    discount_value = models.FloatField()
+    discount_limit_rate = models.IntegerField()
+    expiration_date = models.DateField()
+    # Note: not an 'auto_now_add' field, the original value is preserved.
+    date_added = models.DateTimeField()
+    date_archived = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """
+        To display archived coupon objects in the admin panel or Django shell.
+        """
+        coupon = (f"Store: {self.store} -- " +
+                f"ID: {self.identifier} -- " +
+                f"Value: {self.discount_value} -- " + 
+                f"Expiration: {self.expiration_date} -- " + 
+                f"Archived: {self.date_archived}"
+                )
+        return coupon
+
+
+class ArchiveRollup(models.Model):
+    """
+    Model the cumulative totals of the archived rows of a campaign. The 'home'
+    and 'campaign' summaries add these totals to the live aggregates, so KPIs
+    stay correct after the archival.
+    """
+    store = models.ForeignKey(User, on_delete=models.PROTECT)
+    campaign = models.OneToOneField(Campaign, on_delete=models.PROTECT)
+    # Final value of the archived sales that redeemed a campaign coupon.
+    cumulative_sales = models.FloatField(default=0.0)
+    # Face value of the archived redeemed coupons.
+    cumulative_cashback = models.FloatField(default=0.0)
+    redeemed_coupons = models.IntegerField(default=0)
+    issued_coupons = models.IntegerField(default=0)
+    expired_coupons = models.IntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """
+        To display rollup objects in the admin panel or the Django shell.
+        """
+        rollup = (f"Store: {self.store} -- " +
+                f"Campaign: {self.campaign.title[:20]} -- " + 
+                f"Updated: {self.date_updated}"
+                )
+        return rollup
+
+
+
+### Notifications
+#
+# The SMS sent to customers by the activation cycle (see 'es_mvp/cron.py' and 
+# 'es_mvp/notifications.py'). A notification may cover many coupons of the same
+# customer (a digest). The notifications are queued with a delivery slot into 
+# the store delivery window, and drained continuously. They also support the 
+# daily caps. The delivery receipts of the SMS provider are imported in bulk 
+# (see 'es_mvp/receipts.py').
+#
+###
+
+class DeliveryStatus(models.TextChoices):
+    """
+    Enumerate the delivery states of a sent notification.
+    """
+    # Sent, without a delivery receipt yet.
+    PENDING = 'pending', 'Pending'
+    DELIVERED = 'delivered', 'Delivered'
+    FAILED = 'failed', 'Failed'
+
+
+class Notification(models.Model):
+    """
+    Model a notification (SMS) sent to a customer.
+    """
+    store = models.ForeignKey(User, on_delete=models.PROTECT)
+    customer = models.ForeignKey(Customer, on_delete=models.PROTECT)
+    # The campaign of the covered coupons. Null for a digest of many campaigns.
+    campaign = models.ForeignKey(Campaign, on_delete=models.PROTECT, 
+            null=True, blank=True)
+    message = models.TextField()
+    # The number of coupons covered by the message.
+    coupons = models.PositiveSmallIntegerField(default=1)
+    # The (coupon id, activation step) pairs of the covered coupons. Their 
+    # activation state transitions are applied when the message is sent (see
+    # 'deliver_notifications()' in 'es_mvp/notifications.py').
+    activations = models.JSONField(default=list, blank=True)
+    # The number of billed SMS segments.
+    segments = models.PositiveSmallIntegerField(default=1)
+    # The delivery slot, into the store delivery window. 
+    send_at = models.DateTimeField()
+    # Null while the notification is queued.
+    date_sent = models.DateTimeField(null=True, blank=True)
+    # A notification to a suppressed cellphone leaves the queue unsent (see 
+    # 'es_mvp/suppression.py').
+    is_suppressed = models.BooleanField(default=False)
+    # The message id of the SMS provider. Blank while queued or if suppressed.
+    message_id = models.CharField(max_length=64, blank=True)
+    delivery_status = models.CharField(max_length=10, 
+            choices=DeliveryStatus.choices, default=DeliveryStatus.PENDING)
+    # The time of the delivery receipt.
+    date_delivered = models.DateTimeField(null=True, blank=True)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = (
+            # Supports the daily caps (see 'SMS_DAILY_CAP' in settings.py).
+            models.Index(fields=['customer', 'date_added'],
+                    name='notification_customer_date_idx'),
+            # Supports the delivery queue drain.
+            models.Index(fields=['send_at'], condition=Q(date_sent=None),
+                    name='notification_queue_idx'),
+            # Supports the delivery receipts import.
+            models.Index(fields=['message_id'], condition=~Q(message_id=''),
+                    name='notification_message_id_idx'),
+            # Supports the delivery rates by store and campaign.
+            models.Index(fields=['store', 'campaign', 'delivery_status'], 
+                    condition=~Q(message_id=''), 
+                    name='notification_delivery_idx'),
+        )
+
+    def __str__(self):
+        """
+        To display notification objects in the admin panel or Django shell.
+        """
+        notification = (f"Store: {self.store} -- " +
+                f"Customer: {self.customer.cellphone} -- " +
+                f"Coupons: {self.coupons} -- " + 
+                f"Send at: {self.send_at} -- " + 
+                f"Sent: {self.date_sent} -- " + 
+                f"Delivery: {self.delivery_status}"
+                )
+        return notification
+
+
+
+class SuppressionReason(models.TextChoices):
+    """
+    Enumerate the reasons of a cellphone suppression.
+    """
+    # The customer replied STOP.
+    OPT_OUT = 'opt_out', 'Opt-out'
+    # The provider can never deliver to the cellphone (ex. an invalid number).
+    PERMANENT_FAILURE = 'permanent_failure', 'Permanent failure'
+
+
+class SuppressedCellphone(models.Model):
+    """
+    Model a cellphone that must not receive notifications (see 
+    'es_mvp/suppression.py').
+    Note: the list is shared by all stores (a single SMS sender).
+    """
+    # The complete cellphone number, as 'Customer.cellphone'.
+    cellphone = models.CharField(max_length=16, unique=True)
+    reason = models.CharField(max_length=20, choices=SuppressionReason.choices)
+    date_added = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """
+        To display suppressed cellphone objects in the admin panel or Django 
+        shell.
+        """
+        suppressed_cellphone = (f"Cellphone: {self.cellphone} -- " +
+                f"Reason: {self.reason} -- " +
+                f"Date: {self.date_added}"
+                )
+        return suppressed_cellphone
+
+
+### Scheduler
+#
+# The run state of the periodic tasks (see 'es_mvp/scheduler.py').
+#
+###
+
+class ScheduledTask(models.Model):
+    """
+    Model the run state of a scheduled task.
+    """
+    # The task function name (see 'es_mvp/cron.py').
+    name = models.CharField(max_length=100, unique=True)
+    # The cron expression.
+    schedule = models.CharField(max_length=100)
+    # The last schedule slot claimed by a run.
+    last_slot = models.DateTimeField()
+    last_started = models.DateTimeField(null=True, blank=True)
+    last_finished = models.DateTimeField(null=True, blank=True)
+    # 'running', 'success' or 'failed'.
+    last_status = models.CharField(max_length=10, blank=True)
+    last_error = models.TextField(blank=True)
+    # The node (host:pid) of the last run.
+    node = models.CharField(max_length=100, blank=True)
+    runs = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        """
+        To display scheduled task objects in the admin panel or Django shell.
+        """
+        scheduled_task = (f"Task: {self.name} ({self.schedule}) -- " +
+                f"Last slot: {self.last_slot} -- " +
+                f"Status: {self.last_status}"
+                )
+        return scheduled_task
+
+
+
+### Sharding
+#
+# The directory of the store shards: the database that holds the data of each
+# store (see 'es_mvp/sharding.py'). It lives in the 'default' database.
+#
+###
+
+class StoreShard(models.Model):
+    """
+    Model the shard assignment of a store.
+    """
+    store = models.OneToOneField(User, on_delete=models.CASCADE, 
+            primary_key=True)
+    # The database alias (see 'SHARD_DATABASES' in the app settings.py).
+    shard = models.CharField(max_length=100)
+    # The store writes are paused while it moves between shards.
+    is_moving = models.BooleanField(default=False)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        """
+        To display store shard objects in the admin panel or Django shell.
+        """
+        store_shard = (f"Store: {self.store} -- " +
+                f"Shard: {self.shard} -- " +
+                f"Moving: {self.is_moving}"
+                )
+        return store_shard
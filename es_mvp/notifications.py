@@ -0,0 +1,323 @@
+"""
+Implement the notification planner of the coupon activation cycle.
+"""
+from django.conf import settings as django_settings
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+from .models import (Coupon, CouponState, Notification, SuppressionReason,
+        CouponEvent, CouponEventType)
+from .fragments import bump_data_version
+from .sharding import store_db, moving_stores
+from .sms import (sending_sms_aws, compile_sms_template, sms_segments, 
+        is_permanent_failure)
+from .suppression import suppression_list, suppress
+from .wallet import refresh_wallets
+from datetime import date, datetime, timedelta
+from math import floor
+from zoneinfo import ZoneInfo
+import logging
+
+
+# The activation messages, by activation step. The store fields ('currency' and
+# 'title') and the campaign 'url' are compiled once per run (see 
+# 'compile_sms_template()' in 'es_mvp/sms.py'). The remaining fields are 
+# rendered for each coupon.
+ACTIVATION_TEMPLATES = {
+    1 : ("You receive {currency}{value} of cashback on {title}. Expires on "
+            "{expiration}. Max discount {limit}%, not cumulative. {url}"),
+    2 : ("You have {currency}{value} cashback to purchases on {title}. Expires "
+            "on {expiration}. Max discount {limit}%, not cumulative. {url}"),
+    3 : ("Don't let cashback expire {currency}{value} for purchases on "
+            "{title}. Expires on {expiration}. Max discount {limit}%, not "
+            "cumulative. {url}"),
+    4 : ("Expires in 3 days! Your cashback of {currency}{value} to use on "
+            "{title} expires in {expiration}. Max discount {limit}%, not "
+            "cumulative. {url}"),
+    }
+# The digest message, when many coupons of a customer are due in the same day.
+DIGEST_TEMPLATE = ("You have {currency}{value} of cashback in {count} coupons "
+        "on {title}. The first expires on {expiration}. One per purchase, not "
+        "cumulative. {url}")
+
+logger = logging.getLogger(__name__)
+
+
+def activation_step(coupon, today):
+    """
+    Return the activation step (1 to 4) due today for a coupon, or None.
+    The first three steps are function of the coupon added date. And the last 
+    step are related with the coupon expiration date.
+    """
+    # Converts a datetime object in a date object:
+    trigger_date = date(coupon.date_added.year,
+                coupon.date_added.month, coupon.date_added.day)
+    ### First activation: if the coupon was issued 2 days ago. Note: a coupon
+    ### becomes valid when its first message is sent (see 
+    ### 'deliver_notifications()'), thus a pending coupon whose message was 
+    ### not sent (ex. the customer reached the daily cap) is due again.
+    if (coupon.state == CouponState.PENDING) and (
+            today >= (trigger_date + timedelta(days=2))):
+        return 1
+    ### Second activation: if the coupon was issued 7 days ago.
+    elif today == (trigger_date + timedelta(days=7)):
+        return 2
+    ### Third activation: if the coupon was issued 27 days ago.
+    elif today == (trigger_date + timedelta(days=27)):
+        return 3
+    ### Last activation: if the coupon has an expiration lifetime greater 
+    ### than 35 days and there are only 3 days left before its expiration.
+    # Note: only a valid coupon completes its activation cycle.
+    elif (coupon.campaign.coupon_lifetime > 35) and (
+            coupon.state == CouponState.VALID) and (
+            today == (coupon.expiration_date - timedelta(days=3))):
+        return 4
+    return None
+
+
+def compiled_template(key, template, compiled_templates, **fields):
+    """
+    Compile a message template once per key (see 'compile_sms_template()'), 
+    caching it in 'compiled_templates'.
+    """
+    if key not in compiled_templates:
+        compiled = compile_sms_template(template, **fields)
+        if compiled.segments > 1:
+            logger.warning("Message %s takes %s segments (%s).", key, 
+                    compiled.segments, compiled.encoding)
+        compiled_templates[key] = compiled
+    return compiled_templates[key]
+
+
+def format_expiration(expiration_date):
+    """Format an expiration date as 'dd.mm'."""
+    return (f"{format(expiration_date.day,'02d')}" +
+            f".{format(expiration_date.month,'02d')}")
+
+
+def activation_message(coupon, step, compiled_templates):
+    """
+    Render the activation message of a coupon. The message template is compiled
+    once per store, campaign and step.
+    """
+    settings = coupon.store.storesettings
+    compiled = compiled_template((coupon.store_id, coupon.campaign_id, step),
+            ACTIVATION_TEMPLATES[step], compiled_templates, 
+            currency=settings.currency, title=settings.title, 
+            url=coupon.campaign.url)
+    return compiled.template.format(value=floor(coupon.discount_value), 
+            expiration=format_expiration(coupon.expiration_date),
+            limit=coupon.discount_limit_rate)
+
+
+def digest_message(coupons, compiled_templates):
+    """
+    Render a single message for many coupons of the same customer: the total 
+    cashback available and the nearest expiration. The link is the campaign url
+    if all coupons share a campaign, or else the store default url.
+    """
+    settings = coupons[0].store.storesettings
+    urls = {coupon.campaign.url for coupon in coupons}
+    url = urls.pop() if len(urls) == 1 else settings.url
+    compiled = compiled_template((coupons[0].store_id, url, 'digest'),
+            DIGEST_TEMPLATE, compiled_templates, currency=settings.currency, 
+            title=settings.title, url=url)
+    return compiled.template.format(
+            value=sum(floor(coupon.discount_value) for coupon in coupons),
+            count=len(coupons),
+            expiration=format_expiration(min(coupon.expiration_date 
+                    for coupon in coupons)))
+
+
+def plan_notifications(due, today, compiled_templates=None, 
+        suppression=None):
+    """
+    Plan the notifications of the day. The due activation messages (a list of 
+    (coupon, step) tuples) are grouped by store and customer. A customer with a
+    single due coupon gets its activation message, and a customer with many due
+    coupons gets a single digest message. Customers that have reached the daily
+    cap (see 'SMS_DAILY_CAP' in the app settings.py), have a queued message or
+    are suppressed (see 'es_mvp/suppression.py') are skipped.
+    Returns a list of unsaved 'Notification' objects, without delivery slots 
+    (see 'schedule_notifications()').
+    Note: the plan does not change the coupons. The activation state 
+    transitions are applied when the messages are sent.
+    """
+    if compiled_templates is None:
+        compiled_templates = {}
+    if suppression is None:
+        suppression = suppression_list()
+    groups = {}
+    for coupon, step in due:
+        groups.setdefault((coupon.store_id, coupon.customer_id), []).append(
+                (coupon, step))
+    # Counts the notifications already sent today, by customer.
+    customer_ids = [customer_id for store_id, customer_id in groups]
+    daily_cap = django_settings.SMS_DAILY_CAP
+    sent = {}
+    if daily_cap is not None:
+        sent = dict(Notification.objects.filter(customer__in=customer_ids,
+                date_added__date=today).values('customer').annotate(
+                sent=Count('id')).values_list('customer', 'sent'))
+    # The customers whose message of a previous plan is still queued (its 
+    # coupons are still pending).
+    queued = set(Notification.objects.filter(customer__in=customer_ids,
+            date_sent=None).values_list('customer', flat=True))
+    notifications = []
+    for (store_id, customer_id), group in groups.items():
+        if (daily_cap is not None) and (sent.get(customer_id, 0) >= daily_cap):
+            continue
+        if customer_id in queued:
+            continue
+        coupons = [coupon for coupon, step in group]
+        if coupons[0].customer.cellphone in suppression:
+            continue
+        if len(group) == 1:
+            message = activation_message(*group[0], compiled_templates)
+        else:
+            message = digest_message(coupons, compiled_templates)
+        campaigns = {coupon.campaign_id for coupon in coupons}
+        notifications.append(Notification(store=coupons[0].store, 
+                customer=coupons[0].customer, 
+                campaign_id=campaigns.pop() if len(campaigns) == 1 else None,
+                message=message, 
+                coupons=len(coupons), segments=sms_segments(message)[1],
+                activations=[[coupon.id, step] for coupon, step in group]))
+    return notifications
+
+
+def delivery_slots(store_settings, count, now):
+    """
+    Spread 'count' delivery slots evenly across the remaining delivery window 
+    of a store, in the store timezone. If the window of the day is over, the 
+    slots are taken from the next day window.
+    """
+    store_timezone = ZoneInfo(store_settings.timezone)
+    local_now = now.astimezone(store_timezone)
+    day = local_now.date()
+    start = max(local_now, datetime.combine(day, 
+            store_settings.delivery_window_start, tzinfo=store_timezone))
+    end = datetime.combine(day, store_settings.delivery_window_end, 
+            tzinfo=store_timezone)
+    if start >= end:
+        day += timedelta(days=1)
+        start = datetime.combine(day, store_settings.delivery_window_start, 
+                tzinfo=store_timezone)
+        end = datetime.combine(day, store_settings.delivery_window_end, 
+                tzinfo=store_timezone)
+    interval = (end - start) / count
+    return [start + (interval * index) for index in range(count)]
+
+
+def schedule_notifications(notifications, now=None):
+    """
+    Assign a delivery slot ('send_at') to each planned notification, spreading 
+    the notifications of each store across its delivery window.
+    """
+    if now is None:
+        now = timezone.now()
+    by_store = {}
+    for notification in notifications:
+        by_store.setdefault(notification.store_id, []).append(notification)
+    for store_notifications in by_store.values():
+        store_settings = store_notifications[0].store.storesettings
+        for notification, send_at in zip(store_notifications, delivery_slots(
+                store_settings, len(store_notifications), now)):
+            notification.send_at = send_at
+    return notifications
+
+
+def deliver_notifications(now=None, limit=None, suppression=None):
+    """
+    Send the queued notifications whose delivery slot is due, up to 'limit' 
+    notifications (see 'NOTIFICATION_DELIVERY_RATE' in the app settings.py).
+    Each notification is locked, sent and marked as sent in its own 
+    transaction, skipping the rows locked by concurrent workers, so the queue
+    can be drained by many nodes and a sent message is never sent again. A 
+    transient sending failure stops the run, leaving the remaining 
+    notifications queued for the next one. The notifications to suppressed 
+    cellphones leave the queue unsent, and a permanent sending failure 
+    suppresses its cellphone (see 'es_mvp/suppression.py'). The activations of
+    each sent notification are applied in its transaction (see 
+    'apply_activations()'), and its message id is kept for its delivery 
+    receipt (see 'es_mvp/receipts.py'). The notifications of the stores moving between 
+    shards wait for the move. Returns the number of sent notifications.
+    """
+    if now is None:
+        now = timezone.now()
+    if limit is None:
+        limit = django_settings.NOTIFICATION_DELIVERY_RATE
+    if suppression is None:
+        suppression = suppression_list()
+    moving = moving_stores()
+    sent = 0
+    for index in range(limit):
+        with transaction.atomic(using=store_db()):
+            notification = Notification.objects.select_for_update(
+                    skip_locked=True, of=('self',)).exclude(
+                    store__in=moving).filter(date_sent=None, 
+                    send_at__lte=now).select_related('customer').order_by(
+                    'send_at').first()
+            if notification is None:
+                break
+            cellphone = notification.customer.cellphone
+            if cellphone in suppression:
+                notification.is_suppressed = True
+            else:
+                try:
+                    # The SMS recipient.
+                    notification.message_id = sending_sms_aws(
+                            f"+{cellphone}", notification.message)
+                    apply_activations(notification)
+                    sent += 1
+                except Exception as error:
+                    if not is_permanent_failure(error):
+                        # Note: the notification stays queued.
+                        logger.warning("Notification delivery stopped: %s", 
+                                error)
+                        break
+                    suppress(cellphone, SuppressionReason.PERMANENT_FAILURE)
+                    suppression.add(cellphone)
+                    notification.is_suppressed = True
+            notification.date_sent = timezone.now()
+            notification.save(update_fields=['date_sent', 'is_suppressed', 
+                    'message_id'])
+    return sent
+
+
+def apply_activations(notification, today=None):
+    """
+    Apply the activation state transitions of a sent notification (see 
+    'Notification.activations'): the coupons of the first step become valid, 
+    and the coupons of the last step complete their activation cycle. The 
+    coupons redeemed or expired since the plan are skipped. Returns the number
+    of changed coupons.
+    """
+    if today is None:
+        today = date.today()
+    steps = dict(notification.activations)
+    # The coupon events, by type (see 'CouponEvent').
+    events = {CouponEventType.VALIDATED : [], CouponEventType.ACTIVATED : []}
+    for coupon in Coupon.objects.select_for_update().filter(id__in=steps,
+            expiration_date__gte=today):
+        if (steps[coupon.id] == 1) and (coupon.state == CouponState.PENDING):
+            # Makes the coupon applicable.
+            coupon.transition_to(CouponState.VALID)
+            event = CouponEventType.VALIDATED
+        elif (steps[coupon.id] == 4) and (coupon.state == CouponState.VALID):
+            # At the end, update the coupon status.
+            coupon.transition_to(CouponState.ACTIVATED)
+            event = CouponEventType.ACTIVATED
+        else:
+            continue
+        coupon.save(update_fields=['state'])
+        events[event].append((coupon.id, coupon.store_id))
+    changed = sum(len(coupons) for coupons in events.values())
+    if changed:
+        # Invalidates the cached store fragments, and adds the new valid 
+        # coupons to the customer wallet.
+        bump_data_version(notification.store_id)
+        refresh_wallets([notification.customer_id])
+        for event, coupons in events.items():
+            CouponEvent.objects.record(event, coupons)
+    return changed
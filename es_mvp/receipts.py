@@ -0,0 +1,154 @@
+"""
+Import the delivery receipts of the SMS provider.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+from .models import DeliveryStatus, Notification, SuppressionReason
+from .sharding import store_db, use_shard, moving_stores
+from .sms import is_permanent_response
+from .suppression import suppress
+from collections import namedtuple
+from datetime import datetime
+from itertools import islice
+from zoneinfo import ZoneInfo
+import json
+
+### Delivery receipts
+#
+# The SMS provider (AWS SNS) logs a delivery status record per sent message. 
+# The records are exported as JSON lines, ex.:
+# {"notification": {"messageId": "...",
+#                   "timestamp": "2026-10-19 14:02:11.503"},
+#  "delivery": {"destination": "+5511...", "providerResponse": "..."},
+#  "status": "SUCCESS"}
+# The importer streams the records in batches (see 
+# 'DELIVERY_RECEIPT_BATCH_SIZE' in the app settings.py), and updates the 
+# notifications of each batch in bulk (see 'Notification.message_id'). A 
+# message id does not tell its store, so each batch is looked up in every 
+# shard. The import is idempotent: a notification keeps its latest receipt.
+# A permanent failure also suppresses its cellphone (see 
+# 'es_mvp/suppression.py'). The notifications of the stores moving between 
+# shards are not updated (import the file again after the move).
+#
+###
+
+# A parsed delivery receipt.
+Receipt = namedtuple('Receipt', ['message_id', 'status', 'timestamp', 
+        'cellphone', 'provider_response'])
+# The receipt statuses of the provider.
+RECEIPT_STATUSES = {
+    'SUCCESS' : DeliveryStatus.DELIVERED,
+    'FAILURE' : DeliveryStatus.FAILED,
+    }
+
+
+def parse_receipt(line):
+    """Parse a delivery receipt (a JSON line). Returns a 'Receipt' or None."""
+    try:
+        record = json.loads(line)
+        timestamp = datetime.fromisoformat(record['notification']['timestamp'])
+        receipt = Receipt(record['notification']['messageId'], 
+                RECEIPT_STATUSES[record['status']],
+                timestamp if timezone.is_aware(timestamp) else 
+                timezone.make_aware(timestamp, ZoneInfo('UTC')),
+                record.get('delivery', {}).get('destination', '').lstrip('+'),
+                record.get('delivery', {}).get('providerResponse', ''))
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return None
+    return receipt
+
+
+def apply_receipts(receipts, moving=()):
+    """
+    Update the notifications of a batch of receipts, in the current shard, but
+    those of the 'moving' stores. Returns the number of updated notifications.
+    """
+    with transaction.atomic(using=store_db()):
+        notifications = list(Notification.objects.select_for_update().exclude(
+                store__in=moving).filter(message_id__in=receipts).only(
+                'id', 'message_id', 'delivery_status', 'date_delivered'))
+        updated = []
+        for notification in notifications:
+            receipt = receipts[notification.message_id]
+            # Skips a repeated or an older receipt.
+            if (notification.date_delivered is not None) and (
+                    notification.date_delivered >= receipt.timestamp):
+                continue
+            notification.delivery_status = receipt.status
+            notification.date_delivered = receipt.timestamp
+            updated.append(notification)
+        Notification.objects.bulk_update(updated, ['delivery_status', 
+                'date_delivered'])
+    return len(updated)
+
+
+def import_receipts(lines, batch_size=None):
+    """
+    Import the delivery receipts of an iterable of JSON lines (ex. an open 
+    file), streaming them in batches. Returns a dict of counts: the read, 
+    invalid and updated receipts, and the suppressed cellphones.
+    """
+    if batch_size is None:
+        batch_size = settings.DELIVERY_RECEIPT_BATCH_SIZE
+    counts = {'receipts' : 0, 'invalid' : 0, 'updated' : 0, 'suppressed' : 0}
+    moving = moving_stores()
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, batch_size))
+        if not batch:
+            return counts
+        # The latest receipt of each message.
+        receipts = {}
+        for line in batch:
+            if not line.strip():
+                continue
+            counts['receipts'] += 1
+            receipt = parse_receipt(line)
+            if receipt is None:
+                counts['invalid'] += 1
+                continue
+            latest = receipts.get(receipt.message_id)
+            if (latest is None) or (latest.timestamp <= receipt.timestamp):
+                receipts[receipt.message_id] = receipt
+        if not receipts:
+            continue
+        for alias in settings.SHARD_DATABASES:
+            with use_shard(alias):
+                counts['updated'] += apply_receipts(receipts, moving)
+        for receipt in receipts.values():
+            if ((receipt.status == DeliveryStatus.FAILED) and 
+                    receipt.cellphone and 
+                    is_permanent_response(receipt.provider_response) and 
+                    suppress(receipt.cellphone, 
+                    SuppressionReason.PERMANENT_FAILURE)):
+                counts['suppressed'] += 1
+
+
+def delivery_rates(store=None, since=None):
+    """
+    Return the delivery rates of the sent notifications, by store and campaign
+    (None for the digests of many campaigns), in the current shard. A list of 
+    dicts with the 'sent', 'delivered', 'failed' and 'pending' counts and the 
+    'delivery_rate' (over the receipts). Without 'since', a grouped scan of an
+    index (see 'notification_delivery_idx').
+    """
+    notifications = Notification.objects.exclude(message_id='')
+    if store is not None:
+        notifications = notifications.filter(store=store)
+    if since is not None:
+        notifications = notifications.filter(date_sent__gte=since)
+    rates = list(notifications.values('store', 'campaign').annotate(
+            sent=Count('id'), 
+            delivered=Count('id', filter=Q(
+                    delivery_status=DeliveryStatus.DELIVERED)),
+            failed=Count('id', filter=Q(
+                    delivery_status=DeliveryStatus.FAILED))).order_by(
+            'store', 'campaign'))
+    for rate in rates:
+        rate['pending'] = rate['sent'] - rate['delivered'] - rate['failed']
+        receipts = rate['delivered'] + rate['failed']
+        rate['delivery_rate'] = (rate['delivered'] / receipts 
+                if receipts else None)
+    return rates
@@ -0,0 +1,213 @@
+"""
+Implement the database routing of the app: the store shards and the read
+replica.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from .sharding import current_shard, is_sharded, is_store_model
+import logging
+import time
+
+### Read replica
+#
+# The read-only views (the dashboards and the lists) and the job scans opt in
+# to read from the replica (see 'read_replica()' and 'replica_reads()'). All
+# other reads, and every write, go to the primary ('default') database.
+# Read-your-writes: once a request (or a job) writes, its later reads go to the
+# primary. The store session keeps reading from the primary for a while after
+# its last write (see 'ReplicaPinningMiddleware' in 'es_mvp/middleware.py').
+# The replica lag is checked periodically: a lagging or unreachable replica is
+# skipped until it catches up.
+# Without a replica database (see 'REPLICA_DATABASE' in the app settings.py),
+# everything goes to the primary.
+# With many store shards, each shard is a primary with its own replica (see 
+# 'SHARD_REPLICAS'), and the store rows are read from the replica of their 
+# shard (see 'ShardRouter').
+#
+###
+
+# The routing state of the current request or job: a dict with the keys
+# 'replica' (the reads can go to the replica), 'pinned' (the reads must go to
+# the primary) and 'wrote' (something was written).
+routing_state = ContextVar('routing_state', default=None)
+# The last lag check of each replica: alias -> (monotonic time, healthy).
+lag_checks = {}
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def routing(pinned=False):
+    """Track the routing state of a request or job within the block."""
+    state = {'replica' : False, 'pinned' : pinned, 'wrote' : False}
+    token = routing_state.set(state)
+    try:
+        yield state
+    finally:
+        routing_state.reset(token)
+
+
+@contextmanager
+def read_replica():
+    """Read from the replica (if healthy) within the block."""
+    state = routing_state.get()
+    if state is None:
+        with routing(), read_replica() as state:
+            yield state
+        return
+    replica = state['replica']
+    state['replica'] = True
+    try:
+        yield state
+    finally:
+        state['replica'] = replica
+
+
+def replica_reads(view):
+    """Decorate a read-only view, so its reads can go to the replica."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        with read_replica():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def replica_lag(alias):
+    """
+    Return the replica lag, in seconds. A replica that has replayed all the
+    received changes has no lag (even if the primary is idle).
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT CASE WHEN NOT pg_is_in_recovery() OR "
+                "pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM now() - "
+                "pg_last_xact_replay_timestamp()) END")
+        return float(cursor.fetchone()[0] or 0.0)
+
+
+def replica_of(primary):
+    """Return the replica alias of a primary database (or shard), or None."""
+    if primary == DEFAULT_DB_ALIAS:
+        return settings.REPLICA_DATABASE
+    return settings.SHARD_REPLICAS.get(primary)
+
+
+def primary_of(alias):
+    """Return the primary database of an alias (itself, if not a replica)."""
+    if alias == settings.REPLICA_DATABASE:
+        return DEFAULT_DB_ALIAS
+    for primary, replica in settings.SHARD_REPLICAS.items():
+        if alias == replica:
+            return primary
+    return alias
+
+
+def healthy_replica(primary=DEFAULT_DB_ALIAS):
+    """
+    Return the replica alias of a primary database, or None if there is none or
+    it lags.
+    """
+    alias = replica_of(primary)
+    if alias not in connections.databases:
+        return None
+    checked_at, healthy = lag_checks.get(alias, (None, False))
+    now = time.monotonic()
+    if (checked_at is None) or (now - checked_at >
+            settings.REPLICA_LAG_CHECK_INTERVAL):
+        try:
+            lag = replica_lag(alias)
+        except DatabaseError:
+            logger.exception("Replica %s lag check failed.", alias)
+            lag = None
+        healthy = (lag is not None) and (lag <= settings.REPLICA_MAX_LAG)
+        if not healthy:
+            logger.warning("Replica %s skipped (lag: %s s).", alias, lag)
+        lag_checks[alias] = (now, healthy)
+    return alias if healthy else None
+
+
+def read_db(primary):
+    """
+    Return the database of a read: the replica of the primary, if the current
+    request or job opted in (and is not pinned), or else the primary.
+    """
+    state = routing_state.get()
+    if (state is None) or (not state['replica']) or state['pinned']:
+        return primary
+    return healthy_replica(primary) or primary
+
+
+def record_write(model):
+    """Record a write of the current request or job (pinning its reads)."""
+    state = routing_state.get()
+    # Note: the session writes do not pin the reads.
+    if (state is not None) and (model._meta.app_label != 'sessions'):
+        state['wrote'] = state['pinned'] = True
+
+
+class ReplicaRouter:
+    """Route the opted-in reads to the replica, and the rest to the primary."""
+
+    def db_for_read(self, model, **hints):
+        return read_db(DEFAULT_DB_ALIAS)
+
+    def db_for_write(self, model, **hints):
+        record_write(model)
+        # Note: a row read from the replica is saved to the primary too.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary.
+        databases = {DEFAULT_DB_ALIAS, settings.REPLICA_DATABASE}
+        if {obj1._state.db, obj2._state.db} <= databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas are migrated by the replication itself.
+        if primary_of(db) != db:
+            return False
+        return None
+
+
+class ShardRouter:
+    """
+    Route the store rows to the shard of the current store or job (see
+    'es_mvp/sharding.py'), and the opted-in reads to the shard replica. The 
+    other rows are left to the next routers.
+    """
+
+    def db_for_model(self, model, instance=None):
+        if not (is_sharded() and is_store_model(model)):
+            return None
+        # A related store row stays in the shard of its instance.
+        if (instance is not None) and is_store_model(instance.__class__) and (
+                primary_of(instance._state.db) in settings.SHARD_DATABASES):
+            return primary_of(instance._state.db)
+        return current_shard.get()
+
+    def db_for_read(self, model, **hints):
+        shard = self.db_for_model(model, hints.get('instance'))
+        return read_db(shard) if shard else None
+
+    def db_for_write(self, model, **hints):
+        shard = self.db_for_model(model, hints.get('instance'))
+        if shard:
+            record_write(model)
+        return shard
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not (is_store_model(obj1.__class__) and
+                is_store_model(obj2.__class__)):
+            # Note: every shard holds a copy of its stores ('auth_user').
+            return True if is_sharded() else None
+        if primary_of(obj1._state.db) in settings.SHARD_DATABASES:
+            return primary_of(obj1._state.db) == primary_of(obj2._state.db)
+        return None
+
@@ -0,0 +1,233 @@
+"""
+Implement a cluster-safe scheduler for the periodic tasks (see 'es_mvp/cron.py').
+"""
+from django.conf import settings
+from django.db import connection
+from django.db.models import F
+from django.utils import timezone
+from .models import ScheduledTask
+from datetime import timedelta
+import logging
+import os
+import socket
+import time
+import traceback
+
+### Scheduler
+#
+# The tasks are registered with a cron expression (minute, hour, day of month,
+# month and day of week), evaluated in the project timezone ('TIME_ZONE'):
+#
+#   @register('0 3 * * *')
+#   def some_task(): ...
+#
+# Every app node can run the scheduler service (command: 'python manage.py
+# runscheduler'). A single node is elected as leader with a database advisory
+# lock (PostgreSQL), and only the leader runs the tasks. If the leader dies, its
+# lock is released with its connection and another node takes over.
+# Each run claims its schedule slot with a conditional update of the task state
+# ('ScheduledTask'), so a slot is never run twice. The slots missed while no
+# node was running (up to 'SCHEDULER_CATCHUP_MINUTES') are caught up in a
+# single run.
+#
+###
+
+# The registered tasks: name -> (cron expression, function).
+tasks = {}
+# The advisory lock key of the scheduler leader.
+LEADER_LOCK_KEY = 0x65735f6d7670
+
+logger = logging.getLogger(__name__)
+
+
+def register(schedule):
+    """Register a function as a scheduled task, with a cron expression."""
+    cron_fields(schedule)
+    def decorator(function):
+        tasks[function.__name__] = (schedule, function)
+        return function
+    return decorator
+
+
+def discover_tasks():
+    """Import the tasks module, so its tasks are registered."""
+    from . import cron
+    return tasks
+
+
+def cron_field(expression, minimum, maximum):
+    """
+    Parse a cron expression field (ex. '*', '5', '1-5', '*/15', '5/15' or 
+    '0,30') into a set of values.
+    """
+    values = set()
+    for part in expression.split(','):
+        part, step = (part.split('/') + [None])[:2]
+        if part == '*':
+            start, end = minimum, maximum
+        elif '-' in part:
+            start, end = (int(value) for value in part.split('-'))
+        else:
+            start = end = int(part)
+            # Note: a single value with a step runs up to the maximum (ex. 
+            # '5/15' is 5, 20, 35 and 50, as in crontab).
+            if step is not None:
+                end = maximum
+        step = int(step or 1)
+        if (start < minimum) or (end > maximum) or (step < 1):
+            raise ValueError(f"Invalid cron field: {expression}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def cron_fields(schedule):
+    """Parse a cron expression. Returns a tuple of sets of values."""
+    fields = schedule.split()
+    if len(fields) != 5:
+        raise ValueError(f"Invalid cron expression: {schedule}")
+    minutes, hours, days, months, weekdays = (cron_field(field, minimum,
+            maximum) for field, (minimum, maximum) in zip(fields,
+            ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))))
+    # Note: both 0 and 7 are sunday.
+    if 7 in weekdays:
+        weekdays = (weekdays - {7}) | {0}
+    # Note: if both the day of month and the day of week are restricted, a day
+    # matching any of them matches (as in crontab). A field starting with '*' 
+    # (ex. '*/2') is not restricted.
+    restricted = (not fields[2].startswith('*'), 
+            not fields[4].startswith('*'))
+    return minutes, hours, days, months, weekdays, restricted
+
+
+def cron_matches(fields, moment):
+    """
+    Check if a moment (a local datetime) matches a parsed cron expression (see
+    'cron_fields()').
+    """
+    minutes, hours, days, months, weekdays, restricted = fields
+    # Note: in cron, 0 is sunday. In Python, 0 is monday.
+    day_matches = moment.day in days
+    weekday_matches = ((moment.weekday() + 1) % 7) in weekdays
+    if all(restricted):
+        day_matches = day_matches or weekday_matches
+    else:
+        day_matches = day_matches and weekday_matches
+    return ((moment.minute in minutes) and (moment.hour in hours) and
+            (moment.month in months) and day_matches)
+
+
+def due_slot(schedule, last_slot, now):
+    """
+    Return the latest schedule slot after the last run slot and up to now, or
+    None. Older slots than the catch-up window are ignored.
+    """
+    fields = cron_fields(schedule)
+    now = timezone.localtime(now).replace(second=0, microsecond=0)
+    oldest = now - timedelta(minutes=settings.SCHEDULER_CATCHUP_MINUTES)
+    moment = now
+    last_slot = timezone.localtime(last_slot)
+    while (moment > last_slot) and (moment >= oldest):
+        if cron_matches(fields, moment):
+            return moment
+        moment -= timedelta(minutes=1)
+    return None
+
+
+def try_leadership(is_leader):
+    """
+    Try to take (or keep) the scheduler leadership, with a session level
+    advisory lock. Other databases than PostgreSQL (ex. the SQLite development
+    database) do not support advisory locks, so the node is always the leader.
+    """
+    if connection.vendor != 'postgresql':
+        return True
+    with connection.cursor() as cursor:
+        if is_leader:
+            # Checks that the lock was not lost with a reconnection.
+            cursor.execute("SELECT count(*) FROM pg_locks WHERE "
+                    "locktype = 'advisory' AND pid = pg_backend_pid() AND "
+                    "((classid::bigint << 32) | objid::bigint) = %s",
+                    [LEADER_LOCK_KEY])
+        else:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)",
+                    [LEADER_LOCK_KEY])
+        return bool(cursor.fetchone()[0])
+
+
+def run_task(name, slot=None):
+    """
+    Run a registered task and record its run state. If a slot is informed, the
+    run must claim it first: returns False if other node has already claimed
+    it.
+    """
+    schedule, function = tasks[name]
+    task, created = ScheduledTask.objects.get_or_create(name=name,
+            defaults={'schedule' : schedule, 'last_slot' : timezone.now()})
+    if slot is not None:
+        claimed = ScheduledTask.objects.filter(id=task.id,
+                last_slot__lt=slot).update(last_slot=slot, schedule=schedule)
+        if not claimed:
+            return False
+    ScheduledTask.objects.filter(id=task.id).update(
+            last_started=timezone.now(), last_status='running',
+            node=f"{socket.gethostname()}:{os.getpid()}")
+    try:
+        function()
+    except Exception:
+        logger.exception("Scheduled task %s failed.", name)
+        ScheduledTask.objects.filter(id=task.id).update(
+                last_finished=timezone.now(), last_status='failed',
+                last_error=traceback.format_exc(), runs=F('runs') + 1)
+    else:
+        ScheduledTask.objects.filter(id=task.id).update(
+                last_finished=timezone.now(), last_status='success',
+                last_error='', runs=F('runs') + 1)
+    return True
+
+
+def run_pending(now=None):
+    """
+    Run the tasks with a due schedule slot. Returns the names of the tasks run.
+    """
+    if now is None:
+        now = timezone.now()
+    states = {task.name : task for task in ScheduledTask.objects.filter(
+            name__in=tasks.keys())}
+    ran = []
+    for name, (schedule, function) in tasks.items():
+        if name not in states:
+            # A new task starts from now, without catching up.
+            ScheduledTask.objects.get_or_create(name=name,
+                    defaults={'schedule' : schedule, 'last_slot' : now})
+            continue
+        slot = due_slot(schedule, states[name].last_slot, now)
+        if (slot is not None) and run_task(name, slot):
+            ran.append(name)
+    return ran
+
+
+def run_forever(interval=None):
+    """
+    Run the scheduler service: every interval (in seconds), tries to be the
+    leader and, if so, runs the pending tasks.
+    """
+    if interval is None:
+        interval = settings.SCHEDULER_INTERVAL
+    discover_tasks()
+    is_leader = False
+    while True:
+        try:
+            leader = try_leadership(is_leader)
+            if leader != is_leader:
+                logger.info("Scheduler leadership %s.",
+                        "taken" if leader else "lost")
+            is_leader = leader
+            if is_leader:
+                run_pending()
+        except Exception:
+            # Note: a broken connection is discarded (and the leadership
+            # with it).
+            logger.exception("Scheduler tick failed.")
+            connection.close()
+            is_leader = False
+        time.sleep(interval)
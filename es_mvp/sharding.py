@@ -0,0 +1,259 @@
+"""
+Implement the horizontal sharding of the store data.
+"""
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import AutoField
+from .models import StoreShard
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import time
+
+### Sharding
+#
+# Every store (tenant) row is scoped by its store, and no query crosses stores.
+# Thus each store lives in a single shard database (see 'SHARD_DATABASES' in the
+# app settings.py), recorded in the directory table ('StoreShard', in the
+# 'default' database). A new store is placed by its id.
+#
+# The shard of the current store is tracked per request or job (see
+# 'use_store()' and 'ShardMiddleware' in 'es_mvp/middleware.py'), and the
+# 'ShardRouter' (see 'es_mvp/routers.py') sends the store rows there (or its
+# reads to the shard replica). The transactions over store rows must use the 
+# shard too (see 'store_db()'). The jobs run once per shard (see 
+# 'per_shard()'), skipping the stores that are moving (see 'moving_stores()').
+#
+# Every shard has the full schema (command: 'python manage.py migrate
+# --database <alias>'), and holds a copy of the rows of its stores in the
+# 'auth_user' table, for the foreign keys. The ids of each shard are taken from
+# a distinct range (see 'init_sequences()'), so a store can move between shards
+# keeping its ids (see 'move_store()'). Note: a SQLite table continues from its
+# highest id, so a store moved to a SQLite shard also moves its sequence (the
+# SQLite shards are meant for local tests).
+#
+# With a single shard (the default setup), the routing is disabled.
+#
+###
+
+# The models that are not scoped by a store.
+GLOBAL_MODELS = ('storeshard', 'scheduledtask', 'suppressedcellphone')
+# The shard of the current request or job.
+current_shard = ContextVar('current_shard', default=None)
+
+
+def is_sharded():
+    """Check if the store data is split in many shards."""
+    return len(settings.SHARD_DATABASES) > 1
+
+
+def is_store_model(model):
+    """Check if a model holds store rows."""
+    return ((model._meta.app_label == 'es_mvp') and
+            (model._meta.model_name not in GLOBAL_MODELS))
+
+
+def store_models():
+    """Return the models that hold store rows."""
+    return [model for model in apps.get_app_config('es_mvp').get_models()
+            if is_store_model(model)]
+
+
+def directory_key(store_id):
+    """Return the cache key of a store directory entry."""
+    return f"store_shard:{store_id}"
+
+
+def store_shard(store_id):
+    """
+    Return the directory entry of a store, as a tuple (shard alias, is moving).
+    A new store is placed by its id.
+    """
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS, False
+    entry = cache.get(directory_key(store_id))
+    if entry is None:
+        shards = settings.SHARD_DATABASES
+        store_shard, created = StoreShard.objects.using(
+                DEFAULT_DB_ALIAS).get_or_create(store_id=store_id,
+                defaults={'shard' : shards[store_id % len(shards)]})
+        if created:
+            copy_store_user(store_id, store_shard.shard)
+        entry = (store_shard.shard, store_shard.is_moving)
+        cache.set(directory_key(store_id), entry,
+                settings.SHARD_DIRECTORY_TIMEOUT)
+    return entry
+
+
+def store_db():
+    """
+    Return the database alias of the store rows of the current request or job
+    (ex. for 'transaction.atomic(using=store_db())').
+    """
+    return current_shard.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_shard(alias):
+    """Route the store rows to a shard within the block."""
+    token = current_shard.set(alias)
+    try:
+        yield alias
+    finally:
+        current_shard.reset(token)
+
+
+@contextmanager
+def use_store(store_id):
+    """Route the store rows to the shard of a store within the block."""
+    with use_shard(store_shard(store_id)[0]) as alias:
+        yield alias
+
+
+def per_shard(function):
+    """
+    Decorate a job to run once per shard. Returns a dict of the results by
+    shard alias.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        results = {}
+        for alias in settings.SHARD_DATABASES:
+            with use_shard(alias):
+                results[alias] = function(*args, **kwargs)
+        return results
+    return wrapper
+
+
+### Shard maintenance
+
+def copy_rows(model, source, target, **filters):
+    """
+    Copy rows between databases as they are (the ids and the 'auto_now'
+    dates are kept). Returns the number of copied rows.
+    """
+    connection = connections[target]
+    fields = model._meta.concrete_fields
+    rows = [[field.get_db_prep_save(getattr(obj, field.attname), connection)
+            for field in fields] for obj in model._base_manager.using(
+            source).filter(**filters)]
+    if rows:
+        quote = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.executemany(f"INSERT INTO {quote(model._meta.db_table)} "
+                    f"({', '.join(quote(field.column) for field in fields)}) "
+                    f"VALUES ({', '.join(['%s'] * len(fields))})", rows)
+    return len(rows)
+
+
+def copy_store_user(store_id, alias):
+    """Copy the store row of 'auth_user' to a shard, if missing."""
+    if (alias != DEFAULT_DB_ALIAS) and not User.objects.using(alias).filter(
+            id=store_id).exists():
+        copy_rows(User, DEFAULT_DB_ALIAS, alias, id=store_id)
+
+
+def init_sequences(alias):
+    """
+    Start the id sequences of a shard at its own range (the shard index times
+    'SHARD_ID_RANGE'), so the ids never collide between shards.
+    """
+    start = settings.SHARD_DATABASES.index(alias) * settings.SHARD_ID_RANGE
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        for model in store_models():
+            if not isinstance(model._meta.pk, AutoField):
+                continue
+            table = model._meta.db_table
+            cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM "
+                    f"{connection.ops.quote_name(table)}")
+            value = max(start, cursor.fetchone()[0])
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT setval(pg_get_serial_sequence(%s, "
+                        "'id'), %s)", [table, max(value, 1)])
+            elif connection.vendor == 'sqlite':
+                cursor.execute("DELETE FROM sqlite_sequence WHERE name = %s",
+                        [table])
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) "
+                        "VALUES (%s, %s)", [table, value])
+
+
+def moving_stores():
+    """
+    Return the ids of the stores moving between shards, read from the 
+    directory table (not cached). The jobs skip their rows (see 'es_mvp/
+    cron.py'), as the requests do (see 'ShardMiddleware').
+    """
+    if not is_sharded():
+        return []
+    return list(StoreShard.objects.using(DEFAULT_DB_ALIAS).filter(
+            is_moving=True).values_list('store', flat=True))
+
+
+def directory_delay():
+    """
+    Return how long, in seconds, an app process may keep routing a store by an
+    outdated directory entry. The entries of a shared cache are deleted at once
+    (see 'set_moving()'), but a per-process cache (ex. 'LocMemCache') keeps 
+    them until they expire.
+    """
+    if settings.CACHES['default']['BACKEND'].endswith('.LocMemCache'):
+        return settings.SHARD_DIRECTORY_TIMEOUT
+    return 0
+
+
+def set_moving(store_id, is_moving):
+    """Pause (or resume) the writes of a store, while it moves."""
+    StoreShard.objects.using(DEFAULT_DB_ALIAS).filter(store=store_id).update(
+            is_moving=is_moving)
+    cache.delete(directory_key(store_id))
+
+
+def move_store(store_id, target, grace=None):
+    """
+    Move a store to another shard. The store stays readable, and its writes
+    are paused during the copy (plus a grace period for the requests and job 
+    runs in flight). Returns a dict of the copied rows by model name.
+    Note: without a shared cache, the move also waits for the outdated 
+    directory entries of the other processes to expire (see 
+    'directory_delay()'), before the copy and before the source is purged.
+    """
+    source = store_shard(store_id)[0]
+    if target == source:
+        return {}
+    if grace is None:
+        grace = settings.SHARD_MOVE_GRACE
+    delay = directory_delay()
+    set_moving(store_id, True)
+    try:
+        time.sleep(grace + delay)
+        copied = {}
+        copy_store_user(store_id, target)
+        # Note: the foreign keys are checked at the end of the transaction,
+        # so the copy order does not matter.
+        with transaction.atomic(using=target):
+            for model in store_models():
+                copied[model.__name__] = copy_rows(model, source, target,
+                        store=store_id)
+        StoreShard.objects.using(DEFAULT_DB_ALIAS).filter(
+                store=store_id).update(shard=target)
+    finally:
+        set_moving(store_id, False)
+    # The processes that still route the store to the source read from it.
+    time.sleep(delay)
+    purge_store(store_id, source)
+    return copied
+
+
+def purge_store(store_id, alias):
+    """Delete the rows of a store from a shard (ex. after moving it)."""
+    connection = connections[alias]
+    with transaction.atomic(using=alias), connection.cursor() as cursor:
+        for model in store_models():
+            cursor.execute(f"DELETE FROM "
+                    f"{connection.ops.quote_name(model._meta.db_table)} WHERE "
+                    f"{connection.ops.quote_name('store_id')} = %s",
+                    [store_id])
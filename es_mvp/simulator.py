@@ -0,0 +1,147 @@
+"""
+Implement a campaign "what-if" simulator over the historical sales of a store.
+"""
+from .models import Sale, ArchivedSale
+import numpy as np
+
+
+# The campaign parameters that can be simulated.
+PARAMETERS = ('min_sale_value', 'max_sale_value', 'bonus_rate',
+        'discount_limit_rate', 'coupon_lifetime')
+# A coupon becomes valid from the first activation message (~2 days from the
+# issuance). See 'coupon_activation_task' in 'es_mvp/cron.py'.
+VALIDITY_DELAY_DAYS = 2
+# Maximum number of (combination, sale) cells evaluated at once. It bounds the
+# memory used by the simulation of large grids.
+CHUNK_CELLS = 2_000_000
+
+
+def coupon_discount_values(sale_final_values, campaign_bonus_rates):
+    """
+    Vectorized version of 'coupon_discount_value()' (see 'es_mvp/views.py').
+    """
+    return np.ceil(sale_final_values * (campaign_bonus_rates / 100))
+
+
+def sale_effective_discounts(sale_initial_values, coupon_discount_values,
+        coupon_discount_limit_rates):
+    """
+    Vectorized version of 'sale_effective_discount()' (see 'es_mvp/views.py').
+    """
+    max_discounts = np.ceil(
+            sale_initial_values * (coupon_discount_limit_rates / 100.0))
+    return np.minimum(coupon_discount_values, max_discounts)
+
+
+def load_sales_history(store_id):
+    """
+    Load the live and archived sales of a store into columnar arrays.
+    For each sale, it also locates the next sale of the same customer from the
+    day its coupon would become valid: the gap in days ('next_gap', or -1 if
+    there is not a next sale) and its initial value ('next_initial_value').
+    These arrays support the replay of coupon redemptions.
+    """
+    fields = ('customer', 'date', 'initial_value', 'final_value')
+    rows = (list(Sale.objects.filter(store=store_id).values_list(*fields)) +
+            list(ArchivedSale.objects.filter(
+                    store=store_id).values_list(*fields)))
+    if rows:
+        customers, dates, initial_values, final_values = zip(*rows)
+    else:
+        customers, dates, initial_values, final_values = (), (), (), ()
+    customers = np.array(customers, dtype=np.int64)
+    days = np.array([sale_date.toordinal() for sale_date in dates],
+            dtype=np.int64)
+    initial_values = np.array(initial_values, dtype=np.float64)
+    final_values = np.array(final_values, dtype=np.float64)
+    # Sorts the sales by customer and date. Thus, a composite (customer, day)
+    # key allows to find the next sale of each customer with a binary search.
+    order = np.lexsort((days, customers))
+    customers, days = customers[order], days[order]
+    initial_values, final_values = initial_values[order], final_values[order]
+    # Note: the day ordinal is lower than 10^7.
+    keys = customers * 10_000_000 + days
+    next_index = np.searchsorted(keys, keys + VALIDITY_DELAY_DAYS)
+    found = next_index < len(keys)
+    next_index = np.where(found, next_index, 0)
+    found &= customers[next_index] == customers
+    next_gap = np.where(found, days[next_index] - days, -1)
+    next_initial_value = np.where(found, initial_values[next_index], 0.0)
+    return {
+        'final_value' : final_values,
+        'next_gap' : next_gap,
+        'next_initial_value' : next_initial_value,
+        }
+
+
+def campaign_grid(**parameters):
+    """
+    Build the cartesian grid of candidate campaign parameters. Each keyword
+    argument is a list of values for a parameter (see 'PARAMETERS'). Returns a
+    dict of flat arrays, one item per combination.
+    """
+    axes = np.meshgrid(*[np.asarray(parameters[name], dtype=np.float64)
+            for name in PARAMETERS], indexing='ij')
+    return {name : axis.ravel() for name, axis in zip(PARAMETERS, axes)}
+
+
+def simulate_campaigns(history, grid):
+    """
+    Replay the historical sales against each combination of the grid.
+    For each combination, it projects: the coupons issued, the cashback
+    liability (the sum of the coupon face values), the expected redemptions and
+    the expected discount. Redemptions are estimated by the historical customer
+    behavior: a coupon is redeemed on the next sale of the same customer, if it
+    happens before the coupon expiration.
+    Note: the simulation considers a single campaign, without the competition
+    of other active campaigns.
+    """
+    final_values = history['final_value'][np.newaxis, :]
+    next_gap = history['next_gap'][np.newaxis, :]
+    next_initial_values = history['next_initial_value'][np.newaxis, :]
+    combinations = len(grid['bonus_rate'])
+    results = {
+        'coupons_issued' : np.zeros(combinations, dtype=np.int64),
+        'cashback_liability' : np.zeros(combinations),
+        'expected_redemptions' : np.zeros(combinations, dtype=np.int64),
+        'expected_discount' : np.zeros(combinations),
+        }
+    chunk = max(1, CHUNK_CELLS // max(1, final_values.shape[1]))
+    for start in range(0, combinations, chunk):
+        part = slice(start, start + chunk)
+        column = lambda name: grid[name][part, np.newaxis]
+        eligible = ((final_values >= column('min_sale_value')) &
+                (final_values <= column('max_sale_value')))
+        coupon_values = coupon_discount_values(final_values,
+                column('bonus_rate'))
+        redeemed = eligible & (next_gap >= 0) & (
+                next_gap <= column('coupon_lifetime'))
+        discounts = sale_effective_discounts(next_initial_values,
+                coupon_values, column('discount_limit_rate'))
+        results['coupons_issued'][part] = eligible.sum(axis=1)
+        results['cashback_liability'][part] = np.where(
+                eligible, coupon_values, 0.0).sum(axis=1)
+        results['expected_redemptions'][part] = redeemed.sum(axis=1)
+        results['expected_discount'][part] = np.where(
+                redeemed, discounts, 0.0).sum(axis=1)
+    return results
+
+
+def simulation_rows(grid, results):
+    """
+    Convert the grid and its simulation results to a list of dicts (one per
+    combination), ready to render or to serialize as JSON.
+    """
+    rows = []
+    for index in range(len(grid['bonus_rate'])):
+        row = {name : float(grid[name][index]) for name in PARAMETERS}
+        row.update({name : values[index].item()
+                for name, values in results.items()})
+        try:
+            # Handles zero division.
+            row['redemption_rate'] = (row['expected_redemptions'] /
+                    row['coupons_issued'])
+        except ZeroDivisionError:
+            row['redemption_rate'] = None
+        rows.append(row)
+    return rows
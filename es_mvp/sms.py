@@ -1,8 +1,12 @@
 """
 Implement SMS sending solution.
 """
-import boto3 # AWS Python CLI
+from django.conf import settings
+from collections import namedtuple
+from functools import lru_cache
+from math import ceil
 import os
+import unicodedata
 
 ### AWS SES / Pinpoint 
 
@@ -19,12 +23,7 @@ import os
 def sending_sms_aws(cellphone, message):
     """Send a SMS message to a recipient"""
     # Create an SNS client
-    client = boto3.client(
-        "sns",
-        aws_access_key_id=os.getenv("SENDER_SMS_AWS_ACCESS_KEY_ID"),
-        aws_secret_access_key=os.getenv("SENDER_SMS_AWS_SECRET_ACCESS_KEY"),
-        region_name="us-east-1"
-    )
+    client = sns_client()
 
     # Send your sms message.
     response = client.publish(
@@ -32,4 +31,188 @@ def sending_sms_aws(cellphone, message):
         Message=message,
     )
     ## TO-DO: to implement the log of this service execution
-    return response['MessageId']
\ No newline at end of file
+    return response['MessageId']
+
+
+@lru_cache(maxsize=None)
+def sns_client():
+    """
+    Create an SNS client, once per process. Note: boto3 is imported on the
+    first SMS, so the processes that send none start faster.
+    """
+    import boto3 # AWS Python CLI
+    return boto3.client(
+        "sns",
+        aws_access_key_id=os.getenv("SENDER_SMS_AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("SENDER_SMS_AWS_SECRET_ACCESS_KEY"),
+        region_name="us-east-1"
+    )
+
+
+# The provider errors that will never succeed for a recipient (ex. an invalid
+# number).
+PERMANENT_ERRORS = ('InvalidParameter',)
+
+
+def is_permanent_failure(error):
+    """Check if a sending error is permanent for its recipient."""
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in PERMANENT_ERRORS
+
+
+# The provider responses, in a delivery receipt, of a failure that will never
+# succeed for a recipient.
+PERMANENT_RESPONSES = ('invalid phone number', 'opted out')
+
+
+def is_permanent_response(provider_response):
+    """Check if the provider response of a failed delivery is permanent."""
+    provider_response = provider_response.lower()
+    return any(response in provider_response 
+            for response in PERMANENT_RESPONSES)
+
+
+def opted_out_cellphones():
+    """
+    Return the cellphones (without '+') that opted out at the SMS provider, by
+    replying STOP. A generator.
+    """
+    client = sns_client()
+    next_token = ''
+    while True:
+        response = client.list_phone_numbers_opted_out(nextToken=next_token)
+        for phone_number in response['phoneNumbers']:
+            yield phone_number.lstrip('+')
+        next_token = response.get('nextToken')
+        if not next_token:
+            return
+
+
+### SMS message compiler
+#
+# A SMS is billed by segments. A GSM-7 message fits 160 characters in a single
+# segment (153 per segment when concatenated), but a single character out of 
+# the GSM-7 alphabet (ex. 'ã', 'ç' or a curly quote) switches the whole message
+# to UCS-2, which fits only 70 characters (67 when concatenated). 
+# See: https://en.wikipedia.org/wiki/GSM_03.38
+#
+###
+
+# The GSM-7 basic alphabet (the escape character excluded).
+GSM7_BASIC = set("@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;"
+        "<=>?¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà")
+# The GSM-7 extension table. Each character takes two septets.
+GSM7_EXTENDED = set("^{}\\[~]|€\f")
+# Replacements for common characters out of the GSM-7 alphabet. Other 
+# characters lose their accents (see 'sms_transliterate()').
+GSM7_REPLACEMENTS = {
+    "‘" : "'", "’" : "'", "“" : '"', "”" : '"', "–" : "-", "—" : "-", 
+    "…" : "...", "«" : '"', "»" : '"', "ª" : "a", "º" : "o", "\u00a0" : " ",
+    }
+# The widest value of each variable field of a message template. Supports the 
+# worst case length of a compiled template.
+SMS_FIELD_WIDTHS = {'value' : 6, 'expiration' : 5, 'limit' : 3, 'count' : 3}
+
+# A compiled message template: a 'str.format' template with the remaining 
+# variable fields, its encoding and its worst case number of segments.
+CompiledSms = namedtuple('CompiledSms', ['template', 'encoding', 'segments'])
+
+
+def sms_encoding(message):
+    """Return the encoding required by a message: 'GSM-7' or 'UCS-2'."""
+    for char in message:
+        if (char not in GSM7_BASIC) and (char not in GSM7_EXTENDED):
+            return 'UCS-2'
+    return 'GSM-7'
+
+
+def sms_segments(message):
+    """Count the billed segments of a message. Returns (encoding, segments)."""
+    encoding = sms_encoding(message)
+    if encoding == 'GSM-7':
+        length = sum(2 if char in GSM7_EXTENDED else 1 for char in message)
+        single, multipart = 160, 153
+    else:
+        # Note: UCS-2 is counted in UTF-16 code units.
+        length = len(message.encode('utf-16-le')) // 2
+        single, multipart = 70, 67
+    if length <= single:
+        return encoding, 1
+    return encoding, ceil(length / multipart)
+
+
+def sms_transliterate(text):
+    """
+    Convert a text to the GSM-7 alphabet. Characters out of the alphabet are 
+    replaced or lose their accents (ex. 'São João' becomes 'Sao Joao'). 
+    Characters that can not be converted are replaced by '?'.
+    """
+    converted = []
+    for char in text:
+        if (char in GSM7_BASIC) or (char in GSM7_EXTENDED):
+            converted.append(char)
+        elif char in GSM7_REPLACEMENTS:
+            converted.append(GSM7_REPLACEMENTS[char])
+        else:
+            base = ''.join(part for part in unicodedata.normalize('NFKD', char)
+                    if not unicodedata.combining(part))
+            if base and all(part in GSM7_BASIC for part in base):
+                converted.append(base)
+            else:
+                converted.append('?')
+    return ''.join(converted)
+
+
+class _MissingFields(dict):
+    """Keep the missing fields of a partially rendered template."""
+    def __missing__(self, key):
+        return '{' + key + '}'
+
+
+def compile_sms_template(template, policy=None, **fields):
+    """
+    Pre-render a message template with its static fields (ex. the store title),
+    so it can be rendered once per run and reused for each recipient.
+    The encoding policy (see 'SMS_ENCODING_POLICY' in the app settings.py) 
+    tries to fit the message in a single segment: 'transliterate' converts the
+    static text to GSM-7 and then applies 'truncate'; 'truncate' shortens the 
+    'title' field as needed; and 'none' keeps the message as is.
+    Returns a 'CompiledSms'. Its 'segments' is the worst case, considering the 
+    widest values of the variable fields (see 'SMS_FIELD_WIDTHS').
+    """
+    if policy is None:
+        policy = settings.SMS_ENCODING_POLICY
+    # Note: braces in the static fields must be escaped.
+    fields = {name : str(value).replace('{', '{{').replace('}', '}}') 
+            for name, value in fields.items()}
+    compiled = template.format_map(_MissingFields(fields))
+    if policy == 'transliterate':
+        compiled = sms_transliterate(compiled)
+        fields = {name : sms_transliterate(value) 
+                for name, value in fields.items()}
+    widest = {name : '9' * width for name, width in SMS_FIELD_WIDTHS.items()}
+    encoding, segments = sms_segments(compiled.format(**widest))
+    # Shortens the title, a char at a time, until the message fits.
+    title = fields.get('title', '')
+    while (policy != 'none') and (segments > 1) and title:
+        title = title[:-1].rstrip()
+        compiled = template.format_map(_MissingFields(fields, title=title))
+        if policy == 'transliterate':
+            compiled = sms_transliterate(compiled)
+        encoding, segments = sms_segments(compiled.format(**widest))
+    return CompiledSms(compiled, encoding, segments)
+
+
+def sms_cost_report(messages):
+    """
+    Project the cost of sending a list of messages. The cost per billed 
+    segment is defined by 'SMS_SEGMENT_COST' in the app settings.py.
+    """
+    report = {'messages' : 0, 'segments' : 0, 'GSM-7' : 0, 'UCS-2' : 0}
+    for message in messages:
+        encoding, segments = sms_segments(message)
+        report['messages'] += 1
+        report['segments'] += segments
+        report[encoding] += 1
+    report['cost'] = report['segments'] * settings.SMS_SEGMENT_COST
+    return report
@@ -0,0 +1,150 @@
+"""
+Implement the suppression list of the notifications: the cellphones that opted
+out or can not receive SMS.
+"""
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from .models import SuppressedCellphone, SuppressionReason
+from .sms import opted_out_cellphones
+from math import ceil, log
+import hashlib
+import logging
+import time
+
+### Suppression list
+#
+# A cellphone is suppressed by an opt-out (the customer replied STOP, see
+# 'sync_opt_outs()') or by a permanent delivery failure (see
+# 'deliver_notifications()' in 'es_mvp/notifications.py'). The notifications
+# to a suppressed cellphone are never planned nor sent.
+# The jobs check each message against an in-memory Bloom filter of the table
+# (see 'suppression_list()'), without a query per message: a Bloom filter has
+# no false negatives, and its rare false positives are confirmed in the table.
+# The list is loaded once per process (and rebuilt every
+# 'SUPPRESSION_LIST_MAX_AGE' seconds); each job run only adds the new rows.
+#
+###
+
+logger = logging.getLogger(__name__)
+# The suppression list of the current process (see 'suppression_list()').
+loaded_list = None
+
+
+class BloomFilter:
+    """A Bloom filter of strings, sized for a capacity and error rate."""
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(1, capacity)
+        self.size = ceil(-capacity * log(error_rate) / (log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * log(2)))
+        self.bits = bytearray(ceil(self.size / 8))
+
+    def positions(self, item):
+        """Return the bit positions of an item (double hashing)."""
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + (index * second)) % self.size
+                for index in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                for position in self.positions(item))
+
+
+class SuppressionList:
+    """The suppressed cellphones, as a Bloom filter backed by the table."""
+
+    def __init__(self):
+        rows = list(SuppressedCellphone.objects.values_list('id',
+                'cellphone'))
+        # Leaves room for the rows added later (the list is rebuilt when it
+        # is full).
+        self.capacity = 2 * len(rows) + settings.SUPPRESSION_LIST_CAPACITY
+        self.filter = BloomFilter(self.capacity,
+                settings.SUPPRESSION_LIST_ERROR_RATE)
+        self.count = 0
+        self.last_id = 0
+        self.loaded_at = time.monotonic()
+        # The confirmed cellphones (the Bloom filter positives).
+        self.confirmed = {}
+        self.add_rows(rows)
+
+    def add_rows(self, rows):
+        for row_id, cellphone in rows:
+            self.filter.add(cellphone)
+            self.confirmed.pop(cellphone, None)
+            self.count += 1
+            self.last_id = max(self.last_id, row_id)
+
+    def refresh(self):
+        """
+        Add the rows suppressed since the last load or refresh. Note: a row
+        committed late, with a lower id, waits for the next rebuild.
+        """
+        self.add_rows(SuppressedCellphone.objects.filter(
+                id__gt=self.last_id).values_list('id', 'cellphone'))
+
+    def add(self, cellphone):
+        """Add a cellphone suppressed during the job run."""
+        self.filter.add(cellphone)
+        self.confirmed[cellphone] = True
+
+    def __contains__(self, cellphone):
+        if cellphone not in self.filter:
+            return False
+        # A possible member: confirms it in the table (once).
+        if cellphone not in self.confirmed:
+            self.confirmed[cellphone] = SuppressedCellphone.objects.filter(
+                    cellphone=cellphone).exists()
+        return self.confirmed[cellphone]
+
+
+def suppression_list():
+    """
+    Return the suppression list of the process, with the new rows added.
+    Called once per job run.
+    """
+    global loaded_list
+    if ((loaded_list is None) or (loaded_list.count >= loaded_list.capacity)
+            or (time.monotonic() - loaded_list.loaded_at >
+            settings.SUPPRESSION_LIST_MAX_AGE)):
+        loaded_list = SuppressionList()
+    else:
+        loaded_list.refresh()
+    return loaded_list
+
+
+def suppress(cellphone, reason):
+    """
+    Suppress a cellphone (the complete number, without '+'). Returns True if it
+    was not suppressed yet.
+    """
+    try:
+        # Note: the table lives in the 'default' database (see 
+        # 'GLOBAL_MODELS' in 'es_mvp/sharding.py').
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            SuppressedCellphone.objects.create(cellphone=cellphone,
+                    reason=reason)
+    except IntegrityError:
+        return False
+    logger.info("Cellphone %s suppressed (%s).", cellphone, reason)
+    return True
+
+
+def sync_opt_outs():
+    """
+    Suppress the cellphones that opted out at the SMS provider (the STOP
+    replies). Returns the number of new suppressions.
+    """
+    known = set(SuppressedCellphone.objects.values_list('cellphone',
+            flat=True))
+    new = [SuppressedCellphone(cellphone=cellphone,
+            reason=SuppressionReason.OPT_OUT) for cellphone in
+            set(opted_out_cellphones()) - known]
+    SuppressedCellphone.objects.bulk_create(new, ignore_conflicts=True)
+    return len(new)
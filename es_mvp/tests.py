@@ -1,3 +1,1233 @@
-from django.test import TestCase
+# To run the tests (there is no manage.py in this repository):
+# Command: python -m django test es_mvp --settings=es_mvp_project.settings
+from django.conf import settings
+from django.contrib.auth import logout
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from asgiref.sync import async_to_sync
+from django.core.cache import cache, caches
+from django.core.exceptions import ValidationError
+from django.db import connection, connections, transaction
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from .models import (Customer, Sale, Campaign, Coupon, StoreSettings,
+        ArchivedSale, ArchivedCoupon, ArchiveRollup, CouponState,
+        CouponEvent, CouponEventType, CustomerProfile, Notification,
+        SaleIdempotencyKey, StoreDataVersion, StoreShard,
+        SuppressedCellphone, SuppressionReason, DeliveryStatus)
+from .archive import archivable_rows, archive_store
+from .auth import MemoizedModelBackend, get_store_settings
+from .conditional import effective_state
+from .dashboards import (store_summary_queries, run_queries, run_in_thread,
+        gather_queries)
+from .fragments import data_version, bump_data_version, fragment_context
+from .ledger import tail_events, parse_cursor, format_cursor
+from .middleware import PRIMARY_PIN_COOKIE
+from .receipts import parse_receipt, apply_receipts, import_receipts
+from .routers import (routing, read_replica, read_db, record_write,
+        healthy_replica, lag_checks, ShardRouter, ReplicaRouter)
+from .scheduler import cron_field, cron_fields, due_slot
+from .notifications import (activation_step, plan_notifications,
+        delivery_slots, deliver_notifications)
+from .sharding import use_store, use_shard, store_db, per_shard
+from .sms import compile_sms_template, sms_segments
+from .suppression import BloomFilter, SuppressionList
+from .views import (sale_effective_discount, applicable_coupon_choices,
+        release_held_sale)
+from .wallet import rebuild_profiles, profile_data, get_profile
+from . import cron, velocity, views
+from datetime import date, datetime, time, timedelta
+from unittest import mock
+from threading import Event
+from zoneinfo import ZoneInfo
+import json
 
-# Create your tests here.
+
+### Fixtures
+
+def create_store(title='Loja', **fields):
+    """Create a store (user) with its settings, in the shard of the store."""
+    store = User.objects.create_user(f"store{User.objects.count() + 1}",
+            password='pw-123456')
+    with use_store(store.id):
+        StoreSettings.objects.create(store=store, title=title, currency='R$',
+                country_code='55', long_distance_code='11', 
+                url='http://x.com', bonus_rate=10, discount_limit_rate=50, 
+                coupon_lifetime=60, **fields)
+    return store
+
+
+def create_campaign(store, **fields):
+    """Create an active campaign, for any sale value."""
+    fields = {'title' : 'Campaign', 'min_sale_value' : 0.0,
+            'max_sale_value' : 10000.0, 'url' : 'http://x.com/c',
+            'bonus_rate' : 10, 'discount_limit_rate' : 50,
+            'coupon_lifetime' : 60, **fields}
+    return Campaign.objects.create(store=store, **fields)
+
+
+def create_sale(store, customer, value=100.0, discount=0.0, **fields):
+    """Create a sale of today."""
+    return Sale.objects.create(store=store, customer=customer,
+            initial_value=value, effective_discount=discount,
+            final_value=value - discount, date=date.today(), **fields)
+
+
+def create_coupon(sale, campaign, state=CouponState.PENDING, value=10.0,
+        expiration_date=None, days_ago=0):
+    """Create a coupon of a sale, issued 'days_ago'."""
+    coupon = Coupon.objects.create(store=sale.store, sale=sale,
+            campaign=campaign, customer=sale.customer, identifier='ABC123',
+            discount_value=value, discount_limit_rate=50, state=state,
+            expiration_date=(expiration_date or
+                    date.today() + timedelta(days=60)))
+    if days_ago:
+        Coupon.objects.filter(id=coupon.id).update(
+                date_added=timezone.now() - timedelta(days=days_ago))
+        coupon.refresh_from_db()
+    return coupon
+
+
+class StoreMixin:
+    """
+    Create a store, with a campaign and a customer. The test runs in the shard
+    of the store.
+    """
+    # Note: with local shards (see 'es_mvp/sharding.py'), the store rows may
+    # live in any of them.
+    databases = '__all__'
+
+    def setUp(self):
+        # Note: the cached store directory entries and the velocity counters
+        # outlive the test rows.
+        cache.clear()
+        caches[settings.VELOCITY_CACHE].clear()
+        self.store = create_store()
+        shard = use_store(self.store.id)
+        shard.__enter__()
+        self.addCleanup(shard.__exit__, None, None, None)
+        self.campaign = create_campaign(self.store)
+        self.customer = Customer.objects.create(store=self.store,
+                cellphone='5511987650001', is_verified=True)
+
+
+class SaleRegistrationMixin(StoreMixin):
+    """Post sales to the 'new sale' view of a store, as an API client."""
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.store)
+
+    def post_sale(self, identifier='', key=None, value='50',
+            cellphone='987650001', **fields):
+        headers = {'HTTP_ACCEPT' : 'application/json'}
+        if key:
+            headers['HTTP_IDEMPOTENCY_KEY'] = key
+        return self.client.post(reverse('es_mvp:new_sale'), {
+                'customer_country_code' : '55',
+                'customer_long_distance_code' : '11',
+                'customer_cellphone' : cellphone, 'initial_value' : value,
+                'date' : str(date.today()), 'identifier' : identifier,
+                **fields}, **headers)
+
+
+### Sale registration
+
+@mock.patch('es_mvp.views.sending_sms_aws')
+class SalePipelineTests(SaleRegistrationMixin, TestCase):
+
+    def test_new_customer_is_verified_then_registered(self, sending_sms_aws):
+        step = self.post_sale(cellphone='987650002').json()
+        self.assertEqual(step['step'], 'verify')
+        self.assertEqual(len(step['validation_code']), 4)
+        sending_sms_aws.assert_called_once()
+        done = self.post_sale(cellphone='987650002',
+                customer_verified='on').json()
+        self.assertEqual(done['step'], 'done')
+        customer = Customer.objects.get(cellphone='5511987650002')
+        self.assertTrue(customer.is_verified)
+        self.assertEqual(Sale.objects.get(id=done['sale_id']).customer,
+                customer)
+        # The validation code is sent once.
+        sending_sms_aws.assert_called_once()
+
+    def test_returning_customer_without_coupons_in_a_single_step(self,
+            sending_sms_aws):
+        done = self.post_sale().json()
+        self.assertEqual(done['step'], 'done')
+        self.assertIsNotNone(done['issued_coupon_id'])
+        sending_sms_aws.assert_not_called()
+
+    def test_returning_customer_redeems_a_coupon(self, sending_sms_aws):
+        coupon = create_coupon(create_sale(self.store, self.customer),
+                self.campaign, state=CouponState.VALID, value=10.0)
+        step = self.post_sale(value='100').json()
+        self.assertEqual(step['step'], 'redeem')
+        self.assertEqual([choice[0] for choice in step['coupon_choices']],
+                [coupon.id])
+        done = self.post_sale(value='100', redeemed_coupon=coupon.id).json()
+        self.assertEqual(done['step'], 'done')
+        sale = Sale.objects.get(id=done['sale_id'])
+        self.assertEqual((sale.effective_discount, sale.final_value),
+                (10.0, 90.0))
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.state, CouponState.REDEEMED)
+        # The pipeline is concluded: a new sale starts over.
+        self.assertEqual(self.post_sale(value='100').json()['step'], 'done')
+
+
+class IdempotentSaleTests(SaleRegistrationMixin, TestCase):
+
+    def test_retry_replays_the_registration(self):
+        first = self.post_sale(key='key-1').json()
+        retry = self.post_sale(key='key-1').json()
+        self.assertTrue(retry['replayed'])
+        self.assertEqual(retry['sale_id'], first['sale_id'])
+        self.assertEqual(retry['issued_coupon_id'], first['issued_coupon_id'])
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertEqual(Coupon.objects.count(), 1)
+
+    def test_concurrent_retry_replays_the_registration(self):
+        """
+        A retry that missed the first lookup (the registration was still in
+        flight) gets the outcome at the key claim.
+        """
+        first = self.post_sale(key='key-1').json()
+        with mock.patch.object(SaleIdempotencyKey.objects, 'filter',
+                return_value=SaleIdempotencyKey.objects.none()):
+            retry = self.post_sale(key='key-1').json()
+        self.assertTrue(retry['replayed'])
+        self.assertEqual(retry['sale_id'], first['sale_id'])
+        self.assertEqual(Sale.objects.count(), 1)
+
+    def test_distinct_keys_register_distinct_sales(self):
+        first = self.post_sale(key='key-1').json()
+        second = self.post_sale(key='key-2').json()
+        self.assertNotEqual(first['sale_id'], second['sale_id'])
+
+
+class DuplicateSaleTests(SaleRegistrationMixin, TestCase):
+
+    def test_reject(self):
+        self.post_sale(identifier='INV1')
+        response = self.post_sale(identifier='INV1')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['errors']['identifier'][0]['code'],
+                'identifier_duplicate')
+        self.assertEqual(Sale.objects.count(), 1)
+
+    @override_settings(SALE_IDENTIFIER_POLICY='attach')
+    def test_attach(self):
+        first = self.post_sale(identifier='INV1').json()
+        duplicate = self.post_sale(identifier='INV1').json()
+        self.assertTrue(duplicate['duplicate'])
+        self.assertEqual(duplicate['sale_id'], first['sale_id'])
+        self.assertEqual(duplicate['issued_coupon_id'],
+                first['issued_coupon_id'])
+        self.assertEqual(Sale.objects.count(), 1)
+
+    @override_settings(SALE_IDENTIFIER_POLICY='allow')
+    def test_allow(self):
+        self.post_sale(identifier='INV1')
+        self.post_sale(identifier='INV1')
+        self.assertEqual(Sale.objects.count(), 2)
+
+    def test_reject_an_archived_identifier(self):
+        sale = create_sale(self.store, self.customer, identifier='INV1')
+        archive_store(self.store.id, horizon_days=-2)
+        self.assertTrue(ArchivedSale.objects.filter(id=sale.id).exists())
+        response = self.post_sale(identifier='INV1')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Sale.objects.count(), 0)
+
+    def test_concurrent_duplicate_is_rejected_in_the_transaction(self):
+        """
+        A registration that passed the first check (the other registration
+        was still in flight) is rejected by the check under the store lock,
+        and its idempotency key is released.
+        """
+        create_sale(self.store, self.customer, identifier='INV1')
+        duplicate_sale = views.duplicate_sale
+        checks = []
+        def first_check_misses(store, identifier):
+            checks.append(identifier)
+            if len(checks) == 1:
+                return None
+            return duplicate_sale(store, identifier)
+        with mock.patch('es_mvp.views.duplicate_sale', first_check_misses):
+            response = self.post_sale(identifier='INV1', key='key-1')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(checks), 2)
+        self.assertEqual(Sale.objects.count(), 1)
+        self.assertFalse(SaleIdempotencyKey.objects.filter(
+                key='key-1').exists())
+
+
+class VelocityTests(SaleRegistrationMixin, TestCase):
+
+    def track_sale(self, store_id, customer_id, now):
+        """Track a sale in a committed transaction."""
+        with self.captureOnCommitCallbacks(using=store_db(), execute=True):
+            return velocity.track_sale(store_id, customer_id, now=now,
+                    using=store_db())
+
+    def test_track_sale_counts_the_window(self):
+        rules = (('customer', 'sales', 60 * 60, 2),)
+        now = 1000000.0
+        with override_settings(VELOCITY_RULES=rules):
+            self.assertEqual(self.track_sale(1, 1, now=now), [])
+            self.assertEqual(self.track_sale(1, 1, now=now + 60), [])
+            self.assertEqual(self.track_sale(1, 1, now=now + 120),
+                    ['customer sales 3 > 2 in 60 min'])
+            # Other customer, and the same customer after the window.
+            self.assertEqual(self.track_sale(1, 2, now=now + 120), [])
+            self.assertEqual(self.track_sale(1, 1,
+                    now=now + (2 * 60 * 60)), [])
+
+    @override_settings(VELOCITY_RULES=(('customer', 'sales', 60 * 60, 1),))
+    def test_rolled_back_sale_is_not_counted(self):
+        now = 1000000.0
+        with self.captureOnCommitCallbacks(using=store_db(),
+                execute=True) as callbacks:
+            with self.assertRaises(ValidationError):
+                with transaction.atomic(using=store_db()):
+                    self.assertEqual(velocity.track_sale(1, 1, now=now,
+                            using=store_db()), [])
+                    raise ValidationError("Rolled back.")
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.track_sale(1, 1, now=now), [])
+        self.assertEqual(self.track_sale(1, 1, now=now),
+                ['customer sales 2 > 1 in 60 min'])
+
+    @override_settings(VELOCITY_RULES=(('customer', 'sales', 60 * 60, 1),))
+    def test_flagged_sale_holds_its_coupon_until_released(self):
+        with self.captureOnCommitCallbacks(using=store_db(), execute=True):
+            self.post_sale()
+        held = self.post_sale().json()
+        self.assertTrue(held['is_flagged'])
+        self.assertIsNone(held['issued_coupon_id'])
+        sale = Sale.objects.get(id=held['sale_id'])
+        self.assertFalse(sale.is_evaluated)
+        self.assertIn('customer sales', sale.flag_reason)
+        coupon = release_held_sale(sale.id)
+        self.assertEqual(coupon.sale_id, sale.id)
+        sale.refresh_from_db()
+        self.assertTrue(sale.is_evaluated)
+        # A released sale is not released again.
+        self.assertIsNone(release_held_sale(sale.id))
+        self.assertEqual(Coupon.objects.filter(sale=sale).count(), 1)
+
+
+### Coupon lifecycle
+
+class CouponLifecycleTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.sale = create_sale(self.store, self.customer)
+
+    def test_allowed_transitions(self):
+        coupon = create_coupon(self.sale, self.campaign)
+        for state in (CouponState.VALID, CouponState.ACTIVATED,
+                CouponState.REDEEMED):
+            coupon.transition_to(state)
+            coupon.save()
+        coupon.refresh_from_db()
+        self.assertEqual(coupon.state, CouponState.REDEEMED)
+        self.assertTrue(coupon.is_valid)
+        self.assertTrue(coupon.is_redeemed)
+
+    def test_invalid_transitions(self):
+        coupon = create_coupon(self.sale, self.campaign)
+        with self.assertRaises(ValidationError):
+            coupon.transition_to(CouponState.REDEEMED)
+        coupon.transition_to(CouponState.EXPIRED)
+        # A terminal state.
+        for state in CouponState:
+            with self.assertRaises(ValidationError):
+                coupon.transition_to(state)
+
+    def test_pending_to_expired_was_never_valid(self):
+        pending = create_coupon(self.sale, self.campaign)
+        pending.transition_to(CouponState.EXPIRED)
+        pending.save()
+        create_coupon(create_sale(self.store, self.customer), self.campaign,
+                state=CouponState.VALID)
+        self.assertTrue(pending.is_expired)
+        self.assertFalse(pending.is_valid)
+        summary = run_queries(store_summary_queries(self.store.id))
+        self.assertEqual(summary['issued_coupons'], 1)
+        self.assertEqual(summary['expired_coupons'], 1)
+
+
+class ReadTimeExpirationTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        yesterday = date.today() - timedelta(days=1)
+        self.overdue = create_coupon(create_sale(self.store, self.customer),
+                self.campaign, state=CouponState.VALID,
+                expiration_date=yesterday)
+        self.current = create_coupon(create_sale(self.store, self.customer),
+                self.campaign, state=CouponState.ACTIVATED,
+                expiration_date=date.today())
+
+    def test_expiration_is_evaluated_at_read_time(self):
+        self.assertTrue(self.overdue.is_expired)
+        self.assertFalse(self.current.is_expired)
+        self.assertEqual(list(Coupon.objects.applicable()), [self.current])
+        self.assertEqual(list(Coupon.objects.expired()), [self.overdue])
+        self.assertEqual(list(Coupon.objects.overdue()), [self.overdue])
+        # Tomorrow, both are expired.
+        tomorrow = date.today() + timedelta(days=1)
+        self.assertFalse(Coupon.objects.applicable(tomorrow).exists())
+        self.assertEqual(Coupon.objects.expired(tomorrow).count(), 2)
+
+    def test_settle_expired(self):
+        self.assertEqual(Coupon.objects.settle_expired(), 1)
+        self.overdue.refresh_from_db()
+        self.assertEqual(self.overdue.state, CouponState.EXPIRED)
+        self.assertFalse(Coupon.objects.overdue().exists())
+        self.assertEqual(list(Coupon.objects.expired()), [self.overdue])
+        self.assertEqual(Coupon.objects.settle_expired(), 0)
+
+
+### Coupon event ledger
+
+class LedgerTests(SaleRegistrationMixin, TestCase):
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(parse_cursor(None), {})
+        self.assertEqual(parse_cursor(format_cursor({'default' : (7, 12)})),
+                {'default' : (7, 12)})
+        # A cursor of the event ids only.
+        self.assertEqual(parse_cursor('default:12'), {'default' : (0, 12)})
+        with self.assertRaises(ValueError):
+            parse_cursor('unknown:1')
+
+    @mock.patch('es_mvp.notifications.sending_sms_aws', return_value='msg-1')
+    def test_tail_events(self, sending_sms_aws):
+        for index in range(3):
+            self.post_sale()
+        events, cursor = tail_events(None, limit=2)
+        self.assertEqual([event['event'] for event in events],
+                ['issued', 'issued'])
+        more, cursor = tail_events(cursor, limit=2)
+        self.assertEqual(len(more), 1)
+        self.assertLess(events[-1]['id'], more[0]['id'])
+        # The cursor is at the end.
+        self.assertEqual(tail_events(cursor), ([], cursor))
+        coupon = Coupon.objects.get(id=more[0]['coupon'])
+        # A new event is read after the cursor.
+        Coupon.objects.filter(id=coupon.id).update(
+                date_added=timezone.now() - timedelta(days=2))
+        cron.coupon_activation_task()
+        deliver_notifications(now=timezone.now() + timedelta(days=2),
+                suppression=set())
+        events, cursor = tail_events(cursor)
+        self.assertEqual([(event['coupon'], event['event'])
+                for event in events], [(coupon.id, 'validated')])
+
+    def test_tail_in_transaction_order(self):
+        sale = create_sale(self.store, self.customer)
+        coupon = create_coupon(sale, self.campaign)
+        # A higher id committed by an older transaction is read first.
+        late, early = CouponEvent.objects.bulk_create(CouponEvent(
+                store=self.store, coupon=coupon, event=CouponEventType.ISSUED,
+                xid=xid) for xid in (9, 8))
+        events, cursor = tail_events(None)
+        self.assertEqual([event['id'] for event in events],
+                [early.id, late.id])
+        self.assertEqual(parse_cursor(cursor)[store_db()], (9, late.id))
+        self.assertEqual(tail_events(cursor), ([], cursor))
+
+    def test_tail_waits_for_the_transactions_in_flight(self):
+        with mock.patch.object(connections[store_db()], 'vendor',
+                'postgresql'):
+            events = CouponEvent.objects.tail()
+            self.assertIn('pg_snapshot_xmin', str(events.query))
+        self.assertNotIn('pg_snapshot_xmin',
+                str(CouponEvent.objects.tail().query))
+
+
+### Coupon ranking
+
+class CouponRankingTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Coupons of (face value, discount limit rate, days to expire).
+        for value, limit, days in ((10.0, 50, 30), (25.0, 10, 20),
+                (7.5, 100, 10), (25.0, 20, 5), (0.5, 1, 60)):
+            coupon = create_coupon(create_sale(self.store, self.customer),
+                    self.campaign, state=CouponState.VALID, value=value,
+                    expiration_date=date.today() + timedelta(days=days))
+            Coupon.objects.filter(id=coupon.id).update(
+                    discount_limit_rate=limit)
+
+    def test_sql_discount_matches_the_python_rule(self):
+        for initial_value in (1.0, 9.99, 33.0, 100.0, 257.5):
+            for coupon in Coupon.objects.with_effective_discount(
+                    initial_value):
+                self.assertEqual(float(coupon.effective_discount),
+                        sale_effective_discount(initial_value,
+                        coupon.discount_value, coupon.discount_limit_rate))
+
+    def test_sql_ranking_matches_the_python_rule(self):
+        for initial_value in (1.0, 33.0, 100.0, 257.5):
+            expected = sorted(Coupon.objects.all(), key=lambda coupon: (
+                    -sale_effective_discount(initial_value,
+                    coupon.discount_value, coupon.discount_limit_rate),
+                    coupon.expiration_date))
+            choices = applicable_coupon_choices(self.store, self.customer,
+                    initial_value, 'R$', limit=3)
+            self.assertEqual([coupon_id for coupon_id, label in choices],
+                    [coupon.id for coupon in expected[:3]])
+
+
+### Campaign simulator
+
+class SimulateCampaignTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.store)
+        create_sale(self.store, self.customer, value=80.0)
+
+    def simulate(self, **parameters):
+        return self.client.get(reverse('es_mvp:simulate_campaign'),
+                parameters)
+
+    def test_grid(self):
+        response = self.simulate(bonus_rate=['10', '20'],
+                coupon_lifetime=['30', '60'])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['simulated_sales'], 1)
+        self.assertEqual(len(data['simulation']), 4)
+        self.assertEqual({(row['bonus_rate'], row['coupon_lifetime'])
+                for row in data['simulation']},
+                {(10.0, 30.0), (10.0, 60.0), (20.0, 30.0), (20.0, 60.0)})
+
+    def test_invalid_values(self):
+        for value in ('nan', 'inf', '-inf', 'ten'):
+            self.assertEqual(self.simulate(bonus_rate=value).status_code,
+                    400)
+
+    @override_settings(SIMULATOR_MAX_COMBINATIONS=4)
+    def test_grid_size_is_checked_before_the_grid_is_built(self):
+        with mock.patch('es_mvp.simulator.campaign_grid') as campaign_grid:
+            response = self.simulate(bonus_rate=['10', '20', '30'],
+                    coupon_lifetime=['30', '60'])
+        self.assertEqual(response.status_code, 400)
+        campaign_grid.assert_not_called()
+
+
+### Archive
+
+class ArchiveTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.horizon = date.today() + timedelta(days=2)
+        # A sale whose coupon was redeemed by a second sale, whose coupon is
+        # still pending.
+        self.first_sale = create_sale(self.store, self.customer)
+        self.redeemed = create_coupon(self.first_sale, self.campaign,
+                state=CouponState.REDEEMED)
+        self.second_sale = create_sale(self.store, self.customer,
+                discount=10.0, redeemed_coupon=self.redeemed)
+        self.pending = create_coupon(self.second_sale, self.campaign)
+
+    def test_archivable_rows_fixed_point(self):
+        # The pending coupon keeps its sale, thus the redeemed coupon (its
+        # redemption sale is live) and the first sale.
+        self.assertEqual(archivable_rows(self.store.id, self.horizon),
+                (set(), set()))
+        Coupon.objects.filter(id=self.pending.id).update(
+                state=CouponState.EXPIRED)
+        self.assertEqual(archivable_rows(self.store.id, self.horizon), (
+                {self.first_sale.id, self.second_sale.id},
+                {self.redeemed.id, self.pending.id}))
+        # Out of the horizon.
+        self.assertEqual(archivable_rows(self.store.id, date.today()),
+                (set(), set()))
+
+    def test_archive_store_and_rollups(self):
+        self.assertEqual(archive_store(self.store.id, horizon_days=-2),
+                (0, 0))
+        Coupon.objects.filter(id=self.pending.id).update(
+                state=CouponState.EXPIRED)
+        self.assertEqual(archive_store(self.store.id, horizon_days=-2),
+                (2, 2))
+        self.assertFalse(Sale.objects.exists())
+        self.assertFalse(Coupon.objects.exists())
+        self.assertEqual(ArchivedCoupon.objects.get(
+                id=self.redeemed.id).sale_id, self.first_sale.id)
+        self.assertEqual(ArchivedSale.objects.get(
+                id=self.second_sale.id).redeemed_coupon_id, self.redeemed.id)
+        rollup = ArchiveRollup.objects.get(campaign=self.campaign)
+        self.assertEqual((rollup.cumulative_sales, rollup.cumulative_cashback,
+                rollup.redeemed_coupons, rollup.issued_coupons,
+                rollup.expired_coupons), (90.0, 10.0, 1, 1, 1))
+
+    def test_archival_task_returns_the_archived_rows(self):
+        Coupon.objects.filter(id=self.pending.id).update(
+                state=CouponState.EXPIRED)
+        with override_settings(ARCHIVE_HORIZON_DAYS=-2):
+            results = cron.archival_task()
+        self.assertEqual(sum(sales for sales, coupons in results.values()), 2)
+        self.assertEqual(sum(coupons for sales, coupons in results.values()),
+                2)
+
+
+### SMS messages and notifications
+
+class SmsTests(TestCase):
+
+    def test_gsm7_segments(self):
+        self.assertEqual(sms_segments('a' * 160), ('GSM-7', 1))
+        self.assertEqual(sms_segments('a' * 161), ('GSM-7', 2))
+        self.assertEqual(sms_segments('a' * 306), ('GSM-7', 2))
+        self.assertEqual(sms_segments('a' * 307), ('GSM-7', 3))
+        # The extension characters take two septets.
+        self.assertEqual(sms_segments('€' * 80), ('GSM-7', 1))
+        self.assertEqual(sms_segments('€' * 81), ('GSM-7', 2))
+
+    def test_ucs2_segments(self):
+        self.assertEqual(sms_segments('ã' * 70), ('UCS-2', 1))
+        self.assertEqual(sms_segments('ã' * 71), ('UCS-2', 2))
+        self.assertEqual(sms_segments('ã' * 134), ('UCS-2', 2))
+        self.assertEqual(sms_segments('ã' * 135), ('UCS-2', 3))
+        # A single character switches the whole message.
+        self.assertEqual(sms_segments('a' * 70 + 'ç'), ('UCS-2', 2))
+        # The characters out of the BMP take two code units.
+        self.assertEqual(sms_segments('😀' * 35), ('UCS-2', 1))
+        self.assertEqual(sms_segments('😀' * 36), ('UCS-2', 2))
+
+    def test_compile_keeps_the_variable_fields(self):
+        compiled = compile_sms_template("{title}: {currency}{value} {url}",
+                policy='none', title='Loja', currency='R$', url='x.com/{a}')
+        self.assertEqual(compiled.template, "Loja: R${value} x.com/{{a}}")
+        self.assertEqual(compiled.template.format(value=10),
+                "Loja: R$10 x.com/{a}")
+        self.assertEqual((compiled.encoding, compiled.segments), ('GSM-7', 1))
+
+    def test_compile_policies(self):
+        template = "{title} {value}"
+        self.assertEqual(compile_sms_template(template, policy='none',
+                title='São João').encoding, 'UCS-2')
+        compiled = compile_sms_template(template, policy='transliterate',
+                title='São João')
+        self.assertEqual(compiled.template, "Sao Joao {value}")
+        self.assertEqual(compiled.encoding, 'GSM-7')
+        # The title is shortened to fit a single segment, with the widest
+        # variable fields.
+        compiled = compile_sms_template(template, policy='truncate',
+                title='x' * 160)
+        self.assertEqual(compiled.segments, 1)
+        self.assertEqual(len(compiled.template.format(value='9' * 6)), 160)
+        compiled = compile_sms_template(template, policy='none',
+                title='x' * 160)
+        self.assertEqual(compiled.segments, 2)
+
+
+class PlanNotificationsTests(StoreMixin, TestCase):
+
+    def due_coupons(self, cellphone, count):
+        customer = Customer.objects.create(store=self.store,
+                cellphone=cellphone, is_verified=True)
+        return [(create_coupon(create_sale(self.store, customer),
+                self.campaign), 1) for index in range(count)]
+
+    def test_single_and_digest_messages(self):
+        single = self.due_coupons('5511900000001', 1)
+        digest = self.due_coupons('5511900000002', 3)
+        notifications = plan_notifications(single + digest, date.today(),
+                suppression=set())
+        self.assertEqual(len(notifications), 2)
+        by_customer = {notification.customer.cellphone : notification
+                for notification in notifications}
+        self.assertEqual(by_customer['5511900000001'].coupons, 1)
+        self.assertIn("R$10 of cashback",
+                by_customer['5511900000001'].message)
+        self.assertEqual(by_customer['5511900000002'].coupons, 3)
+        self.assertIn("R$30 of cashback in 3 coupons",
+                by_customer['5511900000002'].message)
+        self.assertEqual(by_customer['5511900000002'].campaign_id,
+                self.campaign.id)
+
+    @override_settings(SMS_DAILY_CAP=1)
+    def test_daily_cap_and_suppression(self):
+        capped = self.due_coupons('5511900000001', 1)
+        suppressed = self.due_coupons('5511900000002', 1)
+        due = self.due_coupons('5511900000003', 1)
+        Notification.objects.create(store=self.store,
+                customer=capped[0][0].customer, message='Sent today',
+                send_at=timezone.now(), date_sent=timezone.now())
+        notifications = plan_notifications(capped + suppressed + due,
+                date.today(), suppression={'5511900000002'})
+        self.assertEqual([notification.customer.cellphone
+                for notification in notifications], ['5511900000003'])
+        with override_settings(SMS_DAILY_CAP=None):
+            self.assertEqual(len(plan_notifications(capped, date.today(),
+                    suppression=set())), 1)
+
+
+class DeliverySlotsTests(TestCase):
+
+    def setUp(self):
+        # Note: Sao Paulo is UTC-3 (no daylight saving time).
+        self.store_settings = StoreSettings(timezone='America/Sao_Paulo',
+                delivery_window_start=time(9, 0),
+                delivery_window_end=time(18, 0))
+        self.local = ZoneInfo('America/Sao_Paulo')
+
+    def test_slots_spread_in_the_remaining_window(self):
+        now = datetime(2026, 10, 19, 15, 0, tzinfo=ZoneInfo('UTC'))
+        self.assertEqual(delivery_slots(self.store_settings, 3, now), [
+                datetime(2026, 10, 19, hour, 0, tzinfo=self.local)
+                for hour in (12, 14, 16)])
+
+    def test_slots_before_the_window(self):
+        now = datetime(2026, 10, 19, 9, 0, tzinfo=ZoneInfo('UTC'))
+        self.assertEqual(delivery_slots(self.store_settings, 1, now),
+                [datetime(2026, 10, 19, 9, 0, tzinfo=self.local)])
+
+    def test_slots_wrap_to_the_next_day(self):
+        # 19:00 in the store timezone, but still the same day in UTC.
+        now = datetime(2026, 10, 19, 22, 0, tzinfo=ZoneInfo('UTC'))
+        self.assertEqual(delivery_slots(self.store_settings, 3, now), [
+                datetime(2026, 10, 20, hour, 0, tzinfo=self.local)
+                for hour in (9, 12, 15)])
+
+
+@mock.patch('es_mvp.notifications.sending_sms_aws', return_value='msg-1')
+class ActivationDeliveryTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # A coupon due for its first activation message.
+        self.coupon = create_coupon(create_sale(self.store, self.customer),
+                self.campaign, days_ago=2)
+        self.later = timezone.now() + timedelta(days=2)
+
+    def test_coupon_is_valid_when_its_message_is_sent(self, sending_sms_aws):
+        cron.coupon_activation_task()
+        notification = Notification.objects.get()
+        self.assertEqual(notification.activations, [[self.coupon.id, 1]])
+        # The message is queued, the coupon is still pending.
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.state, CouponState.PENDING)
+        self.assertEqual(deliver_notifications(now=self.later,
+                suppression=set()), 1)
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.state, CouponState.VALID)
+        self.assertEqual(list(CouponEvent.objects.values_list('coupon',
+                'event')), [(self.coupon.id, CouponEventType.VALIDATED)])
+
+    def test_suppressed_cellphone_keeps_the_coupon_pending(self,
+            sending_sms_aws):
+        cron.coupon_activation_task()
+        self.assertEqual(deliver_notifications(now=self.later,
+                suppression={self.customer.cellphone}), 0)
+        self.assertTrue(Notification.objects.get().is_suppressed)
+        sending_sms_aws.assert_not_called()
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.state, CouponState.PENDING)
+
+    def test_failed_send_keeps_the_message_queued(self, sending_sms_aws):
+        sending_sms_aws.side_effect = Exception("Throttled")
+        cron.coupon_activation_task()
+        self.assertEqual(deliver_notifications(now=self.later,
+                suppression=set()), 0)
+        self.assertIsNone(Notification.objects.get().date_sent)
+        self.coupon.refresh_from_db()
+        self.assertEqual(self.coupon.state, CouponState.PENDING)
+        # The customer with a queued message is not planned again.
+        with override_settings(SMS_DAILY_CAP=None):
+            cron.coupon_activation_task()
+        self.assertEqual(Notification.objects.count(), 1)
+
+    def test_pending_coupon_is_due_until_its_message_is_sent(self,
+            sending_sms_aws):
+        for days in (2, 3, 7):
+            self.assertEqual(activation_step(self.coupon,
+                    date.today() + timedelta(days=days - 2)), 1)
+        self.assertIsNone(activation_step(self.coupon,
+                date.today() - timedelta(days=1)))
+        self.coupon.state = CouponState.VALID
+        self.assertIsNone(activation_step(self.coupon,
+                date.today() + timedelta(days=1)))
+        self.assertEqual(activation_step(self.coupon,
+                date.today() + timedelta(days=5)), 2)
+
+
+### Delivery receipts
+
+def receipt_line(message_id, status, timestamp, response='Delivered'):
+    """Format a delivery receipt of the SMS provider (a JSON line)."""
+    return json.dumps({
+            'notification' : {'messageId' : message_id,
+                    'timestamp' : timestamp},
+            'delivery' : {'destination' : '+5511987650001',
+                    'providerResponse' : response},
+            'status' : status})
+
+
+class ReceiptTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.notification = Notification.objects.create(store=self.store,
+                customer=self.customer, message='Hi', send_at=timezone.now(),
+                date_sent=timezone.now(), message_id='m1')
+
+    def test_parse_receipt(self):
+        receipt = parse_receipt(receipt_line('m1', 'SUCCESS',
+                '2026-10-19 14:02:11.503'))
+        self.assertEqual(receipt.message_id, 'm1')
+        self.assertEqual(receipt.status, DeliveryStatus.DELIVERED)
+        self.assertEqual(receipt.cellphone, '5511987650001')
+        # A naive timestamp is in UTC.
+        self.assertEqual(receipt.timestamp, datetime(2026, 10, 19, 14, 2, 11,
+                503000, tzinfo=ZoneInfo('UTC')))
+        self.assertIsNone(parse_receipt('{not json'))
+        self.assertIsNone(parse_receipt(receipt_line('m1', 'UNKNOWN',
+                '2026-10-19 14:02:11')))
+        self.assertIsNone(parse_receipt(json.dumps({'status' : 'SUCCESS'})))
+
+    def test_apply_receipts_keeps_the_latest(self):
+        failed = parse_receipt(receipt_line('m1', 'FAILURE',
+                '2026-10-19 14:05:00'))
+        delivered = parse_receipt(receipt_line('m1', 'SUCCESS',
+                '2026-10-19 14:02:00'))
+        self.assertEqual(apply_receipts({'m1' : failed}), 1)
+        # An older and a repeated receipt are skipped.
+        self.assertEqual(apply_receipts({'m1' : delivered}), 0)
+        self.assertEqual(apply_receipts({'m1' : failed}), 0)
+        self.notification.refresh_from_db()
+        self.assertEqual(self.notification.delivery_status,
+                DeliveryStatus.FAILED)
+        self.assertEqual(self.notification.date_delivered, failed.timestamp)
+
+    def test_import_receipts_out_of_order(self):
+        lines = [receipt_line('m1', 'SUCCESS', '2026-10-19 14:05:00'),
+                receipt_line('m1', 'FAILURE', '2026-10-19 14:02:00',
+                        response='Invalid phone number'),
+                'invalid', '']
+        for batch_size in (1, 10):
+            counts = import_receipts(lines, batch_size=batch_size)
+            self.assertEqual(counts['receipts'], 3)
+            self.assertEqual(counts['invalid'], 1)
+            self.notification.refresh_from_db()
+            self.assertEqual(self.notification.delivery_status,
+                    DeliveryStatus.DELIVERED)
+        # The permanent failure suppresses the cellphone, even if older.
+        self.assertTrue(SuppressedCellphone.objects.filter(
+                cellphone='5511987650001').exists())
+
+
+### Suppression list
+
+class SuppressionTests(TestCase):
+
+    def test_bloom_filter_has_no_false_negatives(self):
+        bloom = BloomFilter(1000, 0.01)
+        items = [f"55119{index:08d}" for index in range(1000)]
+        for item in items:
+            bloom.add(item)
+        self.assertTrue(all(item in bloom for item in items))
+        # Well under the capacity, the false positives stay rare.
+        false_positives = sum(f"55219{index:08d}" in bloom
+                for index in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_suppression_list_confirms_the_positives(self):
+        cellphones = [f"55119{index:08d}" for index in range(200)]
+        SuppressedCellphone.objects.bulk_create(SuppressedCellphone(
+                cellphone=cellphone, reason=SuppressionReason.OPT_OUT)
+                for cellphone in cellphones)
+        suppression = SuppressionList()
+        self.assertTrue(all(cellphone in suppression
+                for cellphone in cellphones))
+        self.assertFalse(any(f"55219{index:08d}" in suppression
+                for index in range(200)))
+        # The rows added later are loaded by the refresh.
+        SuppressedCellphone.objects.create(cellphone='5531999999999',
+                reason=SuppressionReason.OPT_OUT)
+        suppression.refresh()
+        self.assertIn('5531999999999', suppression)
+
+
+### Scheduler
+
+class CronTests(TestCase):
+
+    def test_cron_field(self):
+        self.assertEqual(cron_field('*', 0, 5), {0, 1, 2, 3, 4, 5})
+        self.assertEqual(cron_field('*/15', 0, 59), {0, 15, 30, 45})
+        self.assertEqual(cron_field('5/15', 0, 59), {5, 20, 35, 50})
+        self.assertEqual(cron_field('1-5/2', 0, 59), {1, 3, 5})
+        self.assertEqual(cron_field('0,30', 0, 59), {0, 30})
+        for expression in ('60', '*/0', '5-70', 'x'):
+            with self.assertRaises(ValueError):
+                cron_field(expression, 0, 59)
+
+    def test_cron_fields(self):
+        fields = cron_fields('0 4 * * 7')
+        self.assertEqual(fields[4], {0})
+        self.assertEqual(fields[5], (False, True))
+        self.assertEqual(cron_fields('0 4 */2 * 1')[5], (False, True))
+        self.assertEqual(cron_fields('0 4 1 * 1')[5], (True, True))
+        with self.assertRaises(ValueError):
+            cron_fields('0 4 * *')
+
+    def test_due_slot(self):
+        local = timezone.get_current_timezone()
+        now = datetime(2026, 10, 19, 3, 30, tzinfo=local)
+        slot = datetime(2026, 10, 19, 3, 0, tzinfo=local)
+        self.assertEqual(due_slot('0 3 * * *', now - timedelta(days=1), now),
+                slot)
+        # The slot already ran.
+        self.assertIsNone(due_slot('0 3 * * *', slot, now))
+        # The latest missed slot is caught up, in the catch-up window.
+        now = datetime(2026, 10, 19, 2, 0, tzinfo=local)
+        self.assertEqual(due_slot('0 3 * * *', now - timedelta(days=3), now),
+                datetime(2026, 10, 18, 3, 0, tzinfo=local))
+        with override_settings(SCHEDULER_CATCHUP_MINUTES=60):
+            self.assertIsNone(due_slot('0 3 * * *', now - timedelta(days=3),
+                    now))
+
+    def test_due_slot_either_day_field(self):
+        """Both the day of month and of week restricted: any of them."""
+        local = timezone.get_current_timezone()
+        # 2026-10-19 is a monday.
+        now = datetime(2026, 10, 19, 0, 5, tzinfo=local)
+        self.assertEqual(due_slot('0 0 1 * 1', now - timedelta(hours=1), now),
+                datetime(2026, 10, 19, 0, 0, tzinfo=local))
+        self.assertIsNone(due_slot('0 0 1 * 2', now - timedelta(hours=1),
+                now))
+
+
+### Customer profiles
+
+class WalletTests(SaleRegistrationMixin, TestCase):
+
+    def profile_values(self):
+        return profile_data(CustomerProfile.objects.get(
+                customer=self.customer))
+
+    def test_maintained_profile_matches_a_rebuild(self):
+        # Two coupons issued and made valid (a digest message), one of them
+        # redeemed.
+        first = self.post_sale(value='100').json()
+        self.post_sale(value='200')
+        Coupon.objects.update(date_added=timezone.now() - timedelta(days=2))
+        cron.coupon_activation_task()
+        with mock.patch('es_mvp.notifications.sending_sms_aws',
+                return_value='msg-1'):
+            deliver_notifications(now=timezone.now() + timedelta(days=2),
+                    suppression=set())
+        self.assertEqual(self.profile_values()['usable_coupons'], 2)
+        coupon_id = first['issued_coupon_id']
+        self.post_sale(value='80')
+        response = self.post_sale(value='80', redeemed_coupon=coupon_id)
+        self.assertEqual(response.json()['step'], 'done')
+        self.assertEqual(Coupon.objects.get(id=coupon_id).state,
+                CouponState.REDEEMED)
+        maintained = self.profile_values()
+        self.assertEqual(maintained['sales_count'], 3)
+        self.assertEqual(maintained['usable_coupons'], 1)
+        rebuild_profiles([self.customer.id])
+        self.assertEqual(self.profile_values(), maintained)
+
+    def test_stale_wallet_is_refreshed_at_read_time(self):
+        sale = create_sale(self.store, self.customer)
+        create_coupon(sale, self.campaign, state=CouponState.VALID,
+                expiration_date=date.today())
+        rebuild_profiles([self.customer.id])
+        self.assertEqual(self.profile_values()['cashback_balance'], 10.0)
+        tomorrow = date.today() + timedelta(days=1)
+        profile = get_profile(self.customer.id, today=tomorrow)
+        self.assertEqual((profile.cashback_balance, profile.usable_coupons,
+                profile.next_expiration), (0.0, 0, None))
+        rebuild_profiles([self.customer.id], today=tomorrow)
+        self.assertEqual(self.profile_values(), profile_data(profile))
+
+
+### Store pages
+
+class FragmentCacheTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.store)
+        create_sale(self.store, self.customer, identifier='NF-1')
+
+    def bump(self):
+        with self.captureOnCommitCallbacks(using=store_db(), execute=True):
+            bump_data_version(self.store.id)
+
+    def test_bump_after_commit(self):
+        self.assertEqual(data_version(self.store.id), 0)
+        with self.captureOnCommitCallbacks(using=store_db()) as callbacks:
+            bump_data_version(self.store.id, self.store.id)
+            # Not bumped before the commit.
+            self.assertEqual(data_version(self.store.id), 0)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(data_version(self.store.id), 1)
+        self.bump()
+        self.assertEqual(data_version(self.store.id), 2)
+
+    def test_bump_invalidates_the_cached_fragments(self):
+        self.assertContains(self.client.get(reverse('es_mvp:sales')), 'NF-1')
+        create_sale(self.store, self.customer, identifier='NF-2')
+        # The cached list is served until the store data version is bumped.
+        self.assertNotContains(self.client.get(reverse('es_mvp:sales')),
+                'NF-2')
+        self.bump()
+        self.assertContains(self.client.get(reverse('es_mvp:sales')), 'NF-2')
+
+    def test_version_is_shared_by_the_app_processes(self):
+        context = fragment_context(self.store.id)
+        # A bump by another app process (the version lives in the database).
+        StoreDataVersion.objects.create(store=self.store, version=7)
+        self.assertNotEqual(fragment_context(self.store.id)['data_version'],
+                context['data_version'])
+
+
+class ConditionalGetTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.store)
+        self.sale = create_sale(self.store, self.customer)
+        self.coupon = create_coupon(self.sale, self.campaign,
+                state=CouponState.VALID)
+        # Note: the first page sets the CSRF cookie (a part of the ETag).
+        self.client.get(reverse('es_mvp:sale', args=[self.sale.id]))
+
+    def get(self, url, etag=None):
+        headers = {'HTTP_IF_NONE_MATCH' : etag} if etag else {}
+        return self.client.get(url, **headers)
+
+    def test_unchanged_page_is_not_modified(self):
+        for url in (reverse('es_mvp:sale', args=[self.sale.id]),
+                reverse('es_mvp:coupon', args=[self.coupon.id]),
+                reverse('es_mvp:campaign', args=[self.campaign.id])):
+            response = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('private', response['Cache-Control'])
+            self.assertIn('no-cache', response['Cache-Control'])
+            response = self.get(url, response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    def test_changed_page_is_rendered(self):
+        sale_url = reverse('es_mvp:sale', args=[self.sale.id])
+        coupon_url = reverse('es_mvp:coupon', args=[self.coupon.id])
+        campaign_url = reverse('es_mvp:campaign', args=[self.campaign.id])
+        etags = {url : self.get(url)['ETag']
+                for url in (sale_url, coupon_url, campaign_url)}
+        Sale.objects.filter(id=self.sale.id).update(is_flagged=True)
+        Coupon.objects.filter(id=self.coupon.id).update(
+                state=CouponState.ACTIVATED)
+        with self.captureOnCommitCallbacks(using=store_db(), execute=True):
+            bump_data_version(self.store.id)
+        for url, etag in etags.items():
+            self.assertEqual(self.get(url, etag).status_code, 200)
+
+    def test_expiration_is_evaluated_at_read_time(self):
+        yesterday = date.today() - timedelta(days=1)
+        self.assertEqual(effective_state(CouponState.VALID, yesterday),
+                CouponState.EXPIRED)
+        self.assertEqual(effective_state(CouponState.VALID, date.today()),
+                CouponState.VALID)
+        self.assertEqual(effective_state(CouponState.PENDING, yesterday),
+                CouponState.PENDING)
+
+
+class GatherQueriesTests(TestCase):
+
+    def test_late_and_failed_queries_get_none(self):
+        def slow():
+            Event().wait(0.5)
+            return 2
+        with self.assertLogs('es_mvp.dashboards', 'WARNING') as logs:
+            results = async_to_sync(gather_queries)({'fast' : lambda: 1,
+                    'slow' : slow, 'failed' : lambda: 1 / 0}, timeout=0.2)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(results, {'fast' : 1, 'slow' : None,
+                'failed' : None})
+
+    @mock.patch.object(connections, 'close_all')
+    def test_worker_sets_the_statement_timeout(self, close_all):
+        with mock.patch.object(connection, 'vendor', 'postgresql'), \
+                mock.patch.object(connection, 'cursor') as cursor:
+            self.assertEqual(run_in_thread(lambda: 1, timeout=0.25), 1)
+        execute = cursor.return_value.__enter__.return_value.execute
+        execute.assert_called_once_with("SET statement_timeout = %s", [250])
+        # The connections of the worker thread are closed.
+        close_all.assert_called_once()
+        with mock.patch.object(connection, 'cursor') as cursor:
+            self.assertEqual(run_in_thread(lambda: 1, timeout=0.25), 1)
+            self.assertEqual(run_in_thread(lambda: 1), 1)
+        # Not on SQLite, nor without a timeout.
+        cursor.assert_not_called()
+
+
+### Store sessions
+
+class StoreMemoTests(StoreMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.backend = MemoizedModelBackend()
+        self.backend.get_user(self.store.id)
+
+    def test_memoized_user_and_settings(self):
+        get_store_settings(self.store)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.backend.get_user(self.store.id), self.store)
+        # Note: the settings live in the shard of the store.
+        with self.assertNumQueries(0, using=store_db()):
+            self.assertEqual(get_store_settings(self.store).title, 'Loja')
+
+    def test_forgotten_on_save_and_password_change(self):
+        self.store.set_password('pw-654321')
+        self.store.save()
+        self.assertTrue(self.backend.get_user(self.store.id).check_password(
+                'pw-654321'))
+        get_store_settings(self.store)
+        StoreSettings.objects.filter(store=self.store).get().save()
+        with self.assertNumQueries(1, using=store_db()):
+            get_store_settings(self.store)
+
+    def test_forgotten_on_logout(self):
+        request = mock.Mock(session=self.client.session, user=self.store)
+        logout(request)
+        with self.assertNumQueries(1):
+            self.backend.get_user(self.store.id)
+
+    @override_settings(STORE_MEMO_TIMEOUT=0)
+    def test_disabled_without_timeout(self):
+        with self.assertNumQueries(1):
+            self.backend.get_user(self.store.id)
+
+
+class StoreSessionTests(StoreMixin, TestCase):
+
+    def test_unchanged_session_is_not_saved(self):
+        self.client.force_login(self.store)
+        self.client.get(reverse('es_mvp:sales'))
+        response = self.client.get(reverse('es_mvp:sales'))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_sessions_of_the_stock_backend_survive(self):
+        self.client.force_login(self.store,
+                backend='django.contrib.auth.backends.ModelBackend')
+        response = self.client.get(reverse('es_mvp:sales'))
+        self.assertEqual(response.status_code, 200)
+
+
+### Database routing
+
+@mock.patch('es_mvp.routers.healthy_replica', return_value='replica')
+class ReplicaRoutingTests(TestCase):
+
+    def test_reads_opt_in_to_the_replica(self, healthy_replica):
+        self.assertEqual(read_db('default'), 'default')
+        with read_replica():
+            self.assertEqual(read_db('default'), 'replica')
+        with routing(), read_replica():
+            self.assertEqual(read_db('default'), 'replica')
+        # A pinned store session reads from the primary.
+        with routing(pinned=True), read_replica():
+            self.assertEqual(read_db('default'), 'default')
+
+    def test_reads_after_a_write_go_to_the_primary(self, healthy_replica):
+        with read_replica() as state:
+            # Note: the session writes do not pin the reads.
+            record_write(Session)
+            self.assertEqual(read_db('default'), 'replica')
+            record_write(Sale)
+            self.assertTrue(state['wrote'])
+            self.assertEqual(read_db('default'), 'default')
+
+
+class ReplicaLagTests(TestCase):
+
+    def setUp(self):
+        lag_checks.clear()
+        self.addCleanup(lag_checks.clear)
+
+    @override_settings(REPLICA_DATABASE='default', REPLICA_MAX_LAG=5,
+            REPLICA_LAG_CHECK_INTERVAL=60)
+    def test_lagging_replica_is_skipped(self):
+        # Note: the 'default' database stands for the replica.
+        with mock.patch('es_mvp.routers.replica_lag', return_value=9.0):
+            self.assertIsNone(healthy_replica())
+        # The lag is checked once per interval.
+        with mock.patch('es_mvp.routers.replica_lag',
+                return_value=0.0) as replica_lag:
+            self.assertIsNone(healthy_replica())
+            replica_lag.assert_not_called()
+            lag_checks.clear()
+            self.assertEqual(healthy_replica(), 'default')
+
+    @override_settings(REPLICA_DATABASE='missing')
+    def test_missing_replica(self):
+        self.assertIsNone(healthy_replica())
+
+
+class ReplicaPinningTests(SaleRegistrationMixin, TestCase):
+
+    def test_store_session_is_pinned_after_a_write(self):
+        response = self.client.get(reverse('es_mvp:sales'))
+        self.assertNotIn(PRIMARY_PIN_COOKIE, response.cookies)
+        response = self.post_sale()
+        self.assertEqual(response.cookies[PRIMARY_PIN_COOKIE]['max-age'],
+                settings.REPLICA_PIN_SECONDS)
+
+
+@override_settings(SHARD_DATABASES=['default', 'shard1'],
+        SHARD_REPLICAS={'shard1' : 'shard1_replica'})
+class ShardRoutingTests(TestCase):
+
+    def setUp(self):
+        self.router = ShardRouter()
+
+    def test_store_rows_go_to_the_current_shard(self):
+        with use_shard('shard1'):
+            self.assertEqual(self.router.db_for_read(Sale), 'shard1')
+            self.assertEqual(self.router.db_for_write(Coupon), 'shard1')
+            self.assertEqual(store_db(), 'shard1')
+            # The global rows are left to the next routers.
+            self.assertIsNone(self.router.db_for_read(StoreShard))
+        self.assertEqual(store_db(), 'default')
+
+    def test_related_rows_stay_in_the_shard_of_their_instance(self):
+        sale = Sale()
+        sale._state.db = 'shard1_replica'
+        with use_shard('default'):
+            self.assertEqual(self.router.db_for_write(Coupon,
+                    instance=sale), 'shard1')
+
+    @mock.patch('es_mvp.routers.healthy_replica',
+            return_value='shard1_replica')
+    def test_reads_opt_in_to_the_shard_replica(self, healthy_replica):
+        with use_shard('shard1'), read_replica():
+            self.assertEqual(self.router.db_for_read(Sale), 'shard1_replica')
+        healthy_replica.assert_called_with('shard1')
+
+    def test_replicas_are_not_migrated(self):
+        self.assertFalse(ReplicaRouter().allow_migrate('shard1_replica',
+                'es_mvp'))
+        self.assertIsNone(ReplicaRouter().allow_migrate('shard1', 'es_mvp'))
+
+    def test_jobs_run_once_per_shard(self):
+        self.assertEqual(per_shard(store_db)(),
+                {'default' : 'default', 'shard1' : 'shard1'})
@@ -1,6 +1,7 @@
 """
 Defines URL patterns for 'es_mvp' app.
 """
+from django.conf import settings
 from django.urls import path
 from django.views.generic.base import TemplateView
 from . import views
@@ -9,19 +10,26 @@ app_name = 'es_mvp'
 
 urlpatterns = [
     # Home page.
-    path('', views.home, name='home'),
+    path('', views.home_async if settings.ASYNC_DASHBOARDS else views.home, 
+            name='home'),
     # Page that list all sales.
     path('sales/', views.sales, name='sales'),
     # Detail page for a sale.
     path('sales/<int:sale_id>/', views.sale, name='sale'),
     # Page for adding a complete new sale.
     path('new_sale/', views.new_sale, name='new_sale'),
+    # Customer wallet lookup by cellphone (JSON).
+    path('customer_wallet/', views.customer_wallet, name='customer_wallet'),
     # Page that list all campaigns.
     path('campaigns/', views.campaigns, name='campaigns'),
     # Detail page for a campaign.
-    path('campaigns/<int:campaign_id>/', views.campaign, name='campaign'),
+    path('campaigns/<int:campaign_id>/', views.campaign_async 
+            if settings.ASYNC_DASHBOARDS else views.campaign, name='campaign'),
     # Page for adding a new campaign.
     path('new_campaign/', views.new_campaign, name='new_campaign'),
+    # Campaign parameters simulation over the historical sales (JSON).
+    path('simulate_campaign/', views.simulate_campaign, 
+            name='simulate_campaign'),
     # Page for editing a campaign.
     path('edit_campaign/<int:campaign_id>/', views.edit_campaign,
             name='edit_campaign'),
@@ -4,6 +4,7 @@ Set custom constraints and validators to use in models.py.
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 from datetime import date
+from zoneinfo import available_timezones
 
 
 def validate_sale_date(sale_date, days_inferior_limit=15, 
@@ -33,3 +34,14 @@ def validate_sale_date(sale_date, days_inferior_limit=15,
         return None
 
 
+def validate_timezone(timezone_name):
+    """
+    A validator to check if a timezone name is a valid IANA timezone (ex. 
+    'America/Sao_Paulo').
+    """
+    if timezone_name not in available_timezones():
+        raise ValidationError(
+            _("%(value)s is not a valid timezone."), 
+            params={"value": timezone_name},
+            code="timezone_invalid")
+    return None
@@ -0,0 +1,93 @@
+"""
+Implement sliding-window velocity checks for the fraud control of new sales.
+"""
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+import time
+
+### Velocity checks
+#
+# Each counter covers a sliding time window, split in a fixed number of buckets
+# (see 'VELOCITY_BUCKETS' in the app settings.py) stored in the cache. Counting
+# increments the current bucket, and the window total sums its buckets with a
+# single cache read. Thus a check has a constant cost and never queries the
+# sale history. A sale is counted only when its transaction commits, so a 
+# rolled back registration leaves no trace in the counters. Note: the window slides a bucket at a time, so the oldest
+# bucket is counted as a whole (the window is slightly wider than its nominal
+# size).
+#
+# The rules are defined by 'VELOCITY_RULES' in the app settings.py, as tuples
+# (scope, metric, window in seconds, limit). Scopes: 'customer' (a customer of
+# a store) or 'store'. Metrics: 'sales' (the number of sales) or 'cashback' (the
+# face value of the coupons to issue).
+#
+###
+
+# Cashback is counted in cents, as cache increments are integers.
+METRIC_UNITS = {'sales' : 1, 'cashback' : 100}
+
+
+def bucket_keys(scope, metric, window, now):
+    """Return the cache keys of the buckets of a window, the current last."""
+    buckets = settings.VELOCITY_BUCKETS
+    size = max(1, window // buckets)
+    current = int(now // size)
+    return [f"velocity:{scope}:{metric}:{size}:{bucket}"
+            for bucket in range(current - buckets + 1, current + 1)]
+
+
+def increment(cache, key, amount, timeout):
+    """Increment a counter in the cache, creating it if needed."""
+    # Note: 'add()' does nothing if the key already exists.
+    cache.add(key, 0, timeout)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        # The key was evicted between the calls.
+        cache.set(key, amount, timeout)
+
+
+def track_sale(store_id, customer_id, cashback=0.0, now=None, using=None):
+    """
+    Check the velocity rules for a new sale (and the cashback of its coupon, if
+    any), then count the sale when the transaction of the 'using' database 
+    commits (or at once, out of a transaction). Returns a list of the violated
+    rules (empty if none), as readable strings.
+    Note: a suspect sale is counted too, so repeated attempts keep flagged. The
+    concurrent sales of a scope are checked before they are counted, so they 
+    may pass together up to the limit.
+    """
+    if now is None:
+        now = time.time()
+    cache = caches[settings.VELOCITY_CACHE]
+    scopes = {'customer' : f"{store_id}:{customer_id}",
+            'store' : f"{store_id}"}
+    amounts = {'sales' : 1, 'cashback' : round(cashback * 100)}
+    rules = [(scope, metric, window, limit, bucket_keys(scopes[scope], metric,
+            window, now)) for scope, metric, window, limit
+            in settings.VELOCITY_RULES]
+    totals = cache.get_many([key for rule in rules for key in rule[4]])
+    violations = []
+    for scope, metric, window, limit, keys in rules:
+        # Note: the new sale is included in the totals.
+        total = (sum(totals.get(key, 0) for key in keys) + 
+                amounts[metric]) / METRIC_UNITS[metric]
+        if total > limit:
+            violations.append(f"{scope} {metric} {total:g} > {limit:g} in "
+                    f"{window // 60} min")
+    # Counts once per window (many rules can share a window).
+    counters = {}
+    for scope, metric, window, limit, keys in rules:
+        if amounts[metric]:
+            counters[keys[-1]] = (amounts[metric], window)
+    transaction.on_commit(lambda: count_sale(cache, counters), using=using)
+    return violations
+
+
+def count_sale(cache, counters):
+    """
+    Increment the current buckets of a sale (a dict of key: (amount, window)).
+    """
+    for key, (amount, window) in counters.items():
+        increment(cache, key, amount, window)
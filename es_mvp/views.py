@@ -1,337 +1,394 @@
+from django.conf import settings as django_settings
 from django.core.paginator import Paginator
-from django.db.models import Sum
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.contrib.auth.models import User
 from django.contrib import messages
-from django.http import Http404
-from .models import Customer, Sale, Campaign, Coupon, StoreSettings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import Http404, JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.functional import SimpleLazyObject
+from django.utils.http import quote_etag
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import condition
+from .models import (Customer, Sale, Campaign, Coupon, StoreSettings, 
+        ArchivedSale, ArchivedCoupon, CouponState, SaleIdempotencyKey, 
+        CouponEvent, CouponEventType)
+from .archive import get_sale, get_coupon
+from .wallet import record_sale, get_profile, profile_data
+from .auth import get_store_settings
+from .fragments import (bump_data_version, fragment_context, 
+        is_fragment_cached)
+from .dashboards import (store_summary_queries, campaign_summary_queries, 
+        build_summary, run_queries, gather_queries)
+from .routers import read_replica, replica_reads
+from .sharding import store_db, use_store
+from .conditional import (sale_etag, coupon_etag, campaign_etag, 
+        patch_detail_cache)
 from .forms import SaleForm, CampaignForm, StoreSettingsForm
 from .sms import sending_sms_aws
+from . import velocity
 from datetime import date, datetime, timedelta
-from math import ceil
+from math import ceil, isfinite, prod
+from asgiref.sync import sync_to_async
 import secrets, re
 
 
+# The session key of the 'new sale' pipeline state.
+SALE_PIPELINE_KEY = 'new_sale_pipeline'
+# The first coupon choice on a new sale, a scenario where no coupons are 
+# redeemed.
+NO_COUPON_CHOICE = [(None, "Não resgatar cupom para esta compra")]
+
 
 ### Home view functions
 
+@replica_reads
 def home(request):
     """The home page."""
     try:
-        settings = StoreSettings.objects.get(store=request.user)
+        settings = get_store_settings(request.user)
     except:
         context = {'store_summary' : False, 
                 'settings' : False, 
                 }
     else:
-        # Summarizes only incentived sales. Returns a dict.
-        cumulative_sales = Sale.objects.filter(
-                store=request.user).exclude(redeemed_coupon=None).aggregate(
-                Sum('final_value', default=0.00))
-        # Summarizes the cashback given. Returns a dict.
-        cumulative_cashback = Coupon.objects.filter(
-            store=request.user, is_redeemed=True).aggregate(
-            Sum('discount_value', default=0.00))
-        # A store summary.
-        store_summary = {
-            'cumulative_sales' : cumulative_sales['final_value__sum'],
-            'cumulative_cashback' : cumulative_cashback['discount_value__sum'],
-            'redeemed_coupons' : 
-                    Coupon.objects.filter(
-                            store=request.user, is_redeemed=True).count(),
-            'issued_coupons' : 
-                    Coupon.objects.filter(
-                            store=request.user, is_valid=True).count(),
-            'expired_coupons' : 
-                    Coupon.objects.filter(
-                            store=request.user, is_expired=True).count(),
-            }
-        try:
-            # Handles zero division.
-            store_summary['conversion_rate'] = (
-                store_summary['redeemed_coupons'] / 
-                store_summary['issued_coupons'])
-        except:
-            store_summary['conversion_rate'] = None
-        context = {'store_summary' : store_summary, 
+        # Note: the summary is lazy, so a cached summary fragment skips its
+        # queries (see 'es_mvp/fragments.py').
+        context = {'store_summary' : SimpleLazyObject(
+                lambda: summarize_store(request.user)), 
                 'settings' : settings, 
                 }
+    context.update(fragment_context(request.user.id))
     return render(request, 'es_mvp/home.html', context)
 
 
+def summarize_store(store):
+    """Summarize the sales and coupons of a store. Returns a dict."""
+    return build_summary(run_queries(store_summary_queries(store)))
+
+
+async def home_async(request):
+    """
+    The home page, for the ASGI deployment: the summary queries run
+    concurrently (see 'es_mvp/dashboards.py').
+    """
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        context = {'store_summary' : False, 
+                'settings' : False, 
+                **await sync_to_async(fragment_context)(request.user.id)}
+        return await sync_to_async(render)(request, 'es_mvp/home.html', 
+                context)
+    with read_replica():
+        try:
+            settings = await sync_to_async(get_store_settings)(request.user)
+        except StoreSettings.DoesNotExist:
+            settings = None
+        context = {'store_summary' : False, 
+                'settings' : settings or False, 
+                **await sync_to_async(fragment_context)(request.user.id)}
+        if settings is not None:
+            context['store_summary'] = await dashboard_summary(context,
+                    store_summary_queries(request.user), 
+                    lambda: summarize_store(request.user), 'home_summary',
+                    request.user.id, context['data_version'])
+    return await sync_to_async(render)(request, 'es_mvp/home.html', context)
+
+
+async def dashboard_summary(context, queries, summarize, fragment_name, 
+        *vary_on):
+    """
+    Return the summary of an async dashboard. A cached summary fragment skips
+    the queries, and a partial summary is not cached.
+    """
+    if await sync_to_async(is_fragment_cached)(context, fragment_name, 
+            *vary_on):
+        # Note: if the fragment expires meanwhile, the template summarizes.
+        return SimpleLazyObject(summarize)
+    summary = build_summary(await gather_queries(queries, 
+            django_settings.DASHBOARD_QUERY_TIMEOUT))
+    if summary['is_partial']:
+        context['fragment_timeout'] = 0
+    return summary
+
+
 ### Sale view functions
 
 @login_required
+@replica_reads
 def sales(request):
     """List all sales for a store."""
-    settings = StoreSettings.objects.get(store=request.user)
-    sales = Sale.objects.filter(store=request.user).order_by('-date')
+    settings = get_store_settings(request.user)
+    sales = Sale.objects.filter(store=request.user).select_related(
+            'customer').order_by('-date')
     paginator = Paginator(sales, 25)
     page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
-    context = {'sales' : sales, 'settings' : settings, 'page_obj' : page_obj}
+    # Note: the page is lazy, so a cached list fragment skips its queries.
+    page_obj = SimpleLazyObject(lambda: paginator.get_page(page_number))
+    context = {'sales' : sales, 'settings' : settings, 'page_obj' : page_obj,
+            'page_number' : page_number, **fragment_context(request.user.id)}
     return render(request, 'es_mvp/sales.html', context)
 
 
 @login_required
+@condition(etag_func=sale_etag)
 def sale(request, sale_id):
     """Show details for a sale."""
-    sale = Sale.objects.get(id=sale_id)
+    # Note: the sale can be a live or an archived one.
+    sale = get_sale(sale_id)
     # Makes sure the sale belongs to the current store.
     check_content_owner(request, sale)
-    settings = StoreSettings.objects.get(store=request.user)
-    # If applicable, gets the coupon issued from this sale.
+    settings = get_store_settings(request.user)
+    # If applicable, gets the coupon issued from this sale. An archived sale 
+    # only issues archived coupons.
     # Note: Django 'get()' method needs exception handling.
+    if isinstance(sale, Sale):
+        issued_coupons = Coupon.objects
+    else:
+        issued_coupons = ArchivedCoupon.objects
     try:
-        issued_coupon = Coupon.objects.get(sale=sale.id)
+        issued_coupon = issued_coupons.get(sale=sale.id)
     except:
         issued_coupon = None
     context = {'sale' : sale, 'issued_coupon' : issued_coupon, 
             'settings' : settings}
-    return render(request, 'es_mvp/sale.html', context)
+    return patch_detail_cache(render(request, 'es_mvp/sale.html', context))
 
 
 @login_required
 def new_sale(request):
     """
     Add a new sale.
-    To deal with a 'new sale' recording, this function adopts a recursive 
-    approach, repeatedly self-reloading and routing its flow through conditional 
-    alternative clauses. 
+    The registration is a pipeline with up to three steps: (1) the customer 
+    lookup, (2) the cellphone validation of a new customer or the optional 
+    coupon redemption of a returning customer, and (3) the sale registration.
+    The intermediate state (store defaults, resolved customer, validation code 
+    and candidate coupons) is kept server-side in the session, so each step only
+    does its incremental work. Steps with nothing to do are skipped: a returning
+    customer without applicable coupons is registered in a single submission.
+    Requests that accept 'application/json' get a compact JSON response instead
+    of a full page.
+    The registration is idempotent: a resubmission with the same idempotency key
+    (the 'Idempotency-Key' header or the form field) gets the original outcome.
     """
-    # Gets default data to fill a 'new sale' form.
-    settings = StoreSettings.objects.get(store=request.user)
     ### At the first call function, no POST data has been sent yet. So, it 
-    # creates a form object, fills some initial data and renders a blank 'new 
+    # starts a new pipeline, fills some initial data and renders a blank 'new 
     # sale' page.
     if request.method != 'POST':
+        pipeline = start_sale_pipeline(request)
         form = SaleForm(
             initial={
-                'customer_country_code' : settings.country_code,
-                'customer_long_distance_code' : settings.long_distance_code,
+                'customer_country_code' : pipeline['country_code'],
+                'customer_long_distance_code' : 
+                        pipeline['long_distance_code'],
                 'initial_value' : 0.00,
                 'date' : date.today(),
-                # Sets control flow as 'False'.
-                'applicable_coupons_control' : False,
+                'idempotency_key' : secrets.token_urlsafe(16),
             },
             label_suffix="")
-        form.fields['initial_value'].label_suffix = f" {settings.currency}"
-    ### POST data was submitted. Now, the function flow handles data through 
-    # three alternative branches: (1) If there is a new user; (2) If they are a 
-    # previous user, with applicable coupons; (3) If they are a previous user, 
-    # without applicable coupons. At the end, all entries are processed in a 
-    # last common branch. 
-    else:
-        form = SaleForm(data=request.POST)
-        ### Gets the customer (if exists).
-        c_country_code = form['customer_country_code'].value()
-        c_long_distance_code = form['customer_long_distance_code'].value()
-        c_cellphone = form['customer_cellphone'].value()
-        customer_cellphone = clean_phone_number(c_country_code + 
-            c_long_distance_code + c_cellphone)
-        # Note: Django 'get()' method needs exception handling.
-        try:
-            customer = Customer.objects.get(cellphone=customer_cellphone)
-        except:
-            customer = None
-        ### First alternative branch: If there is a new customer, thus validates
-        # their data and registers them.
-        if not customer:
-            # Validates the customer cellphone. This sub-branch will be called 
-            # recursively until the data was validated
-            if not form['customer_verified'].value():
-                form = SaleForm(
-                    initial={
-                    'customer_country_code' : 
-                            form['customer_country_code'].value(),
-                    'customer_long_distance_code' : 
-                            form['customer_long_distance_code'].value(),
-                    'customer_cellphone' : form['customer_cellphone'].value(),
-                    'initial_value' : form['initial_value'].value(),
-                    'date' : form['date'].value(),
-                    },
-                    label_suffix="")
-                form.fields['initial_value'].label_suffix = f" {settings.currency}"
-                # Sends a validation code to the customer.
-                validation_code = cellphone_code_validation(customer_cellphone)
-                # Reloads new sale page with all new data. The 'new sale' form 
-                # will display the validation code and asks the user to confirm 
-                # this with the customer.
-                context = {'form': form, 'validation_code' : validation_code}
-                return render(request, 'es_mvp/new_sale.html', context)  
-            # When data customer was validated.
-            else:
-                # The 'ns_control_flag' hidden field permits that function flow 
-                # reaches the last common branch and concludes the new sale 
-                # processing. To update the status of 'ns_control_flag', it is 
-                # necessary to reinstantiate the all form.
-                form = SaleForm(
-                    initial={
-                    'customer_country_code' : 
-                            form['customer_country_code'].value(),
-                    'customer_long_distance_code' : 
-                            form['customer_long_distance_code'].value(),
-                    'customer_cellphone' : form['customer_cellphone'].value(),
-                    'initial_value' : form['initial_value'].value(),
-                    'date' : form['date'].value(),
-                    'ns_control_flag' : True
-                    },
-                    label_suffix="")
-                form.fields['initial_value'].label_suffix = f" {settings.currency}"
-                # Creates and saves a new customer.
-                customer = Customer.objects.create(
-                    store=request.user, cellphone=customer_cellphone, 
-                    is_verified=True)
-                # Reloads new sale page with all new data. The 'new sale' form 
-                # will ask about the 'new_sale.identifier' and, when submitted, 
-                # will conclude the new sale processing.
-                context = {'form': form}
-                return render(request, 'es_mvp/new_sale.html', context)  
-        # If they are a previous user but coupons availability was not checked.
-        elif customer and not form['ns_control_flag'].value():
-            # Searches for all valid, unredeemed, and non-expired coupons for the 
-            # customer. If there are applicable coupons, sort them in descending
-            # order.
-            applicable_coupons = Coupon.objects.filter(store=request.user, 
-                    customer=customer, is_redeemed=False, is_expired=False, 
-                    is_valid=True).order_by('-discount_value') 
-            ### Second alternative branch: The previous user has applicable 
-            # coupons. Thus, handles with a possible (optional) coupon 
-            # redemption.
-            if applicable_coupons:
-                # The 'ns_control_flag' hidden field permits that function flow 
-                # reaches the last common branch and concludes the new sale 
-                # processing. To update the status of 'ns_control_flag', it is 
-                # necessary to reinstantiate the all form.
-                form = SaleForm(
-                    initial={
-                    'customer_country_code' : 
-                            form['customer_country_code'].value(),
-                    'customer_long_distance_code' : 
-                            form['customer_long_distance_code'].value(),
-                    'customer_cellphone' : form['customer_cellphone'].value(),
-                    'initial_value' : form['initial_value'].value(),
-                    'date' : form['date'].value(),
-                    'ns_control_flag' : True,
-                    },
-                    label_suffix="")
-                form.fields['initial_value'].label_suffix = f" {settings.currency}"
-                ### Builds an applicable coupons choice list for a RadioSelect 
-                # fieldset. The first item on the list is 'None', a scenario 
-                # where no coupons are redeemed.
-                coupon_choices = [(None,"Não resgatar cupom para esta compra")]
-                # Each option contains useful information for choosing a coupon.
-                for coupon in applicable_coupons:
-                    # Calculates the effective discount.
-                    discount = sale_effective_discount(
-                            float(form['initial_value'].value()), 
-                            coupon.discount_value, 
-                            coupon.discount_limit_rate)
-                    # Calculates the final discounted value.
-                    final_value = (float(form['initial_value'].value()) - 
-                            discount)
-                    # Builds the choice item.
-                    choice = (coupon.id, (
-                        f"Cupom ID: {coupon.identifier} --- " + 
-                        f"Cashback: {settings.currency} {discount} --- " + 
-                        f"Valor final: {settings.currency} {final_value}"
-                        ))
-                    coupon_choices.append(choice)
-                form.fields['redeemed_coupon'].choices = coupon_choices
-                # Reload the new sales page with all new data. The 'new sale' 
-                # form displays all applicable coupons and will ask about an 
-                # optional coupon redemption. When submitted, it will complete 
-                # the processing of the new sale.
-                context = {'form': form, 
-                        'applicable_coupons' : applicable_coupons}
-                return render(request, 'es_mvp/new_sale.html', context)
-            ### Third alternative branch: The previous user does not have any
-            # applicable coupons.
-            else:
-                # The 'ns_control_flag' hidden field permits that function flow 
-                # reaches the last common branch and concludes the new sale 
-                # processing. To update the status of 'ns_control_flag', it is 
-                # necessary to reinstantiate the all form.
-                form = SaleForm(
-                    initial={
-                    'customer_country_code' : 
-                            form['customer_country_code'].value(),
-                    'customer_long_distance_code' : 
-                            form['customer_long_distance_code'].value(),
-                    'customer_cellphone' : form['customer_cellphone'].value(),
-                    'initial_value' : form['initial_value'].value(),
-                    'date' : form['date'].value(),
-                    'ns_control_flag' : True,
-                    },
-                    label_suffix="")
-                form.fields['initial_value'].label_suffix = f" {settings.currency}"
-                # To displays a "there are not applicable coupons" message.
-                not_applicable_coupons = True
-                # Reloads new sale page with all new data. The 'new sale' 
-                # form displays a "there are not applicable coupons" message. 
-                # When submitted, it will complete the processing of the 
-                # new sale.
-                context = {'form': form, 
-                        'not_applicable_coupons' : not_applicable_coupons}
-                return render(request, 'es_mvp/new_sale.html', context)  
-        ### The final common branch. Here, there are three important steps: (A)
-        # tests all data entries; (B) Handles an optional redeemed coupon; (C) 
-        # Registry the proper new sale; and (D) If new sale is eligible, issues 
-        # a new related coupon.
+        form.fields['initial_value'].label_suffix = f" {pipeline['currency']}"
+        return render_sale_step(request, form, 'lookup')
+    ### POST data was submitted. A retried registration gets its original
+    # outcome, in a single lookup.
+    idempotency_key = sale_idempotency_key(request)
+    if len(idempotency_key) > SaleIdempotencyKey._meta.get_field(
+            'key').max_length:
+        return JsonResponse({'error' : 'Invalid idempotency key.'}, 
+                status=400)
+    if idempotency_key:
+        registration = SaleIdempotencyKey.objects.filter(store=request.user, 
+                key=idempotency_key).exclude(sale=None).first()
+        if registration:
+            return replay_sale(request, registration)
+    # Note: the pipeline is restarted if the session has expired.
+    pipeline = request.session.get(SALE_PIPELINE_KEY) or start_sale_pipeline(
+            request)
+    form = SaleForm(data=request.POST, label_suffix="")
+    form.fields['initial_value'].label_suffix = f" {pipeline['currency']}"
+    # Keeps the candidate coupons (if any) on display.
+    form.fields['redeemed_coupon'].choices = (NO_COUPON_CHOICE + 
+            [tuple(choice) for choice in pipeline['coupon_choices'] or []])
+    # Checks the POS sale identifier against the store sales (see 
+    # 'SALE_IDENTIFIER_POLICY' in the app settings.py).
+    # Note: it is checked again at the registration (see below).
+    duplicate = form.is_valid() and duplicate_sale(request.user, 
+            form.cleaned_data['identifier'])
+    if duplicate and (django_settings.SALE_IDENTIFIER_POLICY == 'attach'):
+        return attach_sale(request, *duplicate)
+    elif duplicate and (django_settings.SALE_IDENTIFIER_POLICY == 'reject'):
+        reject_sale(form)
+    # Tests all data entries once, before any other work (like sending SMS).
+    # Note: the current step is displayed again, with the errors.
+    if not form.is_valid():
+        return render_invalid_sale(request, form, pipeline)
+    customer_cellphone = clean_phone_number(
+            form.cleaned_data['customer_country_code'] + 
+            form.cleaned_data['customer_long_distance_code'] + 
+            form.cleaned_data['customer_cellphone'])
+    initial_value = form.cleaned_data['initial_value']
+    ### (1) Resolves the customer, only once per cellphone number.
+    if pipeline['cellphone'] != customer_cellphone:
+        customer = Customer.objects.filter(store=request.user, 
+                cellphone=customer_cellphone).first()
+        pipeline.update({
+            'cellphone' : customer_cellphone,
+            'customer_id' : customer.id if customer else None,
+            'validation_code' : None,
+            'coupon_choices' : None,
+            'initial_value' : None,
+            })
+    ### (2.1) If there is a new customer, validates their cellphone and 
+    # registers them.
+    if not pipeline['customer_id']:
+        # This step is repeated (resending the SMS) until the customer 
+        # cellphone was validated.
+        if not form.cleaned_data['customer_verified']:
+            # Sends a validation code to the customer. The 'new sale' form will
+            # display the validation code and asks the user to confirm this 
+            # with the customer.
+            pipeline['validation_code'] = cellphone_code_validation(
+                    customer_cellphone)
+            save_sale_pipeline(request, pipeline)
+            return render_sale_step(request, form, 'verify', 
+                    validation_code=pipeline['validation_code'])
+        # Creates and saves a new customer. A new customer does not have any
+        # coupon, thus the flow goes straight to the registration.
+        customer = Customer.objects.create(
+            store=request.user, cellphone=customer_cellphone, 
+            is_verified=True)
+        pipeline.update({
+            'customer_id' : customer.id,
+            'coupon_choices' : [],
+            'initial_value' : initial_value,
+            })
+    ### (2.2) If they are a previous customer, searches for the best 
+    # applicable coupons. It is done again only if the sale value changed.
+    if pipeline['initial_value'] != initial_value:
+        coupon_choices = applicable_coupon_choices(request.user, 
+                pipeline['customer_id'], initial_value, pipeline['currency'])
+        pipeline.update({
+            'coupon_choices' : coupon_choices,
+            'initial_value' : initial_value,
+            })
+        save_sale_pipeline(request, pipeline)
+        # The 'new sale' form displays all applicable coupons and asks about 
+        # an optional coupon redemption. When submitted, it will complete the 
+        # processing of the new sale.
+        if coupon_choices:
+            form.fields['redeemed_coupon'].choices = (NO_COUPON_CHOICE + 
+                    coupon_choices)
+            # Shows the customer wallet (a single-row read).
+            return render_sale_step(request, form, 'redeem', 
+                    coupon_choices=coupon_choices, profile=profile_data(
+                    get_profile(pipeline['customer_id'])))
+    ### (3) The registration. Here, there are three important steps: (A) 
+    # Handles an optional redeemed coupon; (B) Registry the proper new sale; 
+    # and (C) If new sale is eligible, issues a new related coupon.
+    new_sale = form.save(commit=False)
+    candidate_ids = [choice[0] for choice in pipeline['coupon_choices']]
+    with transaction.atomic(using=store_db()):
+        # Claims the idempotency key. Note: a concurrent retry waits here for
+        # the first registration, then gets its outcome.
+        if idempotency_key:
+            registration, created = SaleIdempotencyKey.objects.get_or_create(
+                    store=request.user, key=idempotency_key)
+            if not created:
+                return replay_sale(request, registration)
+        # Checks the POS sale identifier again, holding the store lock, so the
+        # concurrent registrations of the same identifier are serialized.
+        if django_settings.SALE_IDENTIFIER_POLICY != 'allow':
+            lock_store(request.user)
+            duplicate = duplicate_sale(request.user, new_sale.identifier)
+            if duplicate:
+                # Note: the idempotency key claim is rolled back.
+                transaction.set_rollback(True, using=store_db())
+                if django_settings.SALE_IDENTIFIER_POLICY == 'attach':
+                    return attach_sale(request, *duplicate)
+                reject_sale(form)
+                return render_invalid_sale(request, form, pipeline)
+        ### (A.1) If applicable, handles the redeemed coupon. Note: only a 
+        # candidate coupon, still applicable, can be redeemed.
+        redeemed_coupon = form.cleaned_data['redeemed_coupon']
+        if redeemed_coupon and (redeemed_coupon.id in candidate_ids):
+            redeemed_coupon = Coupon.objects.select_for_update().applicable(
+                    ).filter(id=redeemed_coupon.id).first()
         else:
-            ### (A) Tests all data entries;
-            if form.is_valid():
-                # Saves a "raw" version from the form.
-                new_sale = form.save(commit=False)
-                ### (B.1) If applicable, handles the redeemed coupon.
-                try:
-                    redeemed_coupon = Coupon.objects.get(
-                            id=form['redeemed_coupon'].value())
-                except:
-                    redeemed_coupon = None
-                # Calculates 'effective_discount' and the 'final_value'.
-                if not redeemed_coupon:
-                    effective_discount = 0.00
-                    final_value = form['initial_value'].value()
-                else: 
-                    effective_discount = sale_effective_discount(
-                        float(form['initial_value'].value()), 
-                        redeemed_coupon.discount_value, 
-                        redeemed_coupon.discount_limit_rate)
-                    final_value = (float(form['initial_value'].value()) - 
-                            effective_discount)
-                ### (C) Completes and saves the new sale.
-                new_sale.store = request.user
-                new_sale.customer = customer
-                new_sale.effective_discount = effective_discount
-                new_sale.final_value = final_value
-                new_sale.redeemed_coupon = redeemed_coupon
-                new_sale.save()
-                ### (B.2) Updates the status of the redemeed coupon.
-                if redeemed_coupon:
-                    redeemed_coupon.is_redeemed = True
-                    redeemed_coupon.save()
-                ### (D) Evaluates the sale eligibility and, case positive, 
-                # issues a new coupon.
-                evaluate_for_coupon(new_sale.id)
-                # At the final, redirects to new sale detail page.
-                messages.success(request, "Venda registrada com sucesso.", 
-                    extra_tags='alert alert-success alert-dismissible fade show')
-                return redirect('es_mvp:sale', new_sale.id)
-    # Note, this 'return' can be output to two alternative flows: (1) A first 
-    # call to this view function, without a POST submission; or (2) A POST 
-    # submission that failed the 'is_valid()' test. 
-    context = {'form': form}
-    return render(request, 'es_mvp/new_sale.html', context)
+            redeemed_coupon = None
+        # Calculates 'effective_discount' and the 'final_value'.
+        if not redeemed_coupon:
+            effective_discount = 0.00
+            final_value = initial_value
+        else: 
+            effective_discount = sale_effective_discount(initial_value, 
+                redeemed_coupon.discount_value, 
+                redeemed_coupon.discount_limit_rate)
+            final_value = initial_value - effective_discount
+        ### (B) Completes and saves the new sale.
+        new_sale.store = request.user
+        new_sale.customer_id = pipeline['customer_id']
+        new_sale.effective_discount = effective_discount
+        new_sale.final_value = final_value
+        new_sale.redeemed_coupon = redeemed_coupon
+        new_sale.save()
+        ### (A.2) Updates the status of the redemeed coupon.
+        if redeemed_coupon:
+            redeemed_coupon.transition_to(CouponState.REDEEMED)
+            redeemed_coupon.save()
+            CouponEvent.objects.record(CouponEventType.REDEEMED, 
+                    [(redeemed_coupon.id, redeemed_coupon.store_id)])
+        # Updates the customer profile (purchase history and wallet).
+        record_sale(new_sale)
+        # Invalidates the cached store fragments (see 'es_mvp/fragments.py').
+        bump_data_version(request.user.id)
+        ### (C) Evaluates the sale eligibility and, case positive, issues a new
+        # coupon.
+        new_coupon = evaluate_for_coupon(new_sale.id)
+        if not new_coupon:
+            # The coupon issuance may have been held by the velocity checks.
+            new_sale.refresh_from_db(fields=['is_flagged'])
+        # Records the outcome of the idempotency key.
+        if idempotency_key:
+            registration.sale = new_sale
+            registration.issued_coupon = new_coupon
+            registration.is_flagged = new_sale.is_flagged
+            registration.save()
+    # The pipeline is concluded.
+    del request.session[SALE_PIPELINE_KEY]
+    if accepts_json(request):
+        return JsonResponse({'step' : 'done', 'sale_id' : new_sale.id, 
+                'issued_coupon_id' : new_coupon.id if new_coupon else None,
+                'is_flagged' : new_sale.is_flagged})
+    # At the final, redirects to new sale detail page.
+    messages.success(request, "Venda registrada com sucesso.", 
+        extra_tags='alert alert-success alert-dismissible fade show')
+    return redirect('es_mvp:sale', new_sale.id)
+
+
+@login_required
+def customer_wallet(request):
+    """
+    Look up a customer of the store by the cellphone number (ex. 
+    '?cellphone=5511999999999') and return their profile: the cashback wallet 
+    and the purchase history. Returns a JSON response.
+    """
+    cellphone = clean_phone_number(request.GET.get('cellphone', ''))
+    customer = Customer.objects.filter(store=request.user, 
+            cellphone=cellphone).values_list('id', flat=True).first()
+    if not customer:
+        return JsonResponse({'error' : 'Customer not found.'}, status=404)
+    return JsonResponse({'customer_id' : customer, 
+            'profile' : profile_data(get_profile(customer))})
 
 
 ### Campaign view functions
 
 @login_required
+@replica_reads
 def campaigns(request):
     """List all campaigns for a store."""
-    settings = StoreSettings.objects.get(store=request.user)
+    settings = get_store_settings(request.user)
     campaigns = Campaign.objects.filter(
             store=request.user).order_by('-date_added')
     paginator = Paginator(campaigns, 25)
@@ -343,60 +400,65 @@ def campaigns(request):
 
 
 @login_required
+@condition(etag_func=campaign_etag)
+@replica_reads
 def campaign(request, campaign_id):
     """Show details for a campaign."""
     campaign = Campaign.objects.get(id=campaign_id)
     # Makes sure the campaign belongs to the current store.
     check_content_owner(request, campaign)
-    settings = StoreSettings.objects.get(store=request.user)
-    ### Summarizes only incentived sales. 
-    # Gets campaign's redeemed coupons.
-    c_redeemed_coupons =  Coupon.objects.filter(
-            campaign=campaign.id, is_redeemed=True)
-    # Gets all incentived sales.
-    incentived_sales = Sale.objects.filter(
-            store=request.user).exclude(redeemed_coupon=None)
-    campaign_incentived_sales = []
-    for sale in incentived_sales:
-        for coupon in c_redeemed_coupons:
-            if sale.redeemed_coupon.id == coupon.id:
-                campaign_incentived_sales.append(sale.final_value)
-    cumulative_sales = sum(campaign_incentived_sales)
-    # Summarizes the cashback given. Returns a dict.
-    cumulative_cashback = Coupon.objects.filter(
-        campaign=campaign.id, is_redeemed=True).aggregate(
-        Sum('discount_value', default=0.00))
-
-    campaign_summary = {
-        'cumulative_sales' : cumulative_sales,
-        'cumulative_cashback' : cumulative_cashback['discount_value__sum'],
-        'redeemed_coupons' : 
-                Coupon.objects.filter(
-                        campaign=campaign.id, is_redeemed=True).count(),
-        'issued_coupons' : 
-                Coupon.objects.filter(
-                        campaign=campaign.id, is_valid=True).count(),
-        'expired_coupons' : 
-                Coupon.objects.filter(
-                        campaign=campaign.id, is_expired=True).count(),
-        }
-    try:
-        # Handles zero division.
-        campaign_summary['conversion_rate'] = (
-            campaign_summary['redeemed_coupons'] / 
-            campaign_summary['issued_coupons'])
-    except:
-        campaign_summary['conversion_rate'] = None
+    settings = get_store_settings(request.user)
+    # Note: the summary is lazy, so a cached summary fragment skips its
+    # queries (see 'es_mvp/fragments.py').
+    campaign_summary = SimpleLazyObject(lambda: summarize_campaign(campaign))
     context = {'campaign' : campaign, 'campaign_summary' : campaign_summary,
-            'settings' : settings}
-    return render(request, 'es_mvp/campaign.html', context)
+            'settings' : settings, **fragment_context(request.user.id)}
+    return patch_detail_cache(render(request, 'es_mvp/campaign.html', 
+            context))
+
+
+def summarize_campaign(campaign):
+    """Summarize the sales and coupons of a campaign. Returns a dict."""
+    return build_summary(run_queries(campaign_summary_queries(campaign)))
+
+
+async def campaign_async(request, campaign_id):
+    """
+    Show details for a campaign, for the ASGI deployment: the summary queries
+    run concurrently (see 'es_mvp/dashboards.py').
+    """
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return redirect_to_login(request.get_full_path())
+    # Conditional GET (see 'es_mvp/conditional.py').
+    etag = await sync_to_async(campaign_etag)(request, campaign_id)
+    etag = quote_etag(etag) if etag else None
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        return response
+    with read_replica():
+        campaign = await Campaign.objects.filter(id=campaign_id).afirst()
+        # Makes sure the campaign belongs to the current store.
+        if (campaign is None) or (campaign.store_id != request.user.id):
+            raise Http404
+        settings = await sync_to_async(get_store_settings)(request.user)
+        context = {'campaign' : campaign, 'settings' : settings, 
+                **await sync_to_async(fragment_context)(request.user.id)}
+        context['campaign_summary'] = await dashboard_summary(context,
+                campaign_summary_queries(campaign), 
+                lambda: summarize_campaign(campaign), 'campaign_summary',
+                request.user.id, context['data_version'], campaign.id)
+    response = await sync_to_async(render)(request, 'es_mvp/campaign.html', 
+            context)
+    if etag and (request.method in ('GET', 'HEAD')):
+        response.headers['ETag'] = etag
+    return patch_detail_cache(response)
 
 
 @login_required
 def new_campaign(request):
     """Add a new campaign."""
     # Gets default data to build a campaign.
-    settings = StoreSettings.objects.get(store=request.user)
+    settings = get_store_settings(request.user)
     if request.method != 'POST':
         # No data submitted; Creates a blank form with some initial data.
         form = CampaignForm(
@@ -412,11 +474,36 @@ def new_campaign(request):
     else:
         # POST request submitted; Deals with its data.
         form = CampaignForm(data=request.POST)
-        if form.is_valid():
+        if form.is_valid() and ('simulate' in request.POST):
+            # Projects the submitted campaign, and some variations of its 
+            # cashback rate and coupon lifetime, over the historical sales.
+            # Then, displays the form again with the simulation results.
+            # Note: the simulator (numpy) is loaded on its first use.
+            from . import simulator
+            data = form.cleaned_data
+            bonus_rate = data['bonus_rate']
+            coupon_lifetime = data['coupon_lifetime']
+            grid = simulator.campaign_grid(
+                    min_sale_value=[data['min_sale_value']],
+                    max_sale_value=[data['max_sale_value']],
+                    bonus_rate=sorted({max(0, bonus_rate + delta) 
+                            for delta in (-10, -5, 0, 5, 10)}),
+                    discount_limit_rate=[data['discount_limit_rate']],
+                    coupon_lifetime=sorted({coupon_lifetime, 15, 30, 45, 60, 
+                            90}))
+            history = simulator.load_sales_history(request.user.id)
+            simulation = simulator.simulation_rows(grid, 
+                    simulator.simulate_campaigns(history, grid))
+            context = {'form': form, 'simulation' : simulation,
+                    'simulated_sales' : len(history['final_value']),
+                    'settings' : settings}
+            return render(request, 'es_mvp/new_campaign.html', context)
+        elif form.is_valid():
             new_campaign = form.save(commit=False)
             # Assigns the store owner and save.
             new_campaign.store = request.user
             new_campaign.save()
+            bump_data_version(request.user.id)
             # After saving the submitted data, redirects to the campaign list.
             messages.success(request, "Campanha criada com sucesso.", 
                     extra_tags='alert alert-success alert-dismissible fade show')
@@ -426,6 +513,45 @@ def new_campaign(request):
     return render(request, 'es_mvp/new_campaign.html', context)
 
 
+@login_required
+@replica_reads
+def simulate_campaign(request):
+    """
+    Simulate a grid of campaign parameters over the historical sales. Returns a
+    JSON response. Each parameter can be repeated in the query string (ex. 
+    '?bonus_rate=10&bonus_rate=20'). The missing ones take the store defaults.
+    """
+    settings = get_store_settings(request.user)
+    defaults = {
+        'min_sale_value' : 0.00,
+        'max_sale_value' : 100000.00,
+        'bonus_rate' : settings.bonus_rate,
+        'discount_limit_rate' : settings.discount_limit_rate,
+        'coupon_lifetime' : settings.coupon_lifetime,
+        }
+    try:
+        parameters = {name : [float(value) for value in 
+                request.GET.getlist(name, [default])] 
+                for name, default in defaults.items()}
+    except ValueError:
+        return JsonResponse({'error' : 'Invalid parameter value.'}, status=400)
+    if not all(isfinite(value) for values in parameters.values() 
+            for value in values):
+        return JsonResponse({'error' : 'Invalid parameter value.'}, status=400)
+    # Note: the grid size is checked before the grid is built.
+    if prod(len(values) for values in parameters.values()) > (
+            django_settings.SIMULATOR_MAX_COMBINATIONS):
+        return JsonResponse({'error' : 'Too many combinations.'}, status=400)
+    # Note: the simulator (numpy) is loaded on its first use.
+    from . import simulator
+    grid = simulator.campaign_grid(**parameters)
+    history = simulator.load_sales_history(request.user.id)
+    simulation = simulator.simulation_rows(grid, 
+            simulator.simulate_campaigns(history, grid))
+    return JsonResponse({'simulated_sales' : len(history['final_value']),
+            'simulation' : simulation})
+
+
 @login_required
 def edit_campaign(request, campaign_id):
     """Edit a campaign."""
@@ -433,7 +559,7 @@ def edit_campaign(request, campaign_id):
     campaign = Campaign.objects.get(id=campaign_id)
     # Makes sure the campaign belongs to the current store.
     check_content_owner(request, campaign)   
-    settings = StoreSettings.objects.get(store=request.user)
+    settings = get_store_settings(request.user)
     if request.method != 'POST':
         # Initial request; Pre-fills form with the current campaign.
         form = CampaignForm(instance=campaign)
@@ -444,6 +570,7 @@ def edit_campaign(request, campaign_id):
         form = CampaignForm(instance=campaign, data=request.POST)
         if form.is_valid():
             form.save()
+            bump_data_version(request.user.id)
             # Saves the updated data, and redirects to the campaign detail page.
             messages.success(request, "Campanha editada com sucesso.", 
                     extra_tags='alert alert-success alert-dismissible fade show')
@@ -456,9 +583,10 @@ def edit_campaign(request, campaign_id):
 ### Coupon view functions
 
 @login_required
+@replica_reads
 def coupons(request):
     """List all coupons for a store."""
-    settings = StoreSettings.objects.get(store=request.user)
+    settings = get_store_settings(request.user)
     # Gets the paramters to filter.
     customer_id = request.GET.get('customer_id', None)
     if customer_id:
@@ -470,32 +598,38 @@ def coupons(request):
                 store=request.user).order_by('-date_added')
     paginator = Paginator(coupons, 25)
     page_number = request.GET.get("page")
-    page_obj = paginator.get_page(page_number)
+    # Note: the page is lazy, so a cached list fragment skips its queries.
+    page_obj = SimpleLazyObject(lambda: paginator.get_page(page_number))
     context = {'coupons' : coupons, 'settings' : settings, 
-            'page_obj' : page_obj}
+            'page_obj' : page_obj, 'page_number' : page_number,
+            'customer_id' : customer_id, **fragment_context(request.user.id)}
     return render(request, 'es_mvp/coupons.html', context)
 
 
 @login_required
+@condition(etag_func=coupon_etag)
 def coupon(request, coupon_id):
     """Show details for a coupon."""
-    coupon = Coupon.objects.get(id=coupon_id)
+    # Note: the coupon can be a live or an archived one.
+    coupon = get_coupon(coupon_id)
     # Makes sure the coupon belongs to the current store.
     check_content_owner(request, coupon)
-    settings = StoreSettings.objects.get(store=request.user)
-    # Gets the sale that originated the coupon issuance.
-    origination_sale = Sale.objects.get(id=coupon.sale.id)
+    settings = get_store_settings(request.user)
+    # Gets the sale that originated the coupon issuance. An archived coupon 
+    # only references archived sales.
+    origination_sale = coupon.sale
     # If applicable, gets the sale where this coupon was redeemed.
     # Note: Django 'get()' method needs exception handling.
     try:
-        bonified_sale = Sale.objects.get(redeemed_coupon=coupon.id)
+        bonified_sale = coupon.redeemed_coupon
     except:
         bonified_sale = None
     context = {'coupon' : coupon,
             'origination_sale' : origination_sale,
             'bonified_sale' : bonified_sale,
             'settings' : settings}
-    return render(request, 'es_mvp/coupon.html', context)
+    return patch_detail_cache(render(request, 'es_mvp/coupon.html', 
+            context))
 
 
 ### Store settings view functions
@@ -521,6 +655,8 @@ def edit_store_settings(request):
         form = StoreSettingsForm(instance=store_settings, data=request.POST)
         if form.is_valid():
             form.save()
+            # The cached fragments show the store currency.
+            bump_data_version(request.user.id)
             # After saving data, redirects to home.
             messages.success(request, 
                     "Configurações da loja atualizadas com sucesso.", 
@@ -536,13 +672,16 @@ def edit_store_settings(request):
 ### Note: the handling of expired coupons, as well as the activation message
 ### sending service are implemented as cronjob tasks. See 'es_mvp/cron.py.
 
-def evaluate_for_coupon(sale_id):
+def evaluate_for_coupon(sale_id, check_velocity=True):
     """
     Evaluate a new sale object and issue a coupon if eligible.
     The coupon issuance is a concomitant process with new sale registration. 
     This backoffice function checks whether a sale matches the conditions of an 
     active campaign and, if so, uses this campaign's settings to issue a new 
     coupon.
+    The sale is also counted by the velocity checks (see 'es_mvp/velocity.py').
+    A suspect sale is flagged and its coupon issuance is held: the sale stays
+    "not evaluated" until released (see 'release_held_sale()').
     """
     # Gets the new sale.
     new_sale = Sale.objects.get(id=sale_id)
@@ -550,47 +689,67 @@ def evaluate_for_coupon(sale_id):
     # campaign that matches the sale, choose the one with the highest bonus 
     # rate.
     active_campaigns = Campaign.objects.filter(
-            store=new_sale.store.id, is_active=True).order_by('-bonus_rate')
-    # Checks if there are active campaigns.
-    if active_campaigns:
-        for campaign in active_campaigns:
-            # If new sale matches with the campaign. Currently, the campaign 
-            # instances has only eligibilty criteria associated with the range 
-            # of sale final value.
-            if ((new_sale.final_value >= campaign.min_sale_value) and
-                    (new_sale.final_value <= campaign.max_sale_value)):
-                # Thus, creates and saves a new coupon. 
-                # Note: The Django 'create()' method instantiates and saves a 
-                # model object.
-                new_coupon = Coupon.objects.create(
-                        store=new_sale.store,
-                        sale=new_sale,
-                        campaign=campaign,
-                        customer= new_sale.customer,
-                        identifier=coupon_identifier(),
-                        discount_value=coupon_discount_value(
-                                new_sale.final_value, 
-                                campaign.bonus_rate),
-                        discount_limit_rate=campaign.discount_limit_rate,
-                        expiration_date=(date.today() + timedelta(
-                                days=campaign.coupon_lifetime)),
-                        )
-                # Updates the new sale status to evaluated and returns the 
-                # corresponding new coupon.
-                new_sale.is_evaluated = True
-                new_sale.save()
-                return new_coupon
-            else:
-                new_coupon = None 
+            store=new_sale.store_id, is_active=True).order_by('-bonus_rate')
+    # If new sale matches with the campaign. Currently, the campaign instances 
+    # has only eligibilty criteria associated with the range of sale final 
+    # value.
+    campaign = next((campaign for campaign in active_campaigns 
+            if campaign.min_sale_value <= new_sale.final_value <= 
+            campaign.max_sale_value), None)
+    discount_value = coupon_discount_value(new_sale.final_value, 
+            campaign.bonus_rate) if campaign else 0.0
+    # Checks the velocity rules before the coupon issuance. Note: the sale is
+    # counted when the registration commits.
+    if check_velocity:
+        violations = velocity.track_sale(new_sale.store_id, 
+                new_sale.customer_id, cashback=discount_value, 
+                using=store_db())
+        if violations:
+            new_sale.is_flagged = True
+            new_sale.flag_reason = "; ".join(violations)[:200]
+            new_sale.save(update_fields=['is_flagged', 'flag_reason'])
+            return None
+    if campaign:
+        # Thus, creates and saves a new coupon. 
+        # Note: The Django 'create()' method instantiates and saves a model 
+        # object.
+        new_coupon = Coupon.objects.create(
+                store_id=new_sale.store_id,
+                sale=new_sale,
+                campaign=campaign,
+                customer_id=new_sale.customer_id,
+                identifier=coupon_identifier(),
+                discount_value=discount_value,
+                discount_limit_rate=campaign.discount_limit_rate,
+                expiration_date=(date.today() + timedelta(
+                        days=campaign.coupon_lifetime)),
+                )
+        # Note: the callers run in a transaction (see 'CouponEvent').
+        CouponEvent.objects.record(CouponEventType.ISSUED, 
+                [(new_coupon.id, new_coupon.store_id)])
     else:
         new_coupon = None 
-    # Case there aren't active campaigns or the sale does not match any 
-    # campaign, updates the sale status to evaluated and returns 'None'.
+    # Updates the new sale status to evaluated and returns the corresponding 
+    # new coupon. Case there aren't active campaigns or the sale does not match 
+    # any campaign, returns 'None'.
     new_sale.is_evaluated = True
-    new_sale.save()
+    new_sale.save(update_fields=['is_evaluated'])
     return new_coupon
 
 
+def release_held_sale(sale_id):
+    """
+    Release a flagged sale, issuing its held coupon (if eligible). Returns the
+    new coupon or None.
+    """
+    with transaction.atomic(using=store_db()):
+        sale = Sale.objects.select_for_update().get(id=sale_id)
+        if not sale.is_flagged or sale.is_evaluated:
+            return None
+        bump_data_version(sale.store_id)
+        return evaluate_for_coupon(sale.id, check_velocity=False)
+
+
 def coupon_discount_value(sale_final_value, campaign_bonus_rate):
     """
     Calculate the 'coupon.discount_value' attribute when issuing a coupon.
@@ -618,6 +777,159 @@ def sale_effective_discount(sale_initial_value, coupon_discount_value,
         effective_discount = coupon_discount_value
     return effective_discount
 
+def applicable_coupon_choices(store, customer, sale_initial_value, currency,
+        limit=None):
+    """
+    Build the choice list of the best applicable coupons for a new sale.
+    The effective discount of each coupon is calculated, sorted and limited in a
+    single query (see 'CouponQuerySet.with_effective_discount()'), so the best 
+    coupon is always the first choice. Each choice item is a tuple (coupon id, 
+    label) and the label contains useful information for choosing a coupon.
+    """
+    if limit is None:
+        limit = django_settings.APPLICABLE_COUPONS_LIMIT
+    applicable_coupons = Coupon.objects.filter(store=store, 
+            customer=customer).applicable().with_effective_discount(
+            sale_initial_value).order_by('-effective_discount', 
+            'expiration_date').values_list('id', 'identifier', 
+            'effective_discount')[:limit]
+    coupon_choices = []
+    for coupon_id, identifier, discount in applicable_coupons:
+        # Note: the SQL result can be an integer.
+        discount = float(discount)
+        # Calculates the final discounted value.
+        final_value = sale_initial_value - discount
+        # Builds the choice item.
+        choice = (coupon_id, (
+            f"Cupom ID: {identifier} --- " + 
+            f"Cashback: {currency} {discount} --- " + 
+            f"Valor final: {currency} {final_value}"
+            ))
+        coupon_choices.append(choice)
+    return coupon_choices
+
+
+def start_sale_pipeline(request):
+    """
+    Start a 'new sale' pipeline in the session. The store defaults are loaded
+    once, at the pipeline start.
+    """
+    settings = get_store_settings(request.user)
+    pipeline = {
+        'currency' : settings.currency,
+        'country_code' : settings.country_code,
+        'long_distance_code' : settings.long_distance_code,
+        # The resolved customer.
+        'cellphone' : None,
+        'customer_id' : None,
+        'validation_code' : None,
+        # The candidate coupons for the 'initial_value'.
+        'coupon_choices' : None,
+        'initial_value' : None,
+        }
+    save_sale_pipeline(request, pipeline)
+    return pipeline
+
+
+def sale_idempotency_key(request):
+    """
+    Return the idempotency key of a sale registration: the 'Idempotency-Key'
+    header (API clients) or the form field. Returns '' if there is none.
+    """
+    return (request.headers.get('Idempotency-Key') or 
+            request.POST.get('idempotency_key') or '').strip()
+
+
+def replay_sale(request, registration):
+    """Respond a retried sale registration with its original outcome."""
+    if accepts_json(request):
+        return JsonResponse({'step' : 'done', 'sale_id' : registration.sale_id, 
+                'issued_coupon_id' : registration.issued_coupon_id,
+                'is_flagged' : registration.is_flagged, 'replayed' : True})
+    return redirect('es_mvp:sale', registration.sale_id)
+
+
+def render_invalid_sale(request, form, pipeline):
+    """Display the current step of the sale pipeline again, with the errors."""
+    if pipeline['validation_code'] and not pipeline['customer_id']:
+        return render_sale_step(request, form, 'verify', status=400, 
+                validation_code=pipeline['validation_code'])
+    elif pipeline['coupon_choices']:
+        return render_sale_step(request, form, 'redeem', status=400, 
+                coupon_choices=pipeline['coupon_choices'])
+    return render_sale_step(request, form, 'lookup', status=400)
+
+
+def duplicate_sale(store, identifier):
+    """
+    Find a store sale (live or archived) with the same POS identifier. Returns
+    a tuple (sale id, is flagged, issued coupon id), or None.
+    """
+    if not identifier:
+        return None
+    return (Sale.objects.filter(store=store, identifier=identifier).values_list(
+            'id', 'is_flagged', 'coupon').first() or 
+            ArchivedSale.objects.filter(store=store, 
+            identifier=identifier).values_list('id', 'is_flagged', 
+            'archivedcoupon').first())
+
+
+def lock_store(store):
+    """
+    Lock the store row (in the shard of the store rows) until the end of the
+    current transaction.
+    """
+    User.objects.using(store_db()).select_for_update().filter(
+            id=store.id).first()
+
+
+def reject_sale(form):
+    """Add the duplicate POS identifier error to a sale form."""
+    form.add_error('identifier', ValidationError(
+            _("This sale ID was already registered."), 
+            code='identifier_duplicate'))
+
+
+def attach_sale(request, sale_id, is_flagged, issued_coupon_id):
+    """
+    Respond a sale registration with the existing sale of the same POS 
+    identifier. The pipeline is concluded without a new sale.
+    """
+    request.session.pop(SALE_PIPELINE_KEY, None)
+    if accepts_json(request):
+        return JsonResponse({'step' : 'done', 'sale_id' : sale_id, 
+                'issued_coupon_id' : issued_coupon_id, 
+                'is_flagged' : is_flagged, 'duplicate' : True})
+    messages.warning(request, "Venda já registrada com este ID.", 
+        extra_tags='alert alert-warning alert-dismissible fade show')
+    return redirect('es_mvp:sale', sale_id)
+
+
+def save_sale_pipeline(request, pipeline):
+    """Save the 'new sale' pipeline state in the session."""
+    request.session[SALE_PIPELINE_KEY] = pipeline
+
+
+def render_sale_step(request, form, step, status=200, **context):
+    """
+    Render a 'new sale' pipeline step. Renders the full page or, if the request
+    accepts it, a compact JSON response.
+    """
+    if accepts_json(request):
+        data = {'step' : step}
+        data.update(context)
+        if form.is_bound and form.errors:
+            data['errors'] = form.errors.get_json_data()
+        return JsonResponse(data, status=status)
+    context.update({'form' : form, 'step' : step})
+    return render(request, 'es_mvp/new_sale.html', context)
+
+
+def accepts_json(request):
+    """Check if the client asked for a JSON response."""
+    return 'application/json' in request.headers.get('Accept', '')
+
+
 def coupon_identifier():
     """Generate a random alfanumeric string code with lenght=6'."""
     code = ''.join(secrets.choice('0123456789ABCDEF') for i in range(6))
@@ -630,17 +942,19 @@ def initial_store_settings(store_id):
     new user (store) registration.
     """
     store = User.objects.get(id=store_id)
-    store_settings = StoreSettings.objects.create(
-            store=store,
-            title='',
-            country_code="55",
-            long_distance_code="11",
-            currency="R$",
-            url='',
-            bonus_rate=20,
-            discount_limit_rate=30,
-            coupon_lifetime=45,
-            )
+    # Note: a new store is placed in a shard (see 'es_mvp/sharding.py').
+    with use_store(store_id):
+        store_settings = StoreSettings.objects.create(
+                store=store,
+                title='',
+                country_code="55",
+                long_distance_code="11",
+                currency="R$",
+                url='',
+                bonus_rate=20,
+                discount_limit_rate=30,
+                coupon_lifetime=45,
+                )
     # Return the new object.
     return store_settings
 
@@ -665,11 +979,3 @@ def clean_phone_number(phone_number):
     """Clear phone numbers, eliminating symbols, blank space and letters."""
     cleaned_number = re.sub(r'[^0-9]', '', phone_number)
     return cleaned_number
-
-
-
-
-
-
-
-
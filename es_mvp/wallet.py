@@ -0,0 +1,131 @@
+"""
+Maintain the denormalized customer profiles (see 'CustomerProfile').
+"""
+from django.db.models import Count, Max, Min, Sum, F, Value
+from django.db.models.functions import Coalesce, Greatest
+from .models import Customer, CustomerProfile, Sale, ArchivedSale, Coupon
+from datetime import date
+
+
+# The wallet fields, derived from the applicable coupons.
+WALLET_FIELDS = ('cashback_balance', 'usable_coupons', 'next_expiration')
+# The purchase history fields, derived from the live and archived sales.
+HISTORY_FIELDS = ('sales_count', 'lifetime_spend', 'last_purchase_date')
+
+
+def wallet_totals(customer_ids, today=None):
+    """
+    Aggregate the wallet of many customers in a single query. Returns a dict
+    of dicts, by customer id.
+    """
+    totals = {customer_id : {'cashback_balance' : 0.0, 'usable_coupons' : 0,
+            'next_expiration' : None} for customer_id in customer_ids}
+    for row in Coupon.objects.filter(customer__in=customer_ids).applicable(
+            today).values('customer').annotate(
+            cashback_balance=Sum('discount_value'),
+            usable_coupons=Count('id'),
+            next_expiration=Min('expiration_date')):
+        totals[row.pop('customer')] = row
+    return totals
+
+
+def history_totals(customer_ids):
+    """
+    Aggregate the purchase history (live and archived sales) of many customers.
+    Returns a dict of dicts, by customer id.
+    """
+    totals = {customer_id : {'sales_count' : 0, 'lifetime_spend' : 0.0,
+            'last_purchase_date' : None} for customer_id in customer_ids}
+    for model in (Sale, ArchivedSale):
+        for row in model.objects.filter(customer__in=customer_ids).values(
+                'customer').annotate(sales_count=Count('id'),
+                lifetime_spend=Sum('final_value'),
+                last_purchase_date=Max('date')):
+            customer_totals = totals[row['customer']]
+            customer_totals['sales_count'] += row['sales_count']
+            customer_totals['lifetime_spend'] += row['lifetime_spend']
+            customer_totals['last_purchase_date'] = max(filter(None, (
+                    customer_totals['last_purchase_date'],
+                    row['last_purchase_date'])))
+    return totals
+
+
+def rebuild_profiles(customer_ids, today=None):
+    """
+    Rebuild (or create) the profiles of many customers from the source rows.
+    Returns the number of rebuilt profiles.
+    """
+    customers = dict(Customer.objects.filter(id__in=customer_ids).values_list(
+            'id', 'store'))
+    wallets = wallet_totals(customers.keys(), today)
+    histories = history_totals(customers.keys())
+    CustomerProfile.objects.bulk_create((CustomerProfile(customer_id=
+            customer_id, store_id=store_id, **wallets[customer_id],
+            **histories[customer_id]) for customer_id, store_id in
+            customers.items()), update_conflicts=True,
+            unique_fields=['customer'],
+            update_fields=WALLET_FIELDS + HISTORY_FIELDS)
+    return len(customers)
+
+
+def refresh_wallets(customer_ids, today=None):
+    """
+    Refresh the wallet of many customers, after their coupons changed (ex. a
+    coupon activation, redemption or expiration).
+    """
+    customer_ids = set(customer_ids)
+    profiles = list(CustomerProfile.objects.filter(
+            customer__in=customer_ids).only('customer', *WALLET_FIELDS))
+    wallets = wallet_totals([profile.customer_id for profile in profiles], 
+            today)
+    for profile in profiles:
+        for field, value in wallets[profile.customer_id].items():
+            setattr(profile, field, value)
+    CustomerProfile.objects.bulk_update(profiles, WALLET_FIELDS, 
+            batch_size=1000)
+    # Note: the missing profiles are fully built.
+    missing = customer_ids - {profile.customer_id for profile in profiles}
+    if missing:
+        rebuild_profiles(missing, today)
+
+
+def record_sale(sale):
+    """
+    Add a new sale to the customer purchase history (and refresh the wallet if
+    the sale redeemed a coupon).
+    """
+    updated = CustomerProfile.objects.filter(customer=sale.customer_id).update(
+            sales_count=F('sales_count') + 1,
+            lifetime_spend=F('lifetime_spend') + sale.final_value,
+            last_purchase_date=Greatest(Coalesce('last_purchase_date',
+                    Value(sale.date)), Value(sale.date)))
+    if not updated:
+        rebuild_profiles([sale.customer_id])
+    elif sale.redeemed_coupon_id:
+        refresh_wallets([sale.customer_id])
+
+
+def get_profile(customer_id, today=None):
+    """
+    Read a customer profile. A missing or stale profile (a usable coupon has
+    expired since the last update) is refreshed first.
+    """
+    today = today or date.today()
+    profile = CustomerProfile.objects.filter(customer=customer_id).first()
+    if (profile is None) or (profile.next_expiration and
+            profile.next_expiration < today):
+        refresh_wallets([customer_id], today)
+        profile = CustomerProfile.objects.get(customer=customer_id)
+    return profile
+
+
+def profile_data(profile):
+    """Serialize a customer profile to a dict (ex. for a JSON response)."""
+    return {
+        'cashback_balance' : profile.cashback_balance,
+        'usable_coupons' : profile.usable_coupons,
+        'next_expiration' : profile.next_expiration,
+        'sales_count' : profile.sales_count,
+        'lifetime_spend' : profile.lifetime_spend,
+        'last_purchase_date' : profile.last_purchase_date,
+        }
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
 from pathlib import Path
+import os
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -38,7 +39,6 @@ INSTALLED_APPS = [
     'django_bootstrap5',
     'widget_tweaks',
     'mathfilters',
-    'kronos',
     # Django apps
     'django.contrib.humanize',
     'django.contrib.admin',
@@ -56,6 +56,8 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'es_mvp.middleware.ReplicaPinningMiddleware',
+    'es_mvp.middleware.ShardMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -90,6 +92,40 @@ DATABASES = {
     }
 }
 
+# A local read replica, to test the replica routing (see 'es_mvp/routers.py'):
+# a second connection to the development database, that only sees the
+# committed rows (as a replica with no lag). For a two-PostgreSQL setup, point
+# it to a streaming replica of the 'default' database instead.
+if os.environ.get('ES_MVP_LOCAL_REPLICA'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Local store shards, to test the sharding (see 'es_mvp/sharding.py'): 
+# 'ES_MVP_LOCAL_SHARDS=<n>' adds n - 1 SQLite shards to the 'default' database.
+SHARD_DATABASES = ['default']
+# The read replica of each other shard (shard alias: replica alias). The 
+# replica of 'default' is 'REPLICA_DATABASE'.
+SHARD_REPLICAS = {}
+for index in range(1, int(os.environ.get('ES_MVP_LOCAL_SHARDS', 1))):
+    DATABASES[f'shard{index}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / f'db_shard{index}.sqlite3',
+    }
+    SHARD_DATABASES.append(f'shard{index}')
+    if os.environ.get('ES_MVP_LOCAL_REPLICA'):
+        DATABASES[f'shard{index}_replica'] = {
+            **DATABASES[f'shard{index}'],
+            'TEST': {'MIRROR': f'shard{index}'},
+        }
+        SHARD_REPLICAS[f'shard{index}'] = f'shard{index}_replica'
+
+DATABASE_ROUTERS = [
+    'es_mvp.routers.ShardRouter',
+    'es_mvp.routers.ReplicaRouter',
+]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
@@ -109,6 +145,27 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# Authentication
+# https://docs.djangoproject.com/en/4.2/topics/auth/customizing/
+
+# The store users are memoized (see 'es_mvp/auth.py'). Note: a session keeps
+# the backend of its login, so the stock backend keeps the sessions started
+# before the memoization (a failed login is checked by both).
+AUTHENTICATION_BACKENDS = [
+    'es_mvp.auth.MemoizedModelBackend',
+    'django.contrib.auth.backends.ModelBackend',
+]
+
+
+# Sessions
+# https://docs.djangoproject.com/en/4.2/topics/http/sessions/
+
+# Cached database sessions: read from the cache, falling back to the database.
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+# The cache of the sessions and of the memoized store rows. With many app
+# processes, it must be a shared cache (see the Platform.sh settings below).
+SESSION_CACHE_ALIAS = 'default'
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
@@ -127,6 +184,15 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -136,11 +202,101 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_REDIRECT_URL = 'es_mvp:home'
 LOGOUT_REDIRECT_URL = 'es_mvp:home'
 LOGIN_URL = 'accounts:login'
-
-
-# Third-party settings
-KRONOS_PREFIX = ''
-
+# Sales (and their redeemed/expired coupons) older than this horizon, in days,
+# are moved to the archive tables. See 'es_mvp/archive.py'.
+ARCHIVE_HORIZON_DAYS = 365
+# Maximum number of applicable coupons offered on a new sale (the best ones).
+APPLICABLE_COUPONS_LIMIT = 5
+# Maximum number of parameter combinations in a campaign simulation.
+SIMULATOR_MAX_COMBINATIONS = 2000
+# How the SMS templates are fitted in a single billed segment (see 
+# 'compile_sms_template()' in 'es_mvp/sms.py'): 'transliterate', 'truncate' or 
+# 'none'.
+SMS_ENCODING_POLICY = 'transliterate'
+# The cost (USD) of a billed SMS segment. Used to project the sending costs.
+SMS_SEGMENT_COST = 0.00645
+# Maximum number of activation messages sent to a customer per day. The due 
+# coupons of a customer are merged in a single digest message. None disables 
+# the cap.
+SMS_DAILY_CAP = 1
+# Maximum number of queued notifications sent per minute. The notifications are
+# spread across the delivery window of each store (see 'StoreSettings').
+NOTIFICATION_DELIVERY_RATE = 300
+# The suppression list of the notifications (see 'es_mvp/suppression.py'): the
+# spare capacity of its Bloom filter, the false positive rate (each positive is
+# confirmed in the table) and how often, in seconds, it is rebuilt.
+SUPPRESSION_LIST_CAPACITY = 10000
+SUPPRESSION_LIST_ERROR_RATE = 0.001
+SUPPRESSION_LIST_MAX_AGE = 60 * 60
+# Number of delivery receipts updated per bulk query (see 
+# 'es_mvp/receipts.py').
+DELIVERY_RECEIPT_BATCH_SIZE = 1000
+# The scheduler service tick, in seconds (see 'es_mvp/scheduler.py').
+SCHEDULER_INTERVAL = 15
+# Missed schedule slots up to this age, in minutes, are caught up.
+SCHEDULER_CATCHUP_MINUTES = 24 * 60
+# The cache of the velocity counters (see 'es_mvp/velocity.py'). With many app 
+# processes, it must be a shared cache (the Platform.sh deployment uses its 
+# Redis service, see below).
+VELOCITY_CACHE = 'default'
+# Number of buckets of each sliding window.
+VELOCITY_BUCKETS = 12
+# Velocity rules: (scope, metric, window in seconds, limit). A sale over any 
+# limit is flagged as suspect and its coupon issuance is held.
+VELOCITY_RULES = (
+    ('customer', 'sales', 60 * 60, 3),
+    ('customer', 'sales', 24 * 60 * 60, 6),
+    ('customer', 'cashback', 24 * 60 * 60, 500.0),
+    ('store', 'sales', 60 * 60, 500),
+)
+# The cache of the store page fragments (see 'es_mvp/fragments.py'). The store
+# data versions live in the database, so a per-process cache only keeps a copy
+# of the fragments per process.
+FRAGMENT_CACHE = 'default'
+# Maximum age of a cached fragment, in seconds. The fragments are invalidated
+# by the store data changes, so it only bounds the cache usage.
+FRAGMENT_CACHE_TIMEOUT = 24 * 60 * 60
+# What to do with a new sale whose POS identifier (ex. the invoice number) was
+# already registered by the store (a live or archived sale): 'reject' it (a
+# form error), 'attach' it to the existing sale (no new sale, nor coupon) or
+# 'allow' it. Note: 'reject' and 'attach' serialize the registrations of each
+# store (a row lock).
+SALE_IDENTIFIER_POLICY = 'reject'
+# How long, in hours, a sale registration can be retried with its idempotency
+# key (see 'SaleIdempotencyKey' in 'es_mvp/models.py').
+SALE_IDEMPOTENCY_KEY_TTL = 24
+# Maximum number of events per read of the coupon event ledger tail (see 
+# 'es_mvp/ledger.py').
+COUPON_EVENT_TAIL_LIMIT = 1000
+# Maximum age of a memoized store user or settings, in seconds (see 
+# 'es_mvp/auth.py'). 0 disables the memoization.
+STORE_MEMO_TIMEOUT = 5 * 60
+# Serve the home and campaign pages with async views, running the summary
+# queries concurrently (see 'es_mvp/dashboards.py'). Only for the ASGI
+# deployment.
+ASYNC_DASHBOARDS = False
+# How long, in seconds, the async views wait for a summary query. The totals of
+# a late query are left out of the page. None waits for all.
+DASHBOARD_QUERY_TIMEOUT = None
+# The read replica database alias (see 'es_mvp/routers.py'). Without it, all
+# reads go to the primary.
+REPLICA_DATABASE = 'replica'
+# Maximum replica lag, in seconds. A lagging replica is skipped.
+REPLICA_MAX_LAG = 5
+# How often, in seconds, the replica lag is checked (per process).
+REPLICA_LAG_CHECK_INTERVAL = 10
+# How long, in seconds, a store session reads from the primary after writing.
+REPLICA_PIN_SECONDS = 10
+# How long, in seconds, a store shard is cached from the directory. With many 
+# app processes, the default cache should be a shared cache (see the 
+# Platform.sh settings below): with a per-process cache, a store move waits 
+# this long twice (see 'move_store()').
+SHARD_DIRECTORY_TIMEOUT = 5 * 60
+# The size of the id range of each shard (see 'init_sequences()').
+SHARD_ID_RANGE = 10 ** 12
+# How long, in seconds, a moving store waits for its requests and job runs in
+# flight.
+SHARD_MOVE_GRACE = 5
 
 ### Platform.sh settings.
 # More info: 
@@ -148,12 +304,15 @@ KRONOS_PREFIX = ''
 # https://github.com/platformsh/config-reader-python
 # https://pypi.org/project/platformshconfig/
 
-from platformshconfig import Config
-
-config = Config()
-if config.is_valid_platform():
+# Note: 'platformshconfig' is only loaded on Platform.sh (detected by its 
+# environment variables), so the local processes start faster.
+if os.getenv('PLATFORM_APPLICATION_NAME'):
+    from platformshconfig import Config
+    config = Config()
+else:
+    config = None
+if config and config.is_valid_platform():
     ALLOWED_HOSTS.append('.platformsh.site')
-    KRONOS_PREFIX = '' 
 
     if config.appDir:
         STATIC_ROOT = Path(config.appDir) / 'static'
@@ -172,6 +331,33 @@ if config.is_valid_platform():
                 'PORT': db_settings['port'],
             },
         }
+        # An optional streaming replica of the database.
+        if config.has_relationship('replica'):
+            replica_settings = config.credentials('replica')
+            DATABASES['replica'] = {
+                'ENGINE': 'django.db.backends.postgresql',
+                'NAME': replica_settings['path'],
+                'USER': replica_settings['username'],
+                'PASSWORD': replica_settings['password'],
+                'HOST': replica_settings['host'],
+                'PORT': replica_settings['port'],
+            }
+        # The cache shared by the app processes (the velocity counters, the
+        # store directory, the sessions and the memoized store rows), from the
+        # Redis service.
+        if config.has_relationship('redis'):
+            redis_settings = config.credentials('redis')
+            CACHES['default'] = {
+                'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+                'LOCATION': (f"redis://{redis_settings['host']}:"
+                        f"{redis_settings['port']}"),
+            }
+        else:
+            # A per-process cache would serve stale sessions and store rows
+            # to the other processes: the sessions are read from the database,
+            # and the store rows are not memoized.
+            SESSION_ENGINE = 'django.contrib.sessions.backends.db'
+            STORE_MEMO_TIMEOUT = 0
 
 
 